@@ -0,0 +1,179 @@
+"""Benchmarks the NextStrain parsing stages on synthetic trees.
+
+Each stage is timed (wall and CPU) and, unless `--no-memory` is given,
+memory profiled with `tracemalloc` in a separate run so the profiler does
+not skew the timings. Results are written as JSON so throughput can be
+compared across releases:
+
+    python benchmarks/bench_nextstrain.py --sizes 10000 100000 1000000 \\
+        --output bench.json
+
+@author: Kyle Hernandez <kmhernan@uchicago.edu>
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from dmwg_data_pyutils.common.io import load_json_file, streaming_json_available
+from dmwg_data_pyutils.common.logger import Logger
+from dmwg_data_pyutils.common.nextstrain import NextStrainParser, NextStrainTreeIndex
+from dmwg_data_pyutils.common.synthetic import build_synthetic_tree
+from dmwg_data_pyutils.subcommands import ParseNextStrain
+
+
+def run_stage(name, func, nodes, memory):
+    """Runs `func` once for timing and once under tracemalloc."""
+    gc.collect()
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    result = func()
+    wall = time.perf_counter() - wall
+    cpu = time.process_time() - cpu
+    stats = {
+        "wall_s": round(wall, 4),
+        "cpu_s": round(cpu, 4),
+        "nodes_per_s": round(nodes / wall, 1) if wall else None,
+    }
+    if memory:
+        del result
+        gc.collect()
+        tracemalloc.start()
+        result = func()
+        stats["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    print("  {:<22} {:>9.3f}s".format(name, wall), file=sys.stderr)
+    return stats, result
+
+
+def bench_size(size, args, tmpdir):
+    """Runs all stages on one synthetic tree."""
+    print("size={}".format(size), file=sys.stderr)
+    dat = build_synthetic_tree(
+        size,
+        max_depth=args.max_depth,
+        skew=args.skew,
+        mutation_rate=args.mutation_rate,
+        seed=args.seed,
+    )
+    json_path = os.path.join(tmpdir, "tree{}.json".format(size))
+    with open(json_path, "wt") as o:
+        json.dump(dat, o)
+    del dat
+
+    stages = {}
+    memory = not args.no_memory
+
+    stats, dat = run_stage("load", lambda: load_json_file(json_path), size, memory)
+    stages["load"] = stats
+
+    if streaming_json_available():
+        stats, _ = run_stage(
+            "load_stream",
+            lambda: NextStrainParser.from_file_path(json_path, stream=True),
+            size,
+            memory,
+        )
+        stages["load_stream"] = stats
+
+    stats, index = run_stage(
+        "index", lambda: NextStrainTreeIndex.from_obj(dat), size, memory
+    )
+    stages["index"] = stats
+
+    legacy = NextStrainParser(dat)
+    stats, _ = run_stage("_append_parents", legacy._append_parents, size, memory)
+    stages["_append_parents"] = stats
+    stats, nodes = run_stage("_flatten_nodes", legacy._flatten_nodes, size, memory)
+    stages["_flatten_nodes"] = stats
+    if size <= args.legacy_max_size:
+        stats, _ = run_stage(
+            "_collect_mutations",
+            lambda: [legacy._collect_mutations(n) for n in nodes],
+            size,
+            memory,
+        )
+        stages["_collect_mutations"] = stats
+    del legacy, nodes, dat
+    gc.collect()
+
+    nstree = NextStrainParser(None, index=index)
+    stats, _ = run_stage(
+        "mutation_traversal",
+        lambda: sum(1 for _ in nstree.mutation_traversal_generator()),
+        size,
+        memory,
+    )
+    stages["mutation_traversal"] = stats
+
+    out_path = os.path.join(tmpdir, "out{}.tsv.gz".format(size))
+    logger = Logger.get_logger("bench")
+    stats, _ = run_stage(
+        "write_tsv",
+        lambda: ParseNextStrain._write_serial(
+            nstree, ParseNextStrain._tsv_writer(out_path), logger
+        ),
+        size,
+        memory,
+    )
+    stages["write_tsv"] = stats
+
+    return {
+        "size": size,
+        "json_bytes": os.path.getsize(json_path),
+        "stages": stages,
+    }
+
+
+def main(args=None):
+    p = argparse.ArgumentParser("NextStrain benchmarks")
+    p.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    p.add_argument("--max-depth", type=int, default=None)
+    p.add_argument("--skew", type=float, default=0.5)
+    p.add_argument("--mutation-rate", type=float, default=1.0)
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument(
+        "--legacy-max-size",
+        type=int,
+        default=100000,
+        help="Largest tree to run the O(N*depth) _collect_mutations on.",
+    )
+    p.add_argument("--no-memory", action="store_true", help="Skip tracemalloc runs.")
+    p.add_argument("--output", default="bench.json", help="JSON results path.")
+    options = p.parse_args(args)
+
+    # json.dump and the legacy recursion need room on deep trees
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 100000))
+    Logger.RootLogger.setLevel("WARNING")
+
+    tmpdir = tempfile.mkdtemp(prefix="bench_nextstrain-")
+    try:
+        results = [bench_size(size, options, tmpdir) for size in options.sizes]
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "ijson": streaming_json_available(),
+        "params": {
+            "max_depth": options.max_depth,
+            "skew": options.skew,
+            "mutation_rate": options.mutation_rate,
+            "seed": options.seed,
+        },
+        "results": results,
+    }
+    with open(options.output, "wt") as o:
+        json.dump(report, o, indent=2)
+    print("Results written to {}".format(options.output), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
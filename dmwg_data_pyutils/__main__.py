@@ -1,12 +1,12 @@
 """
-Main entrypoint for all dmwg-data-pyutils. 
+Main entrypoint for all dmwg-data-pyutils.
 """
 import argparse
-import datetime
+import os
 import sys
 
 from dmwg_data_pyutils.common.logger import Logger
-from dmwg_data_pyutils.subcommands import ParseNextStrain
+from dmwg_data_pyutils.subcommands import DESCRIPTIONS, SUBCOMMANDS, load_subcommand
 
 
 def main(args=None, extra_subparser=None):
@@ -18,12 +18,23 @@ def main(args=None, extra_subparser=None):
 
     logger = Logger.get_logger("main")
 
+    if args is None:
+        args = sys.argv[1:]
+
     # Get args
     p = argparse.ArgumentParser("DMWG Data Utils")
     subparsers = p.add_subparsers(dest="subcommand")
     subparsers.required = True
 
-    ParseNextStrain.add(subparsers=subparsers)
+    # Only the selected subcommand, the first positional argument, is
+    # imported and gets its arguments; the others are listed with their
+    # description
+    selected = next((i for i in args if not i.startswith("-")), None)
+    for name in SUBCOMMANDS:
+        if name == selected:
+            load_subcommand(name).add(subparsers=subparsers)
+        else:
+            subparsers.add_parser(name, help=DESCRIPTIONS[name])
 
     if extra_subparser:
         extra_subparser.add(subparsers=subparsers)
@@ -31,7 +42,15 @@ def main(args=None, extra_subparser=None):
     options = p.parse_args(args)
 
     # Run
-    options.func(options)
+    try:
+        options.func(options)
+    except BrokenPipeError:
+        # The reader of a stdout pipe (e.g. head) exited early. Points stdout
+        # at devnull so flushing it at exit doesn't fail again.
+        logger.warning("Output pipe closed early, stopping.")
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        sys.exit(1)
 
     # Finish
     logger.info("Finished!")
@@ -0,0 +1,311 @@
+"""Streaming download utilities.
+
+@author: Kyle Hernandez <kmhernan@uchicago.edu>
+"""
+import io
+import os
+import json
+import queue
+import hashlib
+import threading
+import zlib
+import urllib.error
+import urllib.parse
+import urllib.request
+from typing import Optional, BinaryIO, Union, Dict, Any, Mapping
+
+from dmwg_data_pyutils.common.io import GZIP_MAGIC
+from dmwg_data_pyutils.common.writers import file_sha256
+
+DEFAULT_CHUNK_SIZE = 1 << 20
+DEFAULT_PREFETCH_CHUNKS = 8
+
+
+class ChunkPrefetcher(threading.Thread):
+    """
+    Reads chunks from a binary stream on a background thread into a
+    bounded queue, so network I/O overlaps with decompression and parsing
+    while at most `max_chunks` chunks are buffered.
+    """
+
+    def __init__(
+        self,
+        fh: BinaryIO,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        max_chunks: int = DEFAULT_PREFETCH_CHUNKS,
+    ):
+        super().__init__(name="ChunkPrefetcher", daemon=True)
+        self.fh = fh
+        self.chunk_size = chunk_size
+        self.queue = queue.Queue(max_chunks)
+        self._halt = threading.Event()
+
+    def run(self) -> None:
+        try:
+            while not self._halt.is_set():
+                chunk = self.fh.read(self.chunk_size)
+                self._put(chunk)
+                if not chunk:
+                    return
+        except BaseException as e:
+            self._put(e)
+
+    def _put(self, item: Union[bytes, BaseException]) -> None:
+        while not self._halt.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def get(self) -> bytes:
+        """Returns the next chunk, `b""` at EOF, or raises a reader error."""
+        item = self.queue.get()
+        if isinstance(item, BaseException):
+            raise item
+        return item
+
+    def stop(self) -> None:
+        """
+        Signals the reader thread to stop after its current read,
+        discarding unread chunks.
+        """
+        self._halt.set()
+
+
+class DownloadStream(io.RawIOBase):
+    """
+    Readable binary stream over a download that is prefetched in chunks,
+    gunzipped on the fly if it starts with the gzip magic bytes and
+    optionally teed to `save_path` as it is read. By default the bytes are
+    saved exactly as they were received, so a gzipped body stays gzipped
+    on disk; set `save_compressed` to False to save the decompressed data.
+
+    The saved file is written to `<save_path>.part` and only moved into
+    place by `finish` (called when the context manager exits cleanly),
+    which first drains any data the consumer did not read. Interrupted
+    downloads never leave a truncated file at `save_path`.
+    """
+
+    def __init__(
+        self,
+        fh: BinaryIO,
+        save_path: Optional[str] = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        max_chunks: int = DEFAULT_PREFETCH_CHUNKS,
+        save_compressed: bool = True,
+    ):
+        super().__init__()
+        self.save_path = save_path
+        self.save_compressed = save_compressed
+        self.bytes_read = 0
+        self.bytes_saved = 0
+        self._digest = hashlib.sha256()
+        self._prefetcher = ChunkPrefetcher(fh, chunk_size, max_chunks)
+        self._prefetcher.start()
+        self._decompressor = None
+        self._started = False
+        self._eof = False
+        self._buffer = b""
+        self._pos = 0
+        self._sink = None
+        if save_path:
+            self._sink = open(self._part_path, "wb")
+
+    @property
+    def _part_path(self) -> str:
+        return self.save_path + ".part"
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while self._pos >= len(self._buffer):
+            if self._eof:
+                return 0
+            self._fill()
+        n = min(len(b), len(self._buffer) - self._pos)
+        b[:n] = self._buffer[self._pos : self._pos + n]
+        self._pos += n
+        return n
+
+    def _fill(self) -> None:
+        """Pulls the next chunk, decompresses it and tees it to disk."""
+        chunk = self._prefetcher.get()
+        self.bytes_read += len(chunk)
+        if not self._started and chunk:
+            self._started = True
+            if chunk[:2] == GZIP_MAGIC:
+                self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        if not chunk:
+            self._eof = True
+            data = self._decompressor.flush() if self._decompressor else b""
+        elif self._decompressor is not None:
+            data = self._decompressor.decompress(chunk)
+            # Concatenated gzip members
+            while self._decompressor.unused_data:
+                rest = self._decompressor.unused_data
+                self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                data += self._decompressor.decompress(rest)
+        else:
+            data = chunk
+
+        self._save(chunk if self.save_compressed else data)
+        self._buffer = data
+        self._pos = 0
+
+    def _save(self, data: bytes) -> None:
+        if self._sink is not None and data:
+            self._sink.write(data)
+            self._digest.update(data)
+            self.bytes_saved += len(data)
+
+    @property
+    def sha256(self) -> str:
+        """Hex SHA-256 of the bytes written to `save_path`."""
+        return self._digest.hexdigest()
+
+    def finish(self) -> None:
+        """
+        Drains the rest of the download and moves the saved file into
+        place.
+        """
+        while not self._eof:
+            self._fill()
+        self._buffer = b""
+        if self._sink is not None:
+            self._sink.close()
+            self._sink = None
+            os.replace(self._part_path, self.save_path)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self._prefetcher.stop()
+        if self._sink is not None:
+            self._sink.close()
+            self._sink = None
+            os.remove(self._part_path)
+        super().close()
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.finish()
+        self.close()
+
+
+class DownloadCache:
+    """
+    Directory of downloaded files that can be revalidated with conditional
+    GET requests. Each file has a `<file>.meta.json` sidecar recording the
+    URL, ETag, Last-Modified, size and SHA-256 of the saved file.
+    """
+
+    META_SUFFIX = ".meta.json"
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path_for(self, url: str) -> str:
+        """Returns the cache location of a URL."""
+        name = os.path.basename(urllib.parse.urlsplit(url).path) or "download"
+        digest = hashlib.sha1(url.encode("utf-8")).hexdigest()[:12]
+        return os.path.join(self.cache_dir, "{}-{}".format(digest, name))
+
+    def lookup(self, url: str) -> Optional[Dict[str, Any]]:
+        """
+        Returns the metadata of a cached URL, or None if it was never cached
+        or the cached file no longer matches the recorded size and SHA-256.
+        The file is only hashed if the size matches.
+        """
+        path = self.path_for(url)
+        try:
+            with open(path + self.META_SUFFIX, "rt") as fh:
+                meta = json.load(fh)
+        except (OSError, ValueError):
+            return None
+        if meta.get("url") != url or not os.path.isfile(path):
+            return None
+        if os.path.getsize(path) != meta.get("size"):
+            return None
+        if file_sha256(path) != meta.get("sha256"):
+            return None
+        return meta
+
+    def conditional_headers(self, url: str) -> Dict[str, str]:
+        """Returns the revalidation headers for a cached URL."""
+        headers = {}
+        meta = self.lookup(url)
+        if meta is not None:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+        return headers
+
+    def store(
+        self, url: str, headers: Mapping[str, str], size: int, sha256: str
+    ) -> None:
+        """Records the metadata of a freshly downloaded URL."""
+        path = self.path_for(url)
+        meta = {
+            "url": url,
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+            "size": size,
+            "sha256": sha256,
+        }
+        tmp = path + self.META_SUFFIX + ".part"
+        with open(tmp, "wt") as o:
+            json.dump(meta, o, sort_keys=True, indent=2)
+        os.replace(tmp, path + self.META_SUFFIX)
+
+
+def download_file(
+    url: str,
+    save_path: Optional[str] = None,
+    cache: Optional[DownloadCache] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> str:
+    """
+    Downloads `url` to `save_path` as received (gzip stays gzip) and
+    returns the path. With a `cache` the file is kept in the cache instead
+    and only downloaded again if the server does not answer the conditional
+    GET with 304. Like `DownloadStream`, the file is written to
+    `<path>.part` and only moved into place once complete.
+    """
+    headers = {}
+    if cache is not None:
+        save_path = cache.path_for(url)
+        headers = cache.conditional_headers(url)
+    assert save_path is not None, "Either save_path or cache is required"
+
+    request = urllib.request.Request(url, headers=headers)
+    try:
+        response = urllib.request.urlopen(request)
+    except urllib.error.HTTPError as e:
+        if cache is None or e.code != 304:
+            raise
+        e.close()
+        return save_path
+
+    part_path = save_path + ".part"
+    digest = hashlib.sha256()
+    size = 0
+    with response as f:
+        try:
+            with open(part_path, "wb") as o:
+                for chunk in iter(lambda: f.read(chunk_size), b""):
+                    o.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+            os.replace(part_path, save_path)
+        except BaseException:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+        if cache is not None:
+            cache.store(url, f.headers, size, digest.hexdigest())
+    return save_path
@@ -0,0 +1,411 @@
+"""On-disk cache of parsed NextStrain tree indexes.
+
+The `NextStrainTreeIndex` of a JSON is saved in a compact binary file
+keyed by the SHA-256 of the JSON, so later runs on the same file map the
+index into memory instead of parsing the JSON again. The integer arrays
+(parents, children, traversal order, mutation ids) are used straight from
+the memory map, so processes on one host share their pages; names,
+attribute columns and the mutation vocabulary are decoded from
+dictionary-encoded blocks when the file is opened.
+
+File layout, with every section 8-byte aligned::
+
+    MAGIC | header length (uint64, little-endian) | JSON header | sections
+
+The header records the schema, the byte order and the offset, length and
+array typecode of each section.
+
+@author: Kyle Hernandez <kmhernan@uchicago.edu>
+"""
+import os
+import sys
+import json
+import mmap
+import struct
+import hashlib
+import tempfile
+from array import array
+from typing import Any, Dict, List, Optional, Tuple
+
+from dmwg_data_pyutils.common.logger import Logger
+from dmwg_data_pyutils.common.nextstrain import (
+    NextStrainSchema,
+    NextStrainTreeIndex,
+    MutationVocabulary,
+)
+
+MAGIC = b"NSIDX\x00\x00\x00"
+FORMAT_VERSION = 1
+DEFAULT_MAX_BYTES = 2 << 30
+INDEX_SUFFIX = ".idx"
+# Separator of the strings of a blob; strings containing it can't be cached
+STRING_SEP = "\x00"
+_ALIGN = 8
+_HASH_CHUNK_SIZE = 1 << 20
+
+
+class IndexCache:
+    """
+    Directory of binary tree indexes keyed by the SHA-256 of their source
+    JSON (see the module docstring). Indexes built with an inferred schema
+    are kept apart from the ones with the default schema. Once the
+    directory holds more than `max_bytes` of indexes, the least recently
+    used ones are evicted.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.logger = Logger.get_logger("IndexCache")
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def file_digest(path: str) -> str:
+        """Returns the hex SHA-256 of a file's bytes."""
+        digest = hashlib.sha256()
+        with open(path, "rb") as fh:
+            for chunk in iter(lambda: fh.read(_HASH_CHUNK_SIZE), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def path_for(self, digest: str, infer_schema: bool = False) -> str:
+        """Returns the cache location of the index of a JSON digest."""
+        kind = "inferred" if infer_schema else "default"
+        return os.path.join(
+            self.cache_dir, "{}-{}{}".format(digest, kind, INDEX_SUFFIX)
+        )
+
+    def load(
+        self, digest: str, infer_schema: bool = False
+    ) -> Optional[NextStrainTreeIndex]:
+        """
+        Returns the cached index of a JSON digest, or None if it is not
+        cached. Unreadable entries are removed.
+        """
+        path = self.path_for(digest, infer_schema)
+        if not os.path.isfile(path):
+            return None
+        try:
+            index = MappedTreeIndex.from_path(path)
+        except (OSError, ValueError, KeyError, struct.error) as e:
+            self.logger.warning(
+                "Removing unreadable cached index {}: {}".format(path, e)
+            )
+            self._remove(path)
+            return None
+        # Marks the entry as recently used for the eviction
+        os.utime(path)
+        self.logger.info("Loaded cached index {}".format(path))
+        return index
+
+    def store(
+        self, digest: str, index: NextStrainTreeIndex, infer_schema: bool = False
+    ) -> Optional[str]:
+        """
+        Saves the index of a JSON digest and evicts old entries. Returns
+        the path of the entry, or None if the index can't be cached.
+        """
+        path = self.path_for(digest, infer_schema)
+        (fd, tmp) = tempfile.mkstemp(prefix=".", suffix=".part", dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, "wb") as o:
+                write_index(o, index)
+            os.replace(tmp, path)
+        except ValueError as e:
+            self._remove(tmp)
+            self.logger.warning("Not caching the index: {}".format(e))
+            return None
+        except BaseException:
+            self._remove(tmp)
+            raise
+        self.logger.info("Cached index in {}".format(path))
+        self.evict(keep=path)
+        return path
+
+    def entries(self) -> List[Tuple[float, int, str]]:
+        """Returns `(mtime, size, path)` of the cached indexes, oldest first."""
+        res = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(INDEX_SUFFIX):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            res.append((st.st_mtime, st.st_size, path))
+        return sorted(res)
+
+    def evict(self, keep: Optional[str] = None) -> int:
+        """
+        Removes the least recently used indexes (except `keep`) until the
+        cache holds at most `max_bytes`. Returns the number of bytes freed.
+        Indexes that are still mapped by a process stay readable by it.
+        """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        freed = 0
+        for _, size, path in entries:
+            if total - freed <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            if self._remove(path):
+                self.logger.info("Evicted cached index {}".format(path))
+                freed += size
+        return freed
+
+    @staticmethod
+    def _remove(path: str) -> bool:
+        try:
+            os.remove(path)
+        except OSError:
+            return False
+        return True
+
+
+class MappedTreeIndex(NextStrainTreeIndex):
+    """
+    `NextStrainTreeIndex` read from a cached index file. The integer arrays
+    are `memoryview`s over the memory mapped file. The mutation ids and the
+    mutation strings are decoded on first use.
+    """
+
+    def __init__(self, buf: Any, header: Dict[str, Any], sections: Dict[str, Any]):
+        self._buf = buf
+        self._sections = sections
+        self.schema = NextStrainSchema(**header["schema"])
+        self.names = decode_strings(sections["names"], header["nodes"])
+        self.parents = sections["parents"]
+        self.child_offsets = sections["child_offsets"]
+        self.child_ids = sections["child_ids"]
+        self.attrs = {}
+        for i, k in enumerate(self.schema.attr_keys):
+            values = header["attr_values"][i]
+            if values is None:
+                values = list(sections["attr{}.values".format(i)])
+                values[0] = None
+            self.attrs[k] = list(map(values.__getitem__, sections["attr{}".format(i)]))
+        self._genes = [sys.intern(k) for k in header["genes"]]
+        strings = decode_strings(
+            sections["vocabulary"], sum(header["vocabulary_sizes"])
+        )
+        vocabulary = {}
+        start = 0
+        for k, size in zip(self._genes, header["vocabulary_sizes"]):
+            vocabulary[k] = strings[start : start + size]
+            start += size
+        self._vocabulary = MutationVocabulary(vocabulary)
+        self._order = sections["order"]
+        self._duplicates = set(sections["duplicates"])
+        self._subtree_ends = sections["subtree_ends"]
+        self._mutation_ids = None
+        self._mutations = None
+
+    @classmethod
+    def from_path(cls, path: str) -> "MappedTreeIndex":
+        """Memory maps a cached index file."""
+        with open(path, "rb") as fh:
+            buf = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        header, sections = read_sections(memoryview(buf))
+        return cls(buf, header, sections)
+
+    @property
+    def mutation_ids(self) -> List[Optional[Dict[str, Tuple[int, ...]]]]:
+        """The branch mutations of each node as `vocabulary` ids."""
+        if self._mutation_ids is None:
+            sections = self._sections
+            group_nodes = sections["group_nodes"]
+            group_genes = sections["group_genes"]
+            offsets = sections["group_offsets"]
+            ids = sections["mutation_ids"]
+            genes = self._genes
+            res = [None] * len(self.names)
+            for g, idx in enumerate(group_nodes):
+                muts = res[idx]
+                if muts is None:
+                    muts = res[idx] = {}
+                muts[genes[group_genes[g]]] = tuple(ids[offsets[g] : offsets[g + 1]])
+            self._mutation_ids = res
+        return self._mutation_ids
+
+    @property
+    def mutations(self) -> List[Optional[Dict[str, Tuple[str, ...]]]]:
+        """The branch mutations of each node, `None` if there are none."""
+        if self._mutations is None:
+            strings = self.vocabulary.strings
+            self._mutations = [
+                None
+                if muts is None
+                else {k: tuple(map(strings[k].__getitem__, v)) for k, v in muts.items()}
+                for muts in self.mutation_ids
+            ]
+        return self._mutations
+
+    def __getstate__(self) -> Dict[str, Any]:
+        """Copies the mapped arrays, e.g. to send the index to a process."""
+        state = dict(self.__dict__)
+        del state["_buf"]
+        for name in ("parents", "child_offsets", "child_ids"):
+            state[name] = array("q", state[name])
+        for name in ("_order", "_subtree_ends"):
+            state[name] = array("q", state[name])
+        state["_sections"] = {
+            k: array(v.format, v) for k, v in state["_sections"].items()
+        }
+        return state
+
+
+def write_index(fh: Any, index: NextStrainTreeIndex) -> None:
+    """
+    Writes an index in the cache file format to a binary file handle.
+    Raises a `ValueError` if a name or mutation contains `STRING_SEP`.
+    """
+    schema = index.schema
+    sections = [
+        ("names", encode_strings(index.names)),
+        ("parents", array("q", index.parents)),
+        ("child_offsets", array("q", index.child_offsets)),
+        ("child_ids", array("q", index.child_ids)),
+        ("order", array("q", index.order)),
+        ("duplicates", array("q", sorted(index.duplicates))),
+        ("subtree_ends", array("q", index.subtree_ends)),
+    ]
+    attr_values = []
+    for i, k in enumerate(schema.attr_keys):
+        codes, values = encode_column(index.attrs[k])
+        sections.append(("attr{}".format(i), codes))
+        if all(v.__class__ is float for v in values[1:]):
+            values[0] = float("nan")
+            sections.append(("attr{}.values".format(i), array("d", values)))
+            attr_values.append(None)
+        else:
+            attr_values.append(values)
+
+    vocabulary = index.vocabulary.strings
+    genes = list(vocabulary)
+    gene_codes = {k: i for i, k in enumerate(genes)}
+    strings = []
+    for k in genes:
+        strings.extend(vocabulary[k])
+    sections.append(("vocabulary", encode_strings(strings)))
+
+    group_nodes = array("q")
+    group_genes = array("i")
+    group_offsets = array("q", [0])
+    ids = array("i")
+    for idx, muts in enumerate(index.mutation_ids):
+        if muts:
+            for k, v in muts.items():
+                group_nodes.append(idx)
+                group_genes.append(gene_codes[k])
+                ids.extend(v)
+                group_offsets.append(len(ids))
+    sections.extend(
+        [
+            ("group_nodes", group_nodes),
+            ("group_genes", group_genes),
+            ("group_offsets", group_offsets),
+            ("mutation_ids", ids),
+        ]
+    )
+
+    header = {
+        "version": FORMAT_VERSION,
+        "byteorder": sys.byteorder,
+        "nodes": len(index),
+        "schema": {
+            "attr_keys": schema.attr_keys,
+            "numeric": schema.numeric,
+            "genes": schema.genes,
+            "scalar": schema.scalar,
+        },
+        "attr_values": attr_values,
+        "genes": genes,
+        "vocabulary_sizes": [len(vocabulary[k]) for k in genes],
+        "sections": {},
+    }
+    offset = 0
+    for name, data in sections:
+        nbytes = len(data) * data.itemsize
+        header["sections"][name] = [offset, nbytes, data.typecode]
+        offset += _padded(nbytes)
+    raw = json.dumps(header).encode("utf-8")
+    fh.write(MAGIC)
+    fh.write(struct.pack("<Q", len(raw)))
+    fh.write(raw)
+    fh.write(b"\x00" * (_padded(len(raw)) - len(raw)))
+    for name, data in sections:
+        nbytes = len(data) * data.itemsize
+        fh.write(data.tobytes())
+        fh.write(b"\x00" * (_padded(nbytes) - nbytes))
+
+
+def read_sections(buf: memoryview) -> Tuple[Dict[str, Any], Dict[str, memoryview]]:
+    """
+    Parses the header of a cache file and returns it with a typed
+    `memoryview` of each section. Raises a `ValueError` if the file is not
+    a cache file of this version and byte order.
+    """
+    if bytes(buf[: len(MAGIC)]) != MAGIC:
+        raise ValueError("Not a cached index")
+    start = len(MAGIC) + 8
+    (size,) = struct.unpack("<Q", buf[len(MAGIC) : start])
+    header = json.loads(bytes(buf[start : start + size]).decode("utf-8"))
+    if header.get("version") != FORMAT_VERSION:
+        raise ValueError("Unsupported cached index version")
+    if header.get("byteorder") != sys.byteorder:
+        raise ValueError("Cached index has a different byte order")
+    data = start + _padded(size)
+    sections = {}
+    for name, (offset, nbytes, typecode) in header["sections"].items():
+        if data + offset + nbytes > len(buf):
+            raise ValueError("Truncated cached index")
+        view = buf[data + offset : data + offset + nbytes]
+        sections[name] = view if typecode == "B" else view.cast(typecode)
+    return header, sections
+
+
+def encode_strings(strings: List[str]) -> array:
+    """Joins strings into a utf-8 blob."""
+    blob = STRING_SEP.join(strings)
+    if blob.count(STRING_SEP) != max(len(strings) - 1, 0):
+        raise ValueError("Strings containing NUL characters can't be cached")
+    return array("B", blob.encode("utf-8"))
+
+
+def decode_strings(blob: memoryview, count: int) -> List[str]:
+    """Splits a blob of `encode_strings` into its `count` strings."""
+    if count == 0:
+        return []
+    res = bytes(blob).decode("utf-8").split(STRING_SEP)
+    if len(res) != count:
+        raise ValueError("Corrupt string table in cached index")
+    return res
+
+
+def encode_column(column: List[Any]) -> Tuple[array, List[Any]]:
+    """
+    Dictionary encodes an attribute column. Returns the code of each value
+    and the distinct values, `None` always having code 0. Values are told
+    apart by type as well, so `1` and `1.0` stay distinct.
+    """
+    values = [None]
+    ids = {(None.__class__, None): 0}
+    codes = array("i", [0]) * len(column)
+    for i, value in enumerate(column):
+        try:
+            key = (value.__class__, value)
+            code = ids.get(key)
+        except TypeError:
+            key = (value.__class__, json.dumps(value, sort_keys=True))
+            code = ids.get(key)
+        if code is None:
+            code = ids[key] = len(values)
+            values.append(value)
+        codes[i] = code
+    return codes, values
+
+
+def _padded(nbytes: int) -> int:
+    return (nbytes + _ALIGN - 1) // _ALIGN * _ALIGN
@@ -2,15 +2,115 @@
 
 @author: Kyle Hernandez <kmhernan@uchicago.edu>
 """
+import io
+import gzip
 import json
-from typing import Union, Dict, List, Any
+import importlib.util
+from typing import Union, Dict, List, Any, BinaryIO, Iterator, Tuple
+
+GZIP_MAGIC = b"\x1f\x8b"
+# Path standing for stdin (inputs) or stdout (outputs)
+STDIO_PATH = "-"
+
+JsonEventT = Tuple[str, Any]
 
 
 def load_json_file(file_path: str) -> Union[Dict[str, Any], List[Any]]:
     """
-    Helper function to open a JSON file and load.
+    Helper function to open a JSON file and load. Gzipped files are
+    detected by their magic bytes and decompressed transparently.
     """
     dat = None
-    with open(file_path, "rt") as fh:
-        dat = json.load(fh)
+    with open(file_path, "rb") as fh:
+        dat = json.load(open_maybe_gzip(fh))
     return dat
+
+
+def open_maybe_gzip(fh: BinaryIO) -> BinaryIO:
+    """
+    Wraps a binary stream so it is transparently decompressed if it starts
+    with the gzip magic bytes.
+    """
+    if not hasattr(fh, "peek"):
+        fh = io.BufferedReader(fh)
+    if fh.peek(2)[:2] == GZIP_MAGIC:
+        return gzip.GzipFile(fileobj=fh, mode="rb")
+    return fh
+
+
+def streaming_json_available() -> bool:
+    """
+    Returns True if the optional `ijson` package used for incremental
+    JSON parsing is installed.
+    """
+    return importlib.util.find_spec("ijson") is not None
+
+
+def iter_json_events(fh: BinaryIO) -> Iterator[JsonEventT]:
+    """
+    Incrementally parses a binary JSON stream into `(event, value)` pairs
+    (`start_map`, `map_key`, `end_map`, `start_array`, `end_array`,
+    `string`, `number`, `boolean`, `null`). Requires the optional `ijson`
+    package.
+    """
+    import ijson
+
+    return ijson.basic_parse(fh, use_float=True)
+
+
+def read_json_value(events: Iterator[JsonEventT]) -> Any:
+    """
+    Consumes the events of the next JSON value and returns it as a
+    Python object.
+    """
+    event, value = next(events)
+    if event == "start_map":
+        root = {}
+    elif event == "start_array":
+        root = []
+    else:
+        return value
+
+    stack = [root]
+    keys = [None]
+    while len(stack) != 0:
+        event, value = next(events)
+        if event == "map_key":
+            keys[-1] = value
+            continue
+        if event in ("end_map", "end_array"):
+            stack.pop()
+            keys.pop()
+            continue
+
+        if event == "start_map":
+            item = {}
+        elif event == "start_array":
+            item = []
+        else:
+            item = value
+
+        curr = stack[-1]
+        if isinstance(curr, dict):
+            curr[keys[-1]] = item
+        else:
+            curr.append(item)
+
+        if event in ("start_map", "start_array"):
+            stack.append(item)
+            keys.append(None)
+    return root
+
+
+def skip_json_value(events: Iterator[JsonEventT]) -> None:
+    """
+    Consumes the events of the next JSON value without building it.
+    """
+    depth = 0
+    for event, _ in events:
+        if event in ("start_map", "start_array"):
+            depth += 1
+        elif event in ("end_map", "end_array"):
+            depth -= 1
+        if depth == 0 and event != "map_key":
+            return
@@ -16,10 +16,14 @@ class Logger(object):
     @classmethod
     def setup_root_logger(cls):
         """Sets up the root logger and should only be called once."""
-        for handle in Logger.RootLogger.handlers:
+        for handle in list(Logger.RootLogger.handlers):
             Logger.RootLogger.removeHandler(handle)
-            Logger.RootLogger.setLevel(level=Logger.LoggerLevel)
+        Logger.RootLogger.setLevel(level=Logger.LoggerLevel)
+        cls._add_root_handler()
 
+    @classmethod
+    def _add_root_handler(cls):
+        """Adds the stderr handler to the root logger, keeping its level."""
         handler = logging.StreamHandler(sys.stderr)
         formatter = logging.Formatter(Logger.LoggerFormat, datefmt="%Y%m%d %H:%M:%S")
         handler.setFormatter(formatter)
@@ -33,6 +37,10 @@ class Logger(object):
         provided, the logger will be a child of the root logger, otherwise, a
         new logger is created using the given ``stream``."""
         if not stream:
+            # The root handler is added on first use rather than at import;
+            # the level is left to the caller or `setup_root_logger`
+            if not Logger.RootLogger.handlers:
+                cls._add_root_handler()
             logger = Logger.RootLogger.getChild(name)
         else:
             logger = logging.getLogger(name)
@@ -41,6 +49,3 @@ class Logger(object):
             handler.setFormatter(formatter)
             logger.addHandler(handler)
         return logger
-
-
-Logger.setup_root_logger()
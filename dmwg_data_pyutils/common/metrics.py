@@ -0,0 +1,182 @@
+"""Per-stage run metrics and profiling for subcommands.
+
+@author: Kyle Hernandez <kmhernan@uchicago.edu>
+"""
+import io
+import os
+import sys
+import json
+import time
+import cProfile
+from contextlib import contextmanager
+from typing import Dict, Any, Optional, Iterator
+
+try:
+    import resource
+except ImportError:  # pragma: no cover - not available on Windows
+    resource = None
+
+# Number of functions kept from each stage's cProfile output
+PROFILE_LINES = 30
+
+
+class StageMetrics:
+    """
+    Metrics of one stage. `records` can be set by the caller while the
+    stage runs to get a records per second rate.
+    `process_peak_rss_bytes` is the peak RSS of the process so far when the
+    stage ended, not of the stage alone: it only grows between stages.
+    """
+
+    __slots__ = (
+        "name",
+        "records",
+        "wall_s",
+        "cpu_s",
+        "children_cpu_s",
+        "process_peak_rss_bytes",
+        "bytes_read",
+        "bytes_written",
+        "profile",
+    )
+
+    def __init__(self, name: str):
+        self.name = name
+        self.records = None
+        self.wall_s = None
+        self.cpu_s = None
+        self.children_cpu_s = None
+        self.process_peak_rss_bytes = None
+        self.bytes_read = None
+        self.bytes_written = None
+        self.profile = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        dat = {k: getattr(self, k) for k in self.__slots__}
+        dat["records_per_s"] = None
+        if self.records is not None and self.wall_s:
+            dat["records_per_s"] = round(self.records / self.wall_s, 1)
+        return dat
+
+
+class Metrics:
+    """
+    Collects wall and CPU time (own and of waited-for child processes),
+    process peak RSS, bytes read and written and optionally a cProfile summary for
+    each stage of a run.
+    """
+
+    def __init__(self, profile: bool = False):
+        self.profile = profile
+        self.stages = []
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[StageMetrics]:
+        """Measures the enclosed block as a stage named `name`."""
+        curr = StageMetrics(name)
+        io_start = read_io_counters()
+        times_start = os.times()
+        wall_start = time.perf_counter()
+        profiler = None
+        if self.profile:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        try:
+            yield curr
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            curr.wall_s = round(time.perf_counter() - wall_start, 6)
+            times_end = os.times()
+            curr.cpu_s = round(
+                times_end.user
+                + times_end.system
+                - times_start.user
+                - times_start.system,
+                6,
+            )
+            curr.children_cpu_s = round(
+                times_end.children_user
+                + times_end.children_system
+                - times_start.children_user
+                - times_start.children_system,
+                6,
+            )
+            curr.process_peak_rss_bytes = peak_rss_bytes()
+            io_end = read_io_counters()
+            if io_start and io_end:
+                curr.bytes_read = io_end["rchar"] - io_start["rchar"]
+                curr.bytes_written = io_end["wchar"] - io_start["wchar"]
+            if profiler is not None:
+                curr.profile = format_profile(profiler)
+            self.stages.append(curr)
+
+    def report(self) -> Dict[str, Any]:
+        """Returns all metrics as a JSON serializable dict."""
+        return {
+            "wall_s": round(time.perf_counter() - self._start, 6),
+            "process_peak_rss_bytes": peak_rss_bytes(),
+            "children_peak_rss_bytes": peak_rss_bytes(children=True),
+            "stages": [i.to_dict() for i in self.stages],
+        }
+
+    def write(self, path: str) -> None:
+        """Writes the report as JSON."""
+        with open(path, "wt") as o:
+            json.dump(self.report(), o, indent=2)
+
+    def log(self, logger) -> None:
+        """Logs a one line summary per stage."""
+        for curr in self.stages:
+            dat = curr.to_dict()
+            msg = "Stage {}: wall {:.3f}s, cpu {:.3f}s".format(
+                curr.name, curr.wall_s, curr.cpu_s
+            )
+            if curr.children_cpu_s:
+                msg += ", workers cpu {:.3f}s".format(curr.children_cpu_s)
+            if curr.process_peak_rss_bytes is not None:
+                msg += ", process peak rss {:.1f} MB".format(
+                    curr.process_peak_rss_bytes / 1e6
+                )
+            if dat["records_per_s"] is not None:
+                msg += ", {} records/s".format(dat["records_per_s"])
+            logger.info(msg)
+            if curr.profile:
+                logger.info("Stage {} profile:\n{}".format(curr.name, curr.profile))
+
+
+def peak_rss_bytes(children: bool = False) -> Optional[int]:
+    """
+    Returns the peak resident set size of this process (or of its largest
+    waited-for child), None where `resource` is unavailable.
+    """
+    if resource is None:
+        return None
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    peak = resource.getrusage(who).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def read_io_counters() -> Optional[Dict[str, int]]:
+    """
+    Returns this process' `/proc/self/io` counters (`rchar`/`wchar` count
+    all bytes read and written, including sockets), None if unavailable.
+    """
+    try:
+        with open("/proc/self/io", "rt") as fh:
+            return {k: int(v) for k, v in (l.split(":") for l in fh)}
+    except (OSError, ValueError):
+        return None
+
+
+def format_profile(profiler: cProfile.Profile, lines: int = PROFILE_LINES) -> str:
+    """Returns the top functions by cumulative time of a profile."""
+    # pstats is only needed with --profile, so it isn't imported at startup
+    import pstats
+
+    out = io.StringIO()
+    stats = pstats.Stats(profiler, stream=out)
+    stats.sort_stats("cumulative").print_stats(lines)
+    return out.getvalue()
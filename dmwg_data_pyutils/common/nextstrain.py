@@ -2,17 +2,42 @@
 
 @author: Kyle Hernandez <kmhernan@uchicago.edu>
 """
+import sys
 import json
-import gzip
+import urllib.error
 import urllib.request
-from typing import List, Dict, Any, Optional, Union, Callable
+from array import array
+from typing import (
+    List,
+    Dict,
+    Any,
+    Optional,
+    Union,
+    Callable,
+    Iterable,
+    Iterator,
+    Tuple,
+    BinaryIO,
+    Set,
+)
 
 from dmwg_data_pyutils.common.logger import Logger
-from dmwg_data_pyutils.common.io import load_json_file
+from dmwg_data_pyutils.common.download import DownloadStream, DownloadCache
+from dmwg_data_pyutils.common.io import (
+    STDIO_PATH,
+    JsonEventT,
+    load_json_file,
+    open_maybe_gzip,
+    iter_json_events,
+    read_json_value,
+    skip_json_value,
+)
+from dmwg_data_pyutils.common.query import parse_query, evaluate_query, iter_intervals
+from dmwg_data_pyutils.common.writers import to_float
 
 
 NEXTSTRAIN_JSON_URL = "http://data.nextstrain.org/ncov_global.json"
-# TODO - infer from json metadata?
+# Default columns, see `NextStrainSchema.from_meta` to infer them instead
 NODE_ATTRS = [
     "country",
     "division",
@@ -25,6 +50,8 @@ NODE_ATTRS = [
     "recency",
     "num_date",
 ]
+# NODE_ATTRS holding numbers, typed as such in columnar outputs
+NUMERIC_ATTRS = ["age", "div", "num_date"]
 MUTATION_KEYS = [
     "E",
     "M",
@@ -42,27 +69,144 @@ MUTATION_KEYS = [
     "S",
     "nuc",
 ]
+# Auspice v2 node attributes stored as plain values instead of
+# `{"value": ...}` objects
+SCALAR_ATTRS = ["div"]
+# Colorings that are not node attributes (`gt` colors by genotype)
+NON_ATTR_COLORINGS = ["gt"]
 
 
-class NextStrainParser:
+class NextStrainSchema:
+    """
+    Columns of a tree: the node attributes to keep (`attr_keys`), the
+    attributes holding numbers (`numeric`) and the genes with mutation
+    columns (`genes`). Attributes in `scalar` are stored as plain values,
+    all others as auspice `{"value": ...}` objects.
     """
-    Caution, this implementation will actually *mutate* the JSON object
-    (`self.obj`). So my current usage in the subcommand.ParseNextStrain
-    to write out the json object to a file is dangerous. Once I use the
-    `mutation_traversal_generator` the object is modified.
 
-    Things to potentially do differently in future:
-    1. Make seprate class for loading the Nextstrain JSON.
-    2. Separate "traversal" classes from this, and only pass *copy* of json object.
+    def __init__(
+        self,
+        attr_keys: List[str],
+        numeric: List[str],
+        genes: List[str],
+        scalar: Optional[List[str]] = None,
+    ):
+        self.attr_keys = list(attr_keys)
+        self.numeric = list(numeric)
+        self.genes = list(genes)
+        self.scalar = list(SCALAR_ATTRS if scalar is None else scalar)
+
+    @classmethod
+    def default(cls) -> "NextStrainSchema":
+        """The hard-coded `NODE_ATTRS`/`NUMERIC_ATTRS`/`MUTATION_KEYS`."""
+        return cls(NODE_ATTRS, NUMERIC_ATTRS, MUTATION_KEYS)
+
+    @classmethod
+    def from_meta(cls, meta: Optional[Dict[str, Any]]) -> "NextStrainSchema":
+        """
+        Infers the schema from the `meta` of an auspice v2 JSON. The
+        attributes are the `colorings` keys, continuous colorings being
+        numeric, plus the standard `div` and `num_date` attributes. The genes
+        are the `genome_annotations` keys. Missing parts fall back to the
+        defaults.
+        """
+        meta = meta or {}
+        attr_keys = []
+        numeric = []
+        for coloring in meta.get("colorings") or []:
+            key = coloring.get("key")
+            if not key or key in NON_ATTR_COLORINGS or key in attr_keys:
+                continue
+            attr_keys.append(key)
+            if coloring.get("type") == "continuous":
+                numeric.append(key)
+        if not attr_keys:
+            attr_keys = list(NODE_ATTRS)
+            numeric = list(NUMERIC_ATTRS)
+        for key in ("div", "num_date"):
+            if key not in attr_keys:
+                attr_keys.append(key)
+            if key not in numeric:
+                numeric.append(key)
+        genes = sorted(meta.get("genome_annotations") or MUTATION_KEYS)
+        return cls(attr_keys, numeric, genes)
+
+    def project(self, attr_keys: List[str]) -> "NextStrainSchema":
+        """Returns the schema with only the attributes in `attr_keys`."""
+        return NextStrainSchema(
+            attr_keys,
+            [k for k in self.numeric if k in attr_keys],
+            self.genes,
+            self.scalar,
+        )
+
+    def compile_extractor(self) -> Callable[[Dict[str, Any]], List[Any]]:
+        """
+        Generates a function returning the `attr_keys` values of a node's
+        `node_attrs` as a list. Each attribute is unwrapped according to
+        its expected shape in straight-line code, so there is no per-value
+        type dispatch. Nodes that do not have the expected shapes fall back
+        to checking every value.
+        """
+        lines = ["def extract(node_attrs):", "    get = node_attrs.get"]
+        for i, k in enumerate(self.attr_keys):
+            lines.append("    v{} = get({!r})".format(i, k))
+            if k in self.scalar:
+                lines.append("    if v{0}.__class__ is dict:".format(i))
+            else:
+                lines.append("    if v{0} is not None:".format(i))
+            lines.append("        v{0} = v{0}['value']".format(i))
+        lines.append(
+            "    return [{}]".format(
+                ", ".join("v{}".format(i) for i in range(len(self.attr_keys)))
+            )
+        )
+        namespace = {}
+        exec("\n".join(lines), namespace)
+        fast = namespace["extract"]
+        keys = self.attr_keys
+
+        def extract(node_attrs: Dict[str, Any]) -> List[Any]:
+            try:
+                return fast(node_attrs)
+            except (TypeError, KeyError, IndexError):
+                values = []
+                for k in keys:
+                    value = node_attrs.get(k)
+                    if isinstance(value, dict):
+                        value = value["value"]
+                    values.append(value)
+                return values
+
+        return extract
+
+
+class NextStrainParser:
+    """
+    Traversals run over a `NextStrainTreeIndex` built once from the JSON
+    object, which is never modified. The legacy `_append_parents` and
+    `_flatten_nodes` helpers still *mutate* the JSON object (`self.obj`)
+    and are no longer used by `mutation_traversal_generator`.
     """
 
-    def __init__(self, obj: Dict[str, Any]):
+    def __init__(
+        self,
+        obj: Optional[Dict[str, Any]],
+        index: Optional["NextStrainTreeIndex"] = None,
+        infer_schema: bool = False,
+    ):
         """Initialize the NextStrainTree by passing the deserialized
-        JSON object.
+        JSON object, or only a prebuilt `NextStrainTreeIndex`. With
+        `infer_schema` the columns of the index are inferred from the JSON
+        `meta` instead of using the defaults.
         """
         self.logger = Logger.get_logger("NextStrainParser")
         self.obj = obj
-        assert "tree" in self.obj
+        self.infer_schema = infer_schema
+        self._index = index
+        self._mutation_index = None
+        if index is None:
+            assert "tree" in self.obj
 
     @property
     def root(self) -> Dict[str, Any]:
@@ -70,42 +214,533 @@ class NextStrainParser:
         return self.obj["tree"]
 
     @classmethod
-    def from_file_path(cls, file_path: str) -> object:
-        """Initialize from file path"""
+    def from_file_path(
+        cls,
+        file_path: str,
+        stream: bool = False,
+        infer_schema: bool = False,
+        index_cache: Optional["IndexCache"] = None,
+    ) -> object:
+        """
+        Initialize from file path, `-` reads stdin. Gzipped files are
+        detected automatically. If `stream` is True the file is parsed
+        incrementally into a `NextStrainTreeIndex` without building the
+        JSON object.
+
+        With an `index_cache` (see `dmwg_data_pyutils.common.index_cache`)
+        the index is loaded from the cache if the file was parsed before,
+        otherwise it is built and cached; the JSON object is not kept.
+        stdin can't be cached.
+        """
+        if file_path == STDIO_PATH:
+            assert index_cache is None, "stdin can't be cached"
+            return cls.from_handle(sys.stdin.buffer, stream, infer_schema)
+        if index_cache is not None:
+            digest = index_cache.file_digest(file_path)
+            index = index_cache.load(digest, infer_schema)
+            if index is None:
+                index = cls.from_file_path(file_path, stream, infer_schema).index
+                index_cache.store(digest, index, infer_schema)
+            return cls(None, index=index)
+        if stream:
+            with open(file_path, "rb") as fh:
+                return cls.from_handle(fh, stream, infer_schema)
         dat = load_json_file(file_path)
-        return cls(dat)
+        return cls(dat, infer_schema=infer_schema)
+
+    @classmethod
+    def from_handle(
+        cls, fh: BinaryIO, stream: bool = False, infer_schema: bool = False
+    ) -> object:
+        """
+        Initialize from an open binary handle such as stdin, which is read
+        to the end but not closed. Gzipped data is detected automatically.
+        `stream` is like in `from_file_path`.
+        """
+        if stream:
+            index = NextStrainTreeIndex.from_stream(fh, infer_schema=infer_schema)
+            return cls(None, index=index)
+        return cls(json.load(open_maybe_gzip(fh)), infer_schema=infer_schema)
 
     @classmethod
-    def from_url(cls, other_url: Optional[str] = None) -> object:
-        """Initialize from URL. By default uses NEXTSTRAIN_JSON_URL."""
+    def from_url(
+        cls,
+        other_url: Optional[str] = None,
+        stream: bool = False,
+        save_path: Optional[str] = None,
+        cache_dir: Optional[str] = None,
+        save_compressed: bool = True,
+        infer_schema: bool = False,
+        index_cache: Optional["IndexCache"] = None,
+    ) -> object:
+        """
+        Initialize from URL. By default uses NEXTSTRAIN_JSON_URL. The body
+        is downloaded in chunks on a background thread, gunzipped on the
+        fly and, if `save_path` is given, written there while it is parsed.
+        The saved file holds the bytes as received (gzip stays gzip) unless
+        `save_compressed` is False.
+        If `stream` is True the JSON is parsed incrementally into a
+        `NextStrainTreeIndex` without building the JSON object.
+
+        If `cache_dir` is given the download is kept in a `DownloadCache`
+        instead of `save_path` and revalidated with a conditional GET, so
+        the cached copy is reused when the server answers 304.
+
+        With an `index_cache` the index of a saved download is cached under
+        the digest of the saved bytes (see `from_file_path`).
+        """
         _url = NEXTSTRAIN_JSON_URL if other_url is None else other_url
-        dat = None
-        with urllib.request.urlopen(_url) as f:
-            # want to check if this is gzip, so check for magic.
-            # right now it is gzipped.
-            _obj = f.read()
-            if _obj[:2] == b"\x1f\x8b":
-                dat = json.loads(gzip.decompress(_obj))
-            else:
-                dat = json.loads(_obj)
-        return cls(dat)
+        logger = Logger.get_logger("NextStrainParser")
+        cache = None
+        headers = {}
+        if cache_dir is not None:
+            assert save_path is None, "Use either save_path or cache_dir"
+            cache = DownloadCache(cache_dir)
+            save_path = cache.path_for(_url)
+            headers = cache.conditional_headers(_url)
+
+        request = urllib.request.Request(_url, headers=headers)
+        try:
+            response = urllib.request.urlopen(request)
+        except urllib.error.HTTPError as e:
+            if cache is None or e.code != 304:
+                raise
+            e.close()
+            logger.info("Not modified, using cached {}".format(save_path))
+            return cls.from_file_path(
+                save_path,
+                stream=stream,
+                infer_schema=infer_schema,
+                index_cache=index_cache,
+            )
+
+        res = None
+        with response as f:
+            with DownloadStream(
+                f, save_path=save_path, save_compressed=save_compressed
+            ) as fh:
+                if stream:
+                    index = NextStrainTreeIndex.from_events(
+                        iter_json_events(fh), infer_schema=infer_schema
+                    )
+                    res = cls(None, index=index)
+                else:
+                    res = cls(json.load(fh), infer_schema=infer_schema)
+            if cache is not None:
+                cache.store(_url, f.headers, fh.bytes_saved, fh.sha256)
+        if index_cache is not None and save_path:
+            index_cache.store(fh.sha256, res.index, infer_schema)
+        return res
 
-    def mutation_traversal_generator(self) -> Dict[str, Any]:
+    def mutation_traversal_generator(
+        self,
+        start: int = 0,
+        stop: Optional[int] = None,
+        node_filter: Optional["NodeFilter"] = None,
+        attr_keys: Optional[List[str]] = None,
+        genes: Optional[List[str]] = None,
+    ) -> Dict[str, Any]:
         """
         Public mutation traversal generator. Flattens into per-node
         records containing patient metadata and cumulative viral
         mutations.
+
+        The tree is walked top-down over the integer node ids of the
+        `NextStrainTreeIndex`, so each node inherits its parent's
+        accumulated mutations and only adds its own branch mutations.
+        Records are yielded in the same order as `_flatten_nodes` and the
+        JSON object is not modified.
+
+        `start` and `stop` select a slice of that order. The first node of
+        the slice inherits the mutations of its ancestors, so disjoint
+        slices can be generated independently and concatenated in order
+        to give the full output.
+
+        With a `node_filter` only the matching nodes are yielded. The
+        filter is evaluated on the node attributes before any mutation
+        work and subtrees without any match are skipped entirely.
+
+        `attr_keys` and `genes` project the records onto a subset of the
+        attributes and genes of the index's schema. Mutations of other genes are
+        never accumulated or decoded.
         """
-        self._append_parents()
-        for node in self._flatten_nodes():
-            dat = {"parent": node["parent"]["name"], "name": node["name"]}
-            dat.update(self.parse_attrs(node["node_attrs"], NODE_ATTRS))
-            mutations = self._collect_mutations(node)
-            dat.update(self.parse_attrs(mutations, MUTATION_KEYS))
+        index = self.index
+        order = index.order
+        stop = len(order) if stop is None else min(stop, len(order))
+        if start >= stop:
+            return
+
+        names = index.names
+        parents = index.parents
+        mutations = index.mutation_ids
+        duplicates = index.duplicates
+        ends = index.subtree_ends
+        attrs = [(k, index.attrs[k]) for k in self._attr_keys(attr_keys)]
+        genes, gene_set = self._genes(genes)
+        matched = keep = None
+        if node_filter is not None:
+            matched, keep = node_filter.masks(index)
+        # Root path of the current node as (id, cumulative mutations)
+        path = self._ancestor_mutations(order[start], gene_set)
+        resolved = {}
+        pos = start
+        while pos < stop:
+            idx = order[pos]
+            # Subtrees are contiguous in the (pre-)order
+            if keep is not None and not keep[idx]:
+                pos += ends[idx] - idx
+                continue
+            parent = parents[idx]
+            # The root's own branch mutations are not part of any genotype.
+            if parent < 0:
+                muts = {}
+                parent = idx
+            else:
+                while path[-1][0] != parent:
+                    path.pop()
+                muts = self._propagate_mutations(
+                    path[-1][1], mutations[idx], gene_set
+                )
+            path.append((idx, muts))
+
+            if pos in duplicates or (matched is not None and not matched[idx]):
+                pos += 1
+                continue
+            pos += 1
+            dat = {"parent": names[parent], "name": names[idx]}
+            for k, column in attrs:
+                dat[k] = column[idx]
+            dat.update(self._materialize_mutations(muts, genes, resolved))
             yield dat
 
+    def diff_traversal_generator(
+        self,
+        previous: "NextStrainTreeIndex",
+        attr_keys: Optional[List[str]] = None,
+        genes: Optional[List[str]] = None,
+    ) -> Dict[str, Any]:
+        """
+        Yields only the records that differ from an earlier snapshot of the
+        tree, with two extra fields:
+
+        * `change_type`: `added`, `changed` or `removed`.
+        * `previous_name`: name of the matching node in `previous`, which
+          differs from `name` when an internal node was renamed, `None` for
+          added nodes.
+
+        Nodes are matched with `NextStrainTreeIndex.match`. A matched node's
+        genotype is unchanged if its parent's is, its parent matched the
+        previous parent and its branch mutations are the same; otherwise it
+        is recomputed and reported as changed. Subtrees without any change
+        are skipped, so no genotypes are computed for them. Added and
+        changed records are yielded in document order, followed by the
+        removed nodes with their previous attributes and no mutations.
+        `attr_keys` and `genes` project the records like in
+        `mutation_traversal_generator`; changes are detected on all
+        attributes.
+        """
+        index = self.index
+        n = len(index)
+        names = index.names
+        parents = index.parents
+        mutations = index.mutation_ids
+        matched = index.match(previous)
+        compared = [k for k in index.schema.attr_keys if k in previous.attrs]
+        attr_keys = self._attr_keys(attr_keys)
+        attrs = [(k, index.attrs[k]) for k in attr_keys]
+        genes, gene_set = self._genes(genes)
+        new_dups = set(index.order[i] for i in index.duplicates)
+
+        same_genotype = bytearray(n)
+        changed = bytearray(n)
+        for idx in range(n):
+            old = matched[idx]
+            if old < 0:
+                changed[idx] = 1
+                continue
+            parent = parents[idx]
+            old_parent = previous.parents[old]
+            if parent < 0:
+                same = old_parent < 0
+            else:
+                same = (
+                    same_genotype[parent]
+                    and matched[parent] == old_parent
+                    and index.branch_signature(idx)
+                    == previous.branch_signature(old)
+                )
+            same_genotype[idx] = same
+            if (
+                not same
+                or names[idx] != previous.names[old]
+                or names[idx if parent < 0 else parent]
+                != previous.names[old if old_parent < 0 else old_parent]
+                or any(index.attrs[k][idx] != previous.attrs[k][old] for k in compared)
+            ):
+                changed[idx] = 1
+
+        # A subtree has to be walked if any of its nodes changed
+        dirty = bytearray(changed)
+        for idx in range(n - 1, 0, -1):
+            if dirty[idx]:
+                dirty[parents[idx]] = 1
+
+        ends = index.subtree_ends
+        path = []
+        resolved = {}
+        idx = 0
+        while idx < n:
+            if not dirty[idx]:
+                idx = ends[idx]
+                continue
+            parent = parents[idx]
+            if parent < 0:
+                muts = {}
+                parent = idx
+            else:
+                while path[-1][0] != parent:
+                    path.pop()
+                muts = self._propagate_mutations(
+                    path[-1][1], mutations[idx], gene_set
+                )
+            path.append((idx, muts))
+
+            if changed[idx] and idx not in new_dups:
+                old = matched[idx]
+                dat = {
+                    "change_type": "added" if old < 0 else "changed",
+                    "previous_name": None if old < 0 else previous.names[old],
+                    "parent": names[parent],
+                    "name": names[idx],
+                }
+                for k, column in attrs:
+                    dat[k] = column[idx]
+                dat.update(self._materialize_mutations(muts, genes, resolved))
+                yield dat
+            idx += 1
+
+        used = bytearray(len(previous))
+        for old in matched:
+            if old >= 0:
+                used[old] = 1
+        old_dups = set(previous.order[i] for i in previous.duplicates)
+        for old in range(len(previous)):
+            if used[old] or old in old_dups:
+                continue
+            old_parent = previous.parents[old]
+            dat = {
+                "change_type": "removed",
+                "previous_name": previous.names[old],
+                "parent": previous.names[old if old_parent < 0 else old_parent],
+                "name": previous.names[old],
+            }
+            for k in attr_keys:
+                column = previous.attrs.get(k)
+                dat[k] = None if column is None else column[old]
+            dat.update(dict.fromkeys(genes))
+            yield dat
+
+    def branch_mutation_generator(
+        self, genes: Optional[List[str]] = None
+    ) -> Iterator[Dict[str, str]]:
+        """
+        Yields a `name`, `gene`, `mutation` record for each of the nodes'
+        own branch mutations, in the order of `mutation_traversal_generator`
+        and sorted and unique within a gene. Like the cumulative mutations,
+        the root's branch mutations and nodes with a duplicated name are
+        left out, so the union of a node's and its ancestors' records gives
+        its cumulative mutations. `genes` projects the genes of the index's
+        schema.
+        """
+        index = self.index
+        names = index.names
+        parents = index.parents
+        mutations = index.mutation_ids
+        duplicates = index.duplicates
+        strings = index.vocabulary.strings
+        genes, _ = self._genes(genes)
+        for pos, idx in enumerate(index.order):
+            delta = mutations[idx]
+            if not delta or parents[idx] < 0 or pos in duplicates:
+                continue
+            name = names[idx]
+            for gene in genes:
+                ids = delta.get(gene)
+                if ids:
+                    for i in sorted(set(ids)):
+                        yield {
+                            "name": name,
+                            "gene": gene,
+                            "mutation": strings[gene][i],
+                        }
+
+    def tip_mutation_generator(
+        self, genes: Optional[List[str]] = None
+    ) -> Iterator[Dict[str, str]]:
+        """
+        Yields a `name`, `gene`, `mutation` record for each cumulative
+        mutation of each tip, i.e. `mutation_traversal_generator` of the
+        tips in long format.
+        """
+        genes, _ = self._genes(genes)
+        for record in self.mutation_traversal_generator(
+            node_filter=NodeFilter(tips_only=True), attr_keys=[], genes=genes
+        ):
+            name = record["name"]
+            for gene in genes:
+                for mutation in record[gene] or ():
+                    yield {"name": name, "gene": gene, "mutation": mutation}
+
+    def _ancestor_mutations(
+        self, idx: int, genes: Optional[Set[str]] = None
+    ) -> List[Tuple[int, Dict[str, "MutationGenotype"]]]:
+        """
+        Returns the ancestors of a node from the root down, each with its
+        cumulative mutations.
+        """
+        index = self.index
+        ancestors = []
+        parent = index.parents[idx]
+        while parent >= 0:
+            ancestors.append(parent)
+            parent = index.parents[parent]
+
+        path = []
+        muts = {}
+        for anc in reversed(ancestors):
+            if index.parents[anc] >= 0:
+                muts = self._propagate_mutations(muts, index.mutation_ids[anc], genes)
+            path.append((anc, muts))
+        return path
+
+    @property
+    def index(self) -> "NextStrainTreeIndex":
+        """Integer index of the tree, built on first use."""
+        if self._index is None:
+            self._index = NextStrainTreeIndex.from_obj(
+                self.obj, infer_schema=self.infer_schema
+            )
+        return self._index
+
+    @property
+    def mutation_index(self) -> "MutationIntervalIndex":
+        """Inverted mutation index of the tree, built on first use."""
+        if self._mutation_index is None:
+            self._mutation_index = MutationIntervalIndex(self.index)
+        return self._mutation_index
+
+    def query(
+        self, query: Optional[str] = None, node_filter: Optional["NodeFilter"] = None
+    ) -> Iterator[int]:
+        """
+        Yields the ids of the nodes matching a mutation `query` (see
+        `dmwg_data_pyutils.common.query`) and `node_filter` in pre-order.
+        Without a query all nodes match. Like the record traversal, nodes
+        whose name was already seen in the traversal `order` (see
+        `NextStrainTreeIndex.duplicates`) are never reported.
+        """
+        index = self.index
+        intervals = array("l", [0, len(index)])
+        if query is not None:
+            intervals = evaluate_query(
+                parse_query(query), self.mutation_index.lookup, len(index)
+            )
+        duplicates = set(index.order[i] for i in index.duplicates)
+        for idx in iter_intervals(intervals):
+            if idx in duplicates:
+                continue
+            if node_filter is not None and not node_filter.matches(index, idx):
+                continue
+            yield idx
+
+    def release_json(self) -> None:
+        """
+        Builds the index and drops the reference to the deserialized JSON
+        object so it can be garbage collected. Only index based methods
+        can be used afterwards.
+        """
+        self.index
+        self.obj = None
+
+    def _propagate_mutations(
+        self,
+        inherited: Dict[str, "MutationGenotype"],
+        delta: Optional[Dict[str, Tuple[int, ...]]],
+        genes: Optional[Set[str]] = None,
+    ) -> Dict[str, "MutationGenotype"]:
+        """
+        Adds the interned branch mutation ids `delta` of a node to the
+        cumulative genotypes inherited from its parent, only for `genes` if
+        given. The inherited dict is never modified; genes without new
+        mutations share the parent's genotype and a node without any new
+        mutations shares the parent's dict.
+        """
+        if not delta:
+            return inherited
+        muts = None
+        for k, v in delta.items():
+            if genes is not None and k not in genes:
+                continue
+            parent = inherited.get(k)
+            genotype = MutationGenotype.extend(parent, v)
+            if genotype is not parent:
+                if muts is None:
+                    muts = dict(inherited)
+                muts[k] = genotype
+        return inherited if muts is None else muts
+
+    def _attr_keys(self, attr_keys: Optional[List[str]]) -> List[str]:
+        """Validates a projection of the schema's attributes, all if None."""
+        known = self.index.schema.attr_keys
+        if attr_keys is None:
+            return known
+        unknown = [k for k in attr_keys if k not in known]
+        assert not unknown, "Unknown attributes: {}".format(", ".join(unknown))
+        return attr_keys
+
+    def _genes(
+        self, genes: Optional[List[str]]
+    ) -> Tuple[List[str], Optional[Set[str]]]:
+        """
+        Validates a projection of the schema's genes and returns it with
+        the set of genes to accumulate, None to accumulate all.
+        """
+        known = self.index.schema.genes
+        if genes is None:
+            return known, None
+        unknown = [k for k in genes if k not in known]
+        assert not unknown, "Unknown genes: {}".format(", ".join(unknown))
+        return genes, set(genes)
+
+    def _materialize_mutations(
+        self,
+        muts: Dict[str, "MutationGenotype"],
+        key_list: List[str],
+        resolved: Optional[Dict[str, Tuple["MutationGenotype", List[int]]]] = None,
+    ) -> Dict[str, Optional[List[str]]]:
+        """
+        Decodes the sorted, unique per-gene mutation lists for the genes in
+        key_list. Genes not in key_list are never decoded. A traversal can
+        pass a `resolved` dict, which keeps the last resolved genotype of
+        each gene with its ids, so the next one only resolves the links
+        below it.
+        """
+        vocab = self.index.vocabulary
+        curr = dict.fromkeys(key_list)
+        for k, genotype in muts.items():
+            if k in curr:
+                if resolved is None:
+                    curr[k] = vocab.decode(k, genotype.resolve())
+                    continue
+                last = resolved.get(k)
+                if last is None or last[0] is not genotype:
+                    last = resolved[k] = (genotype, genotype.resolve(last))
+                curr[k] = vocab.decode(k, last[1])
+        return curr
+
     def _append_parents(self) -> None:
         """
+        Legacy helper superseded by `NextStrainTreeIndex`.
         Traverses the tree and adds in the parents. This *mutates*
         the object! This is adapted from Trevor Bradford and Richard Neher's
         javascript work in auspice (https://github.com/nextstrain/auspice).
@@ -121,6 +756,7 @@ class NextStrainParser:
 
     def _flatten_nodes(self) -> List[Dict[str, Any]]:
         """
+        Legacy helper superseded by `NextStrainTreeIndex`.
         Traverses the tree and returns a list of ordered nodes. 
         This is adapted from Trevor Bradford and Richard Neher's
         javascript work in auspice (https://github.com/nextstrain/auspice).
@@ -165,7 +801,9 @@ class NextStrainParser:
     ) -> Dict[str, List[str]]:
         """
         Traverses all the way back to root from current node, collecting
-        mutations.
+        mutations. Requires `_append_parents` to have been run. This is
+        O(depth) per node; `mutation_traversal_generator` uses the top-down
+        `_propagate_mutations` instead.
         """
         if muts is None:
             muts = []
@@ -190,3 +828,683 @@ class NextStrainParser:
         for k in dic:
             dic[k] = sorted(list(set(dic[k])))
         return dic
+
+
+class MutationVocabulary:
+    """
+    Interns the distinct mutations of each gene of a tree to integer ids.
+    Ids are assigned in sorted string order, so ascending ids decode to
+    sorted mutation strings.
+
+    * `strings`: per gene, the mutation string of each id.
+    """
+
+    def __init__(self, strings: Dict[str, List[str]]):
+        self.strings = strings
+        self._ids = {k: {m: i for i, m in enumerate(v)} for k, v in strings.items()}
+
+    @classmethod
+    def from_mutations(
+        cls, mutations: Iterable[Optional[Dict[str, Tuple[str, ...]]]]
+    ) -> "MutationVocabulary":
+        """Builds the vocabulary from per-node branch mutations."""
+        genes = {}
+        for muts in mutations:
+            if muts:
+                for k, v in muts.items():
+                    genes.setdefault(k, set()).update(v)
+        return cls({k: sorted(v) for k, v in genes.items()})
+
+    def __len__(self) -> int:
+        return sum(len(v) for v in self.strings.values())
+
+    def encode(self, gene: str, mutations: Iterable[str]) -> Tuple[int, ...]:
+        """Returns the ids of mutations of a gene."""
+        return tuple(map(self._ids[gene].__getitem__, mutations))
+
+    def decode(self, gene: str, ids: Iterable[int]) -> List[str]:
+        """Returns the mutation strings of ids of a gene."""
+        return list(map(self.strings[gene].__getitem__, ids))
+
+
+class MutationGenotype:
+    """
+    Cumulative mutations of a single gene as a chain of links, each holding
+    the `MutationVocabulary` ids `added` on the branch and pointing at the
+    genotype of the nearest ancestor that gained mutations in the same gene.
+    Descendants that add nothing to the gene share their parent's genotype.
+
+    Only the branch ids are kept on the links, so a path of genotypes costs
+    memory in the number of mutations rather than in the depth times the
+    genotype size. A genotype is resolved when a record is emitted: the
+    ids of the chain are united and sorted as ids, which are only decoded
+    to strings at the end. Resolving can start from an already resolved
+    ancestor.
+    """
+
+    __slots__ = ("added", "parent")
+
+    def __init__(
+        self, added: Tuple[int, ...], parent: Optional["MutationGenotype"] = None
+    ):
+        self.added = added
+        self.parent = parent
+
+    @classmethod
+    def extend(
+        cls, parent: Optional["MutationGenotype"], ids: Iterable[int]
+    ) -> "MutationGenotype":
+        """
+        Returns the genotype of `parent` plus the mutation `ids`, which is
+        `parent` itself if there are no ids.
+        """
+        added = tuple(ids)
+        if parent is not None and not added:
+            return parent
+        return cls(added, parent)
+
+    def resolve(
+        self, base: Optional[Tuple["MutationGenotype", List[int]]] = None
+    ) -> List[int]:
+        """
+        Returns the sorted unique mutation ids. If `base` is an ancestor
+        genotype with its resolved ids, only the links below it are walked.
+        The returned list may be the one of `base` and must not be modified.
+        """
+        stop, ids = (None, []) if base is None else base
+        added = []
+        link = self
+        while link is not None and link is not stop:
+            added.extend(link.added)
+            link = link.parent
+        if link is None:
+            # Not below `base`, resolved from the whole chain
+            return sorted(set(added))
+        new = set(added).difference(ids)
+        if not new:
+            return ids
+        # Merging two sorted runs is linear
+        return sorted(ids + sorted(new))
+
+
+class NextStrainTreeIndex:
+    """
+    Compact, read-only index of a NextStrain tree. Nodes are numbered in
+    document (pre-)order, so the root is always `0`, and all traversals run
+    over integer ids:
+
+    * `names`: interned node names.
+    * `parents`: parent id of each node, `-1` for the root.
+    * `child_offsets`/`child_ids`: children of node `i` are
+      `child_ids[child_offsets[i]:child_offsets[i + 1]]`.
+    * `attrs`: one column per node attribute holding the parsed values.
+    * `schema`: the `NextStrainSchema` of the columns.
+    * `mutations`: the branch mutations of each node, `None` if there are
+      none.
+    * `vocabulary`/`mutation_ids`: the mutations interned to integer ids
+      (see `MutationVocabulary`), built on first use.
+
+    The JSON object used to build the index is not modified and can be
+    released afterwards.
+    """
+
+    def __init__(
+        self,
+        names: List[str],
+        parents: array,
+        attrs: Dict[str, List[Any]],
+        mutations: List[Optional[Dict[str, Tuple[str, ...]]]],
+        schema: Optional[NextStrainSchema] = None,
+    ):
+        self.names = names
+        self.parents = parents
+        self.attrs = attrs
+        self.mutations = mutations
+        if schema is None:
+            schema = NextStrainSchema.default().project(list(attrs))
+        self.schema = schema
+        self.child_offsets, self.child_ids = self._build_children(parents)
+        self._order = None
+        self._duplicates = None
+        self._vocabulary = None
+        self._mutation_ids = None
+        self._subtree_ends = None
+
+    @classmethod
+    def from_obj(
+        cls,
+        obj: Dict[str, Any],
+        attr_keys: Optional[List[str]] = None,
+        infer_schema: bool = False,
+    ) -> "NextStrainTreeIndex":
+        """
+        Builds the index from the deserialized JSON object, keeping only the
+        node attributes in `attr_keys` (by default all of the schema's). The
+        schema is inferred from the JSON `meta` if `infer_schema` is True,
+        otherwise the defaults are used.
+        """
+        schema = None
+        if infer_schema:
+            schema = NextStrainSchema.from_meta(obj.get("meta"))
+        builder = NextStrainTreeIndexBuilder(attr_keys, schema)
+        stack = [(obj["tree"], -1)]
+        while len(stack) != 0:
+            node, parent = stack.pop()
+            idx = builder.add_node(
+                parent,
+                node["name"],
+                node.get("node_attrs"),
+                node.get("branch_attrs", {}).get("mutations"),
+            )
+            children = node.get("children")
+            if children:
+                for child in reversed(children):
+                    stack.append((child, idx))
+        return builder.build()
+
+    @classmethod
+    def from_stream(
+        cls,
+        fh: BinaryIO,
+        attr_keys: Optional[List[str]] = None,
+        infer_schema: bool = False,
+    ) -> "NextStrainTreeIndex":
+        """
+        Incrementally parses a (optionally gzipped) binary JSON stream into
+        the index. Only the names, the node attributes in `attr_keys` and
+        the branch mutations are kept; all other fields (and `meta`, unless
+        `infer_schema` is True) are skipped without being deserialized.
+        Requires the optional `ijson` package.
+        """
+        return cls.from_events(
+            iter_json_events(open_maybe_gzip(fh)), attr_keys, infer_schema
+        )
+
+    @classmethod
+    def from_events(
+        cls,
+        events: Iterator[JsonEventT],
+        attr_keys: Optional[List[str]] = None,
+        infer_schema: bool = False,
+    ) -> "NextStrainTreeIndex":
+        """
+        Builds the index from `(event, value)` JSON parse events as produced
+        by `iter_json_events`. With `infer_schema` the schema is inferred
+        from `meta`; otherwise the defaults are used. A `meta` after `tree`
+        can only select from the attributes read with the default schema,
+        so the attributes it adds are left empty with a warning.
+        """
+        builder = NextStrainTreeIndexBuilder(attr_keys)
+        events = iter(events)
+        event, _ = next(events)
+        assert event == "start_map"
+        found = False
+        for event, value in events:
+            if event == "end_map":
+                break
+            if value == "tree":
+                cls._read_tree_events(events, builder)
+                found = True
+            elif value == "meta" and infer_schema:
+                schema = NextStrainSchema.from_meta(read_json_value(events))
+                if attr_keys is not None:
+                    schema = schema.project(attr_keys)
+                if not found:
+                    builder.set_schema(schema)
+                    continue
+                missing = builder.project(schema)
+                if missing:
+                    logger = Logger.get_logger("NextStrainTreeIndex")
+                    logger.warning(
+                        "'meta' comes after 'tree', attributes {} were not "
+                        "read".format(", ".join(missing))
+                    )
+            else:
+                skip_json_value(events)
+        assert found, "Missing 'tree' in NextStrain JSON"
+        return builder.build()
+
+    @staticmethod
+    def _read_tree_events(
+        events: Iterator[JsonEventT], builder: "NextStrainTreeIndexBuilder"
+    ) -> None:
+        """
+        Consumes the events of the `tree` value. Nodes are tracked on an
+        explicit stack of `[id, in_children]` frames so deep trees do not
+        recurse.
+        """
+        wanted = set(builder.attr_keys)
+        event, _ = next(events)
+        assert event == "start_map"
+        stack = [[builder.reserve(-1), False]]
+        while len(stack) != 0:
+            event, value = next(events)
+            frame = stack[-1]
+            if frame[1]:
+                if event == "start_map":
+                    stack.append([builder.reserve(frame[0]), False])
+                    continue
+                if event == "end_array":
+                    frame[1] = False
+                    continue
+
+            if event == "end_map":
+                stack.pop()
+            elif value == "name":
+                builder.set_name(frame[0], read_json_value(events))
+            elif value == "node_attrs":
+                attrs = {}
+                event, _ = next(events)
+                if event == "start_map":
+                    for event, key in events:
+                        if event == "end_map":
+                            break
+                        if key in wanted:
+                            attrs[key] = read_json_value(events)
+                        else:
+                            skip_json_value(events)
+                builder.set_attrs(frame[0], attrs)
+            elif value == "branch_attrs":
+                event, _ = next(events)
+                if event == "start_map":
+                    for event, key in events:
+                        if event == "end_map":
+                            break
+                        if key == "mutations":
+                            builder.set_mutations(frame[0], read_json_value(events))
+                        else:
+                            skip_json_value(events)
+            elif value == "children":
+                event, _ = next(events)
+                frame[1] = event == "start_array"
+            else:
+                skip_json_value(events)
+
+    @staticmethod
+    def _build_children(parents: array) -> Tuple[array, array]:
+        """Builds the child offset and child id arrays from the parents."""
+        n = len(parents)
+        offsets = array("l", [0]) * (n + 1)
+        for parent in parents:
+            if parent >= 0:
+                offsets[parent + 1] += 1
+        for i in range(n):
+            offsets[i + 1] += offsets[i]
+        fill = array("l", offsets)
+        child_ids = array("l", [0]) * offsets[n]
+        for idx, parent in enumerate(parents):
+            if parent >= 0:
+                child_ids[fill[parent]] = idx
+                fill[parent] += 1
+        return offsets, child_ids
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def children_of(self, idx: int) -> array:
+        """Returns the child ids of a node in document order."""
+        return self.child_ids[self.child_offsets[idx] : self.child_offsets[idx + 1]]
+
+    def branch_signature(self, idx: int) -> Tuple[Tuple[str, Tuple[str, ...]], ...]:
+        """
+        Returns the branch mutations of a node in a canonical form, so they
+        can be compared across trees.
+        """
+        muts = self.mutations[idx]
+        if not muts:
+            return ()
+        return tuple(sorted((k, tuple(sorted(set(v)))) for k, v in muts.items() if v))
+
+    def match(self, previous: "NextStrainTreeIndex") -> array:
+        """
+        Matches the nodes of this tree to the nodes of an earlier snapshot
+        and returns the id of the matching `previous` node of each node, or
+        `-1`. Nodes are matched by name first. The remaining nodes (e.g.
+        renumbered internal nodes) are matched top-down to an unmatched
+        child of their parent's match with the same branch mutations. Each
+        previous node is matched at most once; only the first node of
+        duplicated names is matched by name.
+        """
+        n = len(self)
+        matched = array("l", [-1]) * n
+        used = bytearray(len(previous))
+
+        old_dups = set(previous.order[i] for i in previous.duplicates)
+        old_by_name = {}
+        for old, name in enumerate(previous.names):
+            if old not in old_dups:
+                old_by_name.setdefault(name, old)
+        new_dups = set(self.order[i] for i in self.duplicates)
+        for idx, name in enumerate(self.names):
+            old = old_by_name.get(name)
+            if old is not None and idx not in new_dups:
+                matched[idx] = old
+                used[old] = 1
+
+        # Unmatched children of each previous node, by branch signature
+        candidates = {}
+        for idx in range(n):
+            if matched[idx] >= 0:
+                continue
+            parent = self.parents[idx]
+            if parent < 0:
+                if len(previous) and not used[0]:
+                    matched[idx] = 0
+                    used[0] = 1
+                continue
+            old_parent = matched[parent]
+            if old_parent < 0:
+                continue
+            if old_parent not in candidates:
+                children = {}
+                for old in previous.children_of(old_parent):
+                    if not used[old]:
+                        key = previous.branch_signature(old)
+                        children.setdefault(key, []).append(old)
+                candidates[old_parent] = children
+            for old in candidates[old_parent].get(self.branch_signature(idx), []):
+                if not used[old]:
+                    matched[idx] = old
+                    used[old] = 1
+                    break
+        return matched
+
+    def node(self, idx: int) -> "NextStrainNode":
+        """Returns a lightweight view of a node."""
+        return NextStrainNode(self, idx)
+
+    def traversal_order(self) -> Iterator[int]:
+        """
+        Yields node ids in the legacy `_flatten_nodes` order (a pre-order
+        traversal visiting the last child first).
+        """
+        stack = [0]
+        while len(stack) != 0:
+            idx = stack.pop()
+            yield idx
+            stack.extend(self.children_of(idx))
+
+    @property
+    def order(self) -> array:
+        """Node ids in `traversal_order`, computed once."""
+        if self._order is None:
+            self._order = array("l", self.traversal_order())
+        return self._order
+
+    @property
+    def duplicates(self) -> Set[int]:
+        """
+        Positions in `order` of nodes whose name was already seen earlier in
+        the traversal. These are skipped when emitting records, like the
+        legacy `_flatten_nodes` did.
+        """
+        if self._duplicates is None:
+            seen = set()
+            duplicates = set()
+            for pos, idx in enumerate(self.order):
+                name = self.names[idx]
+                if name in seen:
+                    duplicates.add(pos)
+                seen.add(name)
+            self._duplicates = duplicates
+        return self._duplicates
+
+    @property
+    def subtree_ends(self) -> array:
+        """
+        End (exclusive) of the subtree of each node. Ids are in pre-order,
+        so the subtree of node `i` is exactly the ids
+        `range(i, subtree_ends[i])`.
+        """
+        if self._subtree_ends is None:
+            sizes = array("l", [1]) * len(self.parents)
+            for idx in range(len(self.parents) - 1, 0, -1):
+                sizes[self.parents[idx]] += sizes[idx]
+            self._subtree_ends = array("l", (i + n for i, n in enumerate(sizes)))
+        return self._subtree_ends
+
+    @property
+    def vocabulary(self) -> MutationVocabulary:
+        """The interned mutations of the tree, computed once."""
+        if self._vocabulary is None:
+            self._vocabulary = MutationVocabulary.from_mutations(self.mutations)
+        return self._vocabulary
+
+    @property
+    def mutation_ids(self) -> List[Optional[Dict[str, Tuple[int, ...]]]]:
+        """The branch mutations of each node as `vocabulary` ids."""
+        if self._mutation_ids is None:
+            vocab = self.vocabulary
+            self._mutation_ids = [
+                None
+                if muts is None
+                else {k: vocab.encode(k, v) for k, v in muts.items()}
+                for muts in self.mutations
+            ]
+        return self._mutation_ids
+
+
+class MutationIntervalIndex:
+    """
+    Inverted index from each mutation to the nodes carrying it. A node
+    carries every mutation on the branches from the root down to it, so
+    the carriers of a mutation are the subtrees of the nodes whose branch
+    gained it. These are stored as pre-order id intervals (see
+    `dmwg_data_pyutils.common.query`), dropping subtrees nested in an
+    earlier one, so the index is no larger than the branch mutations.
+    """
+
+    def __init__(self, tree: NextStrainTreeIndex):
+        self.tree = tree
+        self.intervals = {k: {} for k in tree.vocabulary.strings}
+        ends = tree.subtree_ends
+        for idx, muts in enumerate(tree.mutation_ids):
+            # The root's own branch mutations are not part of any genotype.
+            if muts is None or tree.parents[idx] < 0:
+                continue
+            for k, ids in muts.items():
+                gene = self.intervals[k]
+                for i in ids:
+                    curr = gene.get(i)
+                    if curr is None:
+                        curr = gene[i] = array("l")
+                    if not curr or idx >= curr[-1]:
+                        curr.append(idx)
+                        curr.append(ends[idx])
+
+    def lookup(self, gene: str, mutation: str) -> array:
+        """
+        Returns the intervals of the nodes carrying a mutation, empty if
+        the mutation does not occur in the tree.
+        """
+        vocab = self.tree.vocabulary
+        try:
+            (i,) = vocab.encode(gene, [mutation])
+        except KeyError:
+            return array("l")
+        return self.intervals[gene][i]
+
+
+class NodeFilter:
+    """
+    Predicates on the parsed node attributes of a `NextStrainTreeIndex`,
+    all of which have to hold:
+
+    * `tips_only`: only tips (sampled sequences) match.
+    * `where`: maps attributes to their accepted values, compared as
+      strings (`NA` for missing values).
+    * `num_date_range`: inclusive `(min, max)` of `num_date`; nodes
+      without a date never match.
+    """
+
+    def __init__(
+        self,
+        tips_only: bool = False,
+        where: Optional[Dict[str, List[str]]] = None,
+        num_date_range: Optional[Tuple[float, float]] = None,
+    ):
+        self.tips_only = tips_only
+        self.where = {
+            k: set(str(v) for v in values) for k, values in (where or {}).items()
+        }
+        self.num_date_range = num_date_range
+        self._masks = None
+
+    def matches(self, index: NextStrainTreeIndex, idx: int) -> bool:
+        """Returns whether a single node matches."""
+        offsets = index.child_offsets
+        if self.tips_only and offsets[idx] != offsets[idx + 1]:
+            return False
+        for k, values in self.where.items():
+            value = index.attrs[k][idx]
+            if ("NA" if value is None else str(value)) not in values:
+                return False
+        if self.num_date_range is not None:
+            value = to_float(index.attrs["num_date"][idx])
+            low, high = self.num_date_range
+            if value is None or not low <= value <= high:
+                return False
+        return True
+
+    def masks(self, index: NextStrainTreeIndex) -> Tuple[bytearray, bytearray]:
+        """
+        Returns the nodes that match and the nodes whose subtree contains a
+        match, as flags by node id. Computed once per index.
+        """
+        if self._masks is None or self._masks[0] is not index:
+            matched = bytearray(self.matches(index, i) for i in range(len(index)))
+            keep = bytearray(matched)
+            parents = index.parents
+            for idx in range(len(index) - 1, 0, -1):
+                if keep[idx]:
+                    keep[parents[idx]] = 1
+            self._masks = (index, matched, keep)
+        return self._masks[1], self._masks[2]
+
+
+class NextStrainTreeIndexBuilder:
+    """
+    Accumulates nodes in document pre-order and builds a
+    `NextStrainTreeIndex`. Node attributes are parsed with the `schema`'s
+    compiled extractor and only the keys in `attr_keys` (by default all of
+    the schema's) are kept; names and mutations are interned.
+    """
+
+    def __init__(
+        self,
+        attr_keys: Optional[List[str]] = None,
+        schema: Optional[NextStrainSchema] = None,
+    ):
+        self.set_schema(NextStrainSchema.default() if schema is None else schema)
+        if attr_keys is not None:
+            self.set_schema(self.schema.project(attr_keys))
+
+    def set_schema(self, schema: NextStrainSchema) -> None:
+        """Sets the schema; only possible before any node was added."""
+        self.schema = schema
+        self.attr_keys = schema.attr_keys
+        self._extract = schema.compile_extractor()
+        self._missing = [None] * len(self.attr_keys)
+        self.names = []
+        self.parents = array("l")
+        self.attrs = {k: [] for k in self.attr_keys}
+        self._columns = [self.attrs[k] for k in self.attr_keys]
+        self.mutations = []
+
+    def project(self, schema: NextStrainSchema) -> List[str]:
+        """
+        Switches to `schema` after the nodes were added, keeping the columns
+        of its attributes. Returns the attributes that were not read, whose
+        columns are left empty.
+        """
+        n = len(self.names)
+        missing = [k for k in schema.attr_keys if k not in self.attrs]
+        self.schema = schema
+        self.attr_keys = schema.attr_keys
+        self.attrs = {k: self.attrs.get(k) or [None] * n for k in self.attr_keys}
+        self._columns = [self.attrs[k] for k in self.attr_keys]
+        return missing
+
+    def add_node(
+        self,
+        parent: int,
+        name: str,
+        node_attrs: Optional[Dict[str, Any]],
+        mutations: Optional[Dict[str, List[str]]],
+    ) -> int:
+        """Adds a node and returns its id. The root has parent `-1`."""
+        idx = self.reserve(parent)
+        self.set_name(idx, name)
+        self.set_attrs(idx, node_attrs)
+        self.set_mutations(idx, mutations)
+        return idx
+
+    def reserve(self, parent: int) -> int:
+        """
+        Adds an empty node and returns its id, so the fields can be set as
+        they are parsed. Nodes must be reserved in document pre-order.
+        """
+        idx = len(self.names)
+        self.names.append(None)
+        self.parents.append(parent)
+        for column in self._columns:
+            column.append(None)
+        self.mutations.append(None)
+        return idx
+
+    def set_name(self, idx: int, name: str) -> None:
+        self.names[idx] = sys.intern(name)
+
+    def set_attrs(self, idx: int, node_attrs: Optional[Dict[str, Any]]) -> None:
+        """Parses and stores the `attr_keys` values of `node_attrs`."""
+        values = self._extract(node_attrs) if node_attrs else self._missing
+        for column, value in zip(self._columns, values):
+            column[idx] = value
+
+    def set_mutations(
+        self, idx: int, mutations: Optional[Dict[str, List[str]]]
+    ) -> None:
+        if mutations:
+            self.mutations[idx] = {
+                sys.intern(k): tuple(sys.intern(m) for m in v)
+                for k, v in mutations.items()
+            }
+        else:
+            self.mutations[idx] = None
+
+    def build(self) -> NextStrainTreeIndex:
+        """Returns the finished index."""
+        return NextStrainTreeIndex(
+            self.names, self.parents, self.attrs, self.mutations, self.schema
+        )
+
+
+class NextStrainNode:
+    """Read-only view of a single node of a `NextStrainTreeIndex`."""
+
+    __slots__ = ("tree", "idx")
+
+    def __init__(self, tree: NextStrainTreeIndex, idx: int):
+        self.tree = tree
+        self.idx = idx
+
+    @property
+    def name(self) -> str:
+        return self.tree.names[self.idx]
+
+    @property
+    def parent(self) -> Optional["NextStrainNode"]:
+        parent = self.tree.parents[self.idx]
+        return None if parent < 0 else NextStrainNode(self.tree, parent)
+
+    @property
+    def children(self) -> List["NextStrainNode"]:
+        return [NextStrainNode(self.tree, i) for i in self.tree.children_of(self.idx)]
+
+    @property
+    def attrs(self) -> Dict[str, Any]:
+        return {k: v[self.idx] for k, v in self.tree.attrs.items()}
+
+    @property
+    def mutations(self) -> Dict[str, Tuple[str, ...]]:
+        return self.tree.mutations[self.idx] or {}
@@ -0,0 +1,149 @@
+"""Boolean mutation queries evaluated over preorder node intervals.
+
+Query strings combine `gene:mutation` terms with `AND`, `OR`, `NOT` and
+parentheses, e.g. `S:N501Y AND (ORF1a:T1001I OR NOT nuc:C241T)`. `NOT`
+binds tightest, then `AND`, then `OR`; keywords are case-insensitive.
+
+Node sets are represented as flat interval lists `[s0, e0, s1, e1, ...]`
+of sorted, disjoint, half-open ranges of node ids.
+
+@author: Kyle Hernandez <kmhernan@uchicago.edu>
+"""
+import re
+from array import array
+from typing import Callable, Iterator, List, Sequence, Tuple, Union
+
+QueryT = Tuple[Union[str, "QueryT"], ...]
+
+_TOKEN_RE = re.compile(r"\(|\)|[^\s()]+")
+_KEYWORDS = {"AND", "OR", "NOT"}
+
+
+def parse_query(text: str) -> QueryT:
+    """
+    Parses a query string into nested tuples: `("mut", gene, mutation)`,
+    `("not", q)`, `("and", q1, q2)` and `("or", q1, q2)`. Raises a
+    `ValueError` on malformed queries.
+    """
+    tokens = _TOKEN_RE.findall(text)
+    if not tokens:
+        raise ValueError("Empty query")
+    pos, res = _parse_or(tokens, 0)
+    if pos != len(tokens):
+        raise ValueError("Unexpected '{}' in query: {}".format(tokens[pos], text))
+    return res
+
+
+def _parse_or(tokens: List[str], pos: int) -> Tuple[int, QueryT]:
+    pos, left = _parse_and(tokens, pos)
+    while pos < len(tokens) and tokens[pos].upper() == "OR":
+        pos, right = _parse_and(tokens, pos + 1)
+        left = ("or", left, right)
+    return pos, left
+
+
+def _parse_and(tokens: List[str], pos: int) -> Tuple[int, QueryT]:
+    pos, left = _parse_not(tokens, pos)
+    while pos < len(tokens) and tokens[pos].upper() == "AND":
+        pos, right = _parse_not(tokens, pos + 1)
+        left = ("and", left, right)
+    return pos, left
+
+
+def _parse_not(tokens: List[str], pos: int) -> Tuple[int, QueryT]:
+    if pos >= len(tokens):
+        raise ValueError("Query ended unexpectedly")
+    token = tokens[pos]
+    if token.upper() == "NOT":
+        pos, res = _parse_not(tokens, pos + 1)
+        return pos, ("not", res)
+    if token == "(":
+        pos, res = _parse_or(tokens, pos + 1)
+        if pos >= len(tokens) or tokens[pos] != ")":
+            raise ValueError("Missing ')' in query")
+        return pos + 1, res
+    if token == ")" or token.upper() in _KEYWORDS:
+        raise ValueError("Unexpected '{}' in query".format(token))
+    gene, sep, mutation = token.partition(":")
+    if not sep or not gene or not mutation:
+        raise ValueError(
+            "Query terms must look like gene:mutation, got '{}'".format(token)
+        )
+    return pos + 1, ("mut", gene, mutation)
+
+
+def evaluate_query(
+    query: QueryT, lookup: Callable[[str, str], Sequence[int]], size: int
+) -> array:
+    """
+    Evaluates a parsed query to an interval list over node ids `[0, size)`.
+    `lookup(gene, mutation)` returns the interval list of a single term.
+    """
+    op = query[0]
+    if op == "mut":
+        return array("l", lookup(query[1], query[2]))
+    if op == "not":
+        return complement_intervals(evaluate_query(query[1], lookup, size), size)
+    left = evaluate_query(query[1], lookup, size)
+    right = evaluate_query(query[2], lookup, size)
+    if op == "and":
+        return intersect_intervals(left, right)
+    return union_intervals(left, right)
+
+
+def union_intervals(a: Sequence[int], b: Sequence[int]) -> array:
+    """Returns the union of two interval lists."""
+    res = array("l")
+    i = j = 0
+    while i < len(a) or j < len(b):
+        if j >= len(b) or (i < len(a) and a[i] <= b[j]):
+            start, end = a[i], a[i + 1]
+            i += 2
+        else:
+            start, end = b[j], b[j + 1]
+            j += 2
+        if res and start <= res[-1]:
+            if end > res[-1]:
+                res[-1] = end
+        else:
+            res.append(start)
+            res.append(end)
+    return res
+
+
+def intersect_intervals(a: Sequence[int], b: Sequence[int]) -> array:
+    """Returns the intersection of two interval lists."""
+    res = array("l")
+    i = j = 0
+    while i < len(a) and j < len(b):
+        start = max(a[i], b[j])
+        end = min(a[i + 1], b[j + 1])
+        if start < end:
+            res.append(start)
+            res.append(end)
+        if a[i + 1] < b[j + 1]:
+            i += 2
+        else:
+            j += 2
+    return res
+
+
+def complement_intervals(a: Sequence[int], size: int) -> array:
+    """Returns the intervals of `[0, size)` not covered by `a`."""
+    res = array("l")
+    prev = 0
+    for i in range(0, len(a), 2):
+        if a[i] > prev:
+            res.append(prev)
+            res.append(a[i])
+        prev = a[i + 1]
+    if prev < size:
+        res.append(prev)
+        res.append(size)
+    return res
+
+
+def iter_intervals(a: Sequence[int]) -> Iterator[int]:
+    """Yields the node ids covered by an interval list."""
+    for i in range(0, len(a), 2):
+        yield from range(a[i], a[i + 1])
@@ -0,0 +1,141 @@
+"""Synthetic auspice v2 NextStrain trees for tests and benchmarks.
+
+@author: Kyle Hernandez <kmhernan@uchicago.edu>
+"""
+import math
+import bisect
+import random
+import itertools
+from typing import Dict, Any, List, Optional
+
+COUNTRIES = {
+    "North America": ["USA", "Canada", "Mexico"],
+    "Europe": ["United Kingdom", "Germany", "Spain", "Italy"],
+    "Asia": ["China", "India", "Japan"],
+    "Oceania": ["Australia", "New Zealand"],
+}
+CLADES = ["19A", "19B", "20A", "20B", "20C", "20G", "20I"]
+# Relative weight of each gene when drawing branch mutations
+GENE_WEIGHTS = {"nuc": 10, "ORF1a": 4, "ORF1b": 3, "S": 2, "N": 1, "ORF3a": 1}
+BASES = "ACGT"
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+
+
+def build_synthetic_tree(
+    size: int,
+    max_depth: Optional[int] = None,
+    skew: float = 0.5,
+    mutation_rate: float = 1.0,
+    seed: int = 0,
+) -> Dict[str, Any]:
+    """
+    Builds a random auspice v2 JSON object with `size` nodes.
+
+    * `max_depth`: nodes are never attached deeper than this, at least 1.
+    * `skew`: probability of attaching a node to the most recently added
+      node instead of a random earlier one. Values near 1 give deep
+      ladder-like trees, values near 0 give shallow bushy trees.
+    * `mutation_rate`: mean number of mutations per branch (Poisson).
+
+    Internal nodes are named `NODE_<n>` and tips `<country>/<n>/2020`.
+    """
+    if size < 1:
+        raise ValueError("size must be at least 1, got {}".format(size))
+    if max_depth is not None and max_depth < 1:
+        raise ValueError("max_depth must be at least 1, got {}".format(max_depth))
+    rng = random.Random(seed)
+    genes = list(GENE_WEIGHTS)
+    cum_weights = list(itertools.accumulate(GENE_WEIGHTS[g] for g in genes))
+    regions = sorted(COUNTRIES)
+
+    nodes = [_new_node(rng, regions, None)]
+    depths = [0]
+    # Nodes that can still take children under max_depth
+    shallow = [0]
+    for i in range(1, size):
+        parent = i - 1
+        if rng.random() >= skew:
+            parent = rng.randrange(i)
+        if max_depth is not None and depths[parent] >= max_depth:
+            parent = shallow[rng.randrange(len(shallow))]
+
+        node = _new_node(rng, regions, nodes[parent])
+        muts = {}
+        for _ in range(_poisson(rng, mutation_rate)):
+            pick = rng.random() * cum_weights[-1]
+            gene = genes[bisect.bisect(cum_weights, pick)]
+            muts.setdefault(gene, []).append(_mutation(rng, gene))
+        if muts:
+            node["branch_attrs"]["mutations"] = muts
+        nodes[parent].setdefault("children", []).append(node)
+        nodes.append(node)
+        depths.append(depths[parent] + 1)
+        if max_depth is not None and depths[i] < max_depth:
+            shallow.append(i)
+
+    for i, node in enumerate(nodes):
+        if "children" in node:
+            node["name"] = "NODE_{:07d}".format(i)
+        else:
+            country = node["node_attrs"]["country"]["value"]
+            node["name"] = "{}/{}/2020".format(country, i)
+
+    return {
+        "version": "v2",
+        "meta": {
+            "title": "Synthetic build",
+            "colorings": [
+                {"key": "region", "type": "categorical"},
+                {"key": "country", "type": "categorical"},
+                {"key": "clade_membership", "type": "categorical"},
+                {"key": "num_date", "type": "continuous"},
+            ],
+            "genome_annotations": {
+                g: {"start": 1, "end": 1000, "strand": "+"} for g in genes
+            },
+        },
+        "tree": nodes[0],
+    }
+
+
+def _new_node(
+    rng: random.Random, regions: List[str], parent: Optional[Dict[str, Any]]
+) -> Dict[str, Any]:
+    """Returns a node with random attributes, dated after its parent."""
+    region = rng.choice(regions)
+    div = 0.0
+    num_date = 2019.9
+    if parent is not None:
+        div = parent["node_attrs"]["div"] + rng.random() * 1e-4
+        num_date = parent["node_attrs"]["num_date"]["value"] + rng.random() * 0.01
+    return {
+        "name": None,
+        "node_attrs": {
+            "region": {"value": region},
+            "country": {"value": rng.choice(COUNTRIES[region])},
+            "clade_membership": {"value": rng.choice(CLADES)},
+            "div": div,
+            "num_date": {"value": num_date, "confidence": [num_date, num_date]},
+        },
+        "branch_attrs": {},
+    }
+
+
+def _mutation(rng: random.Random, gene: str) -> str:
+    """Returns a random mutation string, e.g. `A23403G` or `D614G`."""
+    alphabet = BASES if gene == "nuc" else AMINO_ACIDS
+    ref, alt = rng.sample(alphabet, 2)
+    return "{}{}{}".format(ref, rng.randint(1, 30000), alt)
+
+
+def _poisson(rng: random.Random, lam: float) -> int:
+    """Draws from a Poisson distribution (Knuth's method)."""
+    if lam <= 0:
+        return 0
+    limit = math.exp(-lam)
+    k = 0
+    p = rng.random()
+    while p > limit:
+        k += 1
+        p *= rng.random()
+    return k
@@ -0,0 +1,634 @@
+"""Record writers for flattened NextStrain records.
+
+@author: Kyle Hernandez <kmhernan@uchicago.edu>
+"""
+import os
+import sys
+import json
+import zlib
+import queue
+import hashlib
+import operator
+import threading
+import importlib.util
+import urllib.parse
+from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, TextIO, BinaryIO, Union, Set, Callable
+
+from dmwg_data_pyutils.common.io import STDIO_PATH
+from dmwg_data_pyutils.common.logger import Logger
+
+OUTPUT_FORMATS = ["tsv", "parquet", "arrow", "npz"]
+DEFAULT_BATCH_SIZE = 10000
+DEFAULT_BUFFER_ROWS = 5000
+DEFAULT_COMPRESSLEVEL = 6
+DEFAULT_MAX_OPEN_SHARDS = 64
+DEFAULT_MAX_BUFFERED_ROWS = 100000
+SHARD_MANIFEST = "manifest.json"
+
+
+def pyarrow_available() -> bool:
+    """Returns True if the optional `pyarrow` package is installed."""
+    return importlib.util.find_spec("pyarrow") is not None
+
+
+def numpy_available() -> bool:
+    """Returns True if the optional `numpy` package is installed."""
+    return importlib.util.find_spec("numpy") is not None
+
+
+class RecordWriter(metaclass=ABCMeta):
+    """
+    Base class for writers of flattened records. Subclasses implement
+    `write` and `close`; writers are context managers.
+
+    `columns` gives the column order, `numeric` the columns holding numbers
+    and `lists` the columns holding lists of strings. All other columns are
+    strings. Missing values are None.
+    """
+
+    def __init__(
+        self,
+        columns: List[str],
+        numeric: Optional[List[str]] = None,
+        lists: Optional[List[str]] = None,
+    ):
+        self.columns = columns
+        self.numeric = set(numeric or [])
+        self.lists = set(lists or [])
+        self.total = 0
+
+    @abstractmethod
+    def write(self, record: Dict[str, Any]) -> None:
+        """Writes a single record."""
+
+    @abstractmethod
+    def close(self) -> None:
+        """Flushes and closes the output."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class TsvRecordWriter(RecordWriter):
+    """
+    Writes records as TSV, gzipped if the path ends with `.gz` (or if
+    `compress` is True). Missing values are written as `NA` and lists are
+    joined by commas.
+
+    The row formatter is compiled once for the columns, rows are buffered
+    and written `buffer_rows` at a time, and gzip output is deflated at
+    `compresslevel` on a background thread (unless `threaded` is False) so
+    formatting and compression overlap. If `output` is an open text handle
+    the buffered blocks are written to it as they are. `-` writes plain
+    TSV to stdout, flushing every block so downstream readers of a pipe get
+    the rows as they are written.
+    """
+
+    def __init__(
+        self,
+        output: Union[str, TextIO],
+        columns: List[str],
+        numeric: Optional[List[str]] = None,
+        lists: Optional[List[str]] = None,
+        header: bool = True,
+        compress: Optional[bool] = None,
+        compresslevel: int = DEFAULT_COMPRESSLEVEL,
+        threaded: bool = True,
+        buffer_rows: int = DEFAULT_BUFFER_ROWS,
+    ):
+        super().__init__(columns, numeric, lists)
+        self.buffer_rows = buffer_rows
+        self.format_row = self.compile_formatter(columns, self.lists)
+        self._buffer = []
+        self._text = None
+        self._sink = None
+        if output == STDIO_PATH:
+            if hasattr(sys.stdout, "buffer"):
+                sys.stdout.flush()
+                self._sink = StdoutSink(sys.stdout.buffer)
+            else:
+                self._text = sys.stdout
+        elif isinstance(output, str):
+            if compress is None:
+                compress = output.endswith(".gz")
+            handle = open(output, "wb")
+            if compress and threaded:
+                self._sink = BackgroundGzipSink(handle, compresslevel)
+            elif compress:
+                self._sink = GzipSink(handle, compresslevel)
+            else:
+                self._sink = PlainSink(handle)
+        else:
+            self._text = output
+        if header:
+            self._buffer.append("\t".join(columns) + "\n")
+
+    @staticmethod
+    def compile_formatter(
+        columns: List[str], lists: Set[str]
+    ) -> Callable[[Dict[str, Any]], str]:
+        """
+        Builds the function formatting a record into a TSV line, choosing
+        each column's formatting once instead of per value.
+        """
+
+        def fmt_value(value):
+            return "NA" if value is None else str(value)
+
+        def fmt_list(value):
+            return "NA" if value is None else ",".join(value)
+
+        getter = operator.itemgetter(*columns)
+        fmts = [fmt_list if k in lists else fmt_value for k in columns]
+        if len(columns) == 1:
+            fmt = fmts[0]
+            return lambda record: fmt(getter(record)) + "\n"
+
+        def format_row(record):
+            return "\t".join([f(v) for f, v in zip(fmts, getter(record))]) + "\n"
+
+        return format_row
+
+    def write(self, record: Dict[str, Any]) -> None:
+        self._buffer.append(self.format_row(record))
+        self.total += 1
+        if len(self._buffer) >= self.buffer_rows:
+            self._flush()
+
+    def _flush(self) -> None:
+        if self._buffer:
+            block = "".join(self._buffer)
+            self._buffer = []
+            if self._text is not None:
+                self._text.write(block)
+            else:
+                self._sink.write(block.encode("utf-8"))
+
+    def close(self) -> None:
+        self._flush()
+        if self._sink is not None:
+            self._sink.close()
+            self._sink = None
+
+
+class PlainSink:
+    """Writes byte blocks to a binary handle it owns."""
+
+    def __init__(self, handle: BinaryIO):
+        self.handle = handle
+
+    def write(self, block: bytes) -> None:
+        self.handle.write(block)
+
+    def close(self) -> None:
+        self.handle.close()
+
+
+class StdoutSink(PlainSink):
+    """
+    Writes byte blocks to stdout's binary handle, flushing after each
+    block. The handle is not closed.
+    """
+
+    def write(self, block: bytes) -> None:
+        self.handle.write(block)
+        self.handle.flush()
+
+    def close(self) -> None:
+        self.handle.flush()
+
+
+class GzipSink(PlainSink):
+    """Gzips byte blocks into a binary handle it owns."""
+
+    def __init__(self, handle: BinaryIO, compresslevel: int = DEFAULT_COMPRESSLEVEL):
+        super().__init__(handle)
+        self._compressor = zlib.compressobj(
+            compresslevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS
+        )
+
+    def write(self, block: bytes) -> None:
+        self.handle.write(self._compressor.compress(block))
+
+    def close(self) -> None:
+        self.handle.write(self._compressor.flush())
+        self.handle.close()
+
+
+class BackgroundGzipSink(threading.Thread):
+    """
+    Gzips byte blocks into a binary handle it owns on a background thread.
+    zlib releases the GIL while deflating, so compression overlaps with
+    the caller formatting the next block. At most `max_blocks` blocks are
+    queued.
+    """
+
+    def __init__(
+        self,
+        handle: BinaryIO,
+        compresslevel: int = DEFAULT_COMPRESSLEVEL,
+        max_blocks: int = 4,
+    ):
+        super().__init__(name="BackgroundGzipSink", daemon=True)
+        self._sink = GzipSink(handle, compresslevel)
+        self.queue = queue.Queue(max_blocks)
+        self.error = None
+        self.start()
+
+    def run(self) -> None:
+        while True:
+            block = self.queue.get()
+            if block is None:
+                break
+            if self.error is None:
+                try:
+                    self._sink.write(block)
+                except BaseException as e:
+                    self.error = e
+
+    def write(self, block: bytes) -> None:
+        if self.error is not None:
+            raise self.error
+        self.queue.put(block)
+
+    def close(self) -> None:
+        self.queue.put(None)
+        self.join()
+        if self.error is None:
+            self._sink.close()
+        else:
+            self._sink.handle.close()
+            raise self.error
+
+
+class ShardedRecordWriter(RecordWriter):
+    """
+    Writes records as TSV partitioned into one file per partition in
+    `output_dir`. `partition` returns the partition of a record, whose file
+    is its URL quoted name followed by `suffix` (gzipped if it ends with
+    `.gz`, on a background thread unless `threaded` is False).
+
+    Rows are buffered per partition and a partition's rows are written
+    `buffer_rows` at a time, or the largest buffer once `max_buffered_rows`
+    rows are buffered in total. At most `max_open` shard files are kept
+    open; the least recently written is closed when another is needed and
+    appended to (as a new gzip member) if it is needed again.
+
+    On close, a JSON manifest (`SHARD_MANIFEST`) with `metadata`, the
+    columns and the records, bytes and SHA-256 of each shard is written to
+    `output_dir`. It is not written if the writer is left on an exception.
+    """
+
+    def __init__(
+        self,
+        output_dir: str,
+        partition: Callable[[Dict[str, Any]], str],
+        columns: List[str],
+        numeric: Optional[List[str]] = None,
+        lists: Optional[List[str]] = None,
+        suffix: str = ".tsv.gz",
+        compresslevel: int = DEFAULT_COMPRESSLEVEL,
+        max_open: int = DEFAULT_MAX_OPEN_SHARDS,
+        threaded: bool = True,
+        buffer_rows: int = DEFAULT_BUFFER_ROWS,
+        max_buffered_rows: int = DEFAULT_MAX_BUFFERED_ROWS,
+        metadata: Optional[Dict[str, Any]] = None,
+    ):
+        super().__init__(columns, numeric, lists)
+        if max_open < 1:
+            raise ValueError("At least one shard must be open, got {}".format(max_open))
+        self.output_dir = output_dir
+        self.partition = partition
+        self.suffix = suffix
+        self.compresslevel = compresslevel
+        self.max_open = max_open
+        self.threaded = threaded
+        self.buffer_rows = buffer_rows
+        self.max_buffered_rows = max_buffered_rows
+        self.metadata = metadata or {}
+        self.format_row = TsvRecordWriter.compile_formatter(columns, self.lists)
+        self.counts = {}
+        self.manifest = None
+        self._buffers = {}
+        self._buffered = 0
+        self._created = set()
+        self._sinks = OrderedDict()
+        os.makedirs(output_dir, exist_ok=True)
+
+    def shard_path(self, partition: str) -> str:
+        """Returns the path of the shard of a partition."""
+        name = urllib.parse.quote(partition, safe="")
+        return os.path.join(self.output_dir, name + self.suffix)
+
+    def write(self, record: Dict[str, Any]) -> None:
+        partition = self.partition(record)
+        buffer = self._buffers.get(partition)
+        if buffer is None:
+            buffer = self._buffers[partition] = []
+            self.counts.setdefault(partition, 0)
+        buffer.append(self.format_row(record))
+        self.counts[partition] += 1
+        self.total += 1
+        self._buffered += 1
+        if len(buffer) >= self.buffer_rows:
+            self._flush(partition)
+        elif self._buffered >= self.max_buffered_rows:
+            self._flush(max(self._buffers, key=lambda k: len(self._buffers[k])))
+
+    def _flush(self, partition: str) -> None:
+        """Writes the buffered rows of a partition to its shard."""
+        buffer = self._buffers.pop(partition)
+        self._buffered -= len(buffer)
+        self._sink(partition).write("".join(buffer).encode("utf-8"))
+
+    def _sink(self, partition: str) -> Union[PlainSink, BackgroundGzipSink]:
+        """
+        Returns the open sink of a shard, closing the least recently written
+        one if `max_open` are open. New shards start with the header.
+        """
+        sink = self._sinks.get(partition)
+        if sink is not None:
+            self._sinks.move_to_end(partition)
+            return sink
+        if len(self._sinks) >= self.max_open:
+            _, lru = self._sinks.popitem(last=False)
+            lru.close()
+        path = self.shard_path(partition)
+        created = partition in self._created
+        handle = open(path, "ab" if created else "wb")
+        if not self.suffix.endswith(".gz"):
+            sink = PlainSink(handle)
+        elif self.threaded:
+            sink = BackgroundGzipSink(handle, self.compresslevel)
+        else:
+            sink = GzipSink(handle, self.compresslevel)
+        if not created:
+            self._created.add(partition)
+            sink.write(("\t".join(self.columns) + "\n").encode("utf-8"))
+        self._sinks[partition] = sink
+        return sink
+
+    def _close_sinks(self) -> None:
+        while self._sinks:
+            _, sink = self._sinks.popitem(last=False)
+            sink.close()
+
+    def close(self) -> None:
+        for partition in sorted(self._buffers):
+            self._flush(partition)
+        self._close_sinks()
+        shards = []
+        for partition in sorted(self.counts):
+            path = self.shard_path(partition)
+            shards.append(
+                {
+                    "partition": partition,
+                    "path": os.path.basename(path),
+                    "records": self.counts[partition],
+                    "bytes": os.path.getsize(path),
+                    "sha256": file_sha256(path),
+                }
+            )
+        self.manifest = dict(self.metadata)
+        self.manifest.update(
+            {"columns": self.columns, "records": self.total, "shards": shards}
+        )
+        path = os.path.join(self.output_dir, SHARD_MANIFEST)
+        with open(path + ".part", "wt") as o:
+            json.dump(self.manifest, o, indent=2)
+            o.write("\n")
+        os.replace(path + ".part", path)
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._close_sinks()
+
+
+def file_sha256(path: str) -> str:
+    """Returns the hex SHA-256 of a file's bytes."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class BatchedRecordWriter(RecordWriter):
+    """
+    Buffers records column-wise and hands them to `_write_batch` every
+    `batch_size` records.
+    """
+
+    def __init__(
+        self,
+        columns: List[str],
+        numeric: Optional[List[str]] = None,
+        lists: Optional[List[str]] = None,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+    ):
+        super().__init__(columns, numeric, lists)
+        self.batch_size = batch_size
+        self._batch = {k: [] for k in columns}
+        self._pending = 0
+
+    def write(self, record: Dict[str, Any]) -> None:
+        for key in self.columns:
+            value = record[key]
+            if key in self.numeric:
+                value = to_float(value)
+            self._batch[key].append(value)
+        self._pending += 1
+        self.total += 1
+        if self._pending >= self.batch_size:
+            self._flush()
+
+    def _flush(self) -> None:
+        if self._pending:
+            self._write_batch(self._batch)
+            self._batch = {k: [] for k in self.columns}
+            self._pending = 0
+
+    @abstractmethod
+    def _write_batch(self, batch: Dict[str, List[Any]]) -> None:
+        """Writes a batch of column name to column values."""
+
+    def close(self) -> None:
+        self._flush()
+
+
+class ArrowRecordWriter(BatchedRecordWriter):
+    """
+    Writes records as Parquet (`fmt="parquet"`) or as an Arrow IPC file
+    (`fmt="arrow"`). Numeric columns are float64, list columns are
+    `list<string>` and everything else is a string; Parquet dictionary
+    encodes the string values on disk. Requires the optional `pyarrow`
+    package.
+    """
+
+    def __init__(
+        self,
+        output: str,
+        columns: List[str],
+        numeric: Optional[List[str]] = None,
+        lists: Optional[List[str]] = None,
+        fmt: str = "parquet",
+        batch_size: int = DEFAULT_BATCH_SIZE,
+    ):
+        super().__init__(columns, numeric, lists, batch_size)
+        import pyarrow as pa
+
+        self._pa = pa
+        fields = []
+        for key in columns:
+            if key in self.numeric:
+                dtype = pa.float64()
+            elif key in self.lists:
+                dtype = pa.list_(pa.string())
+            else:
+                dtype = pa.string()
+            fields.append(pa.field(key, dtype))
+        self.schema = pa.schema(fields)
+
+        if fmt == "parquet":
+            import pyarrow.parquet as pq
+
+            self._writer = pq.ParquetWriter(output, self.schema)
+        elif fmt == "arrow":
+            self._writer = pa.ipc.new_file(output, self.schema)
+        else:
+            raise ValueError("Unsupported format {}".format(fmt))
+
+    def _write_batch(self, batch: Dict[str, List[Any]]) -> None:
+        pa = self._pa
+        arrays = [pa.array(batch[f.name], f.type) for f in self.schema]
+        self._writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=self.schema))
+
+    def close(self) -> None:
+        super().close()
+        self._writer.close()
+
+
+class NpzRecordWriter(BatchedRecordWriter):
+    """
+    Writes records to a compressed NumPy `.npz` archive, for when `pyarrow`
+    is not installed. Requires the optional `numpy` package. The archive
+    holds, per column:
+
+    * numeric: `<col>` float64 array with NaN for missing values.
+    * string: `<col>.codes` int32 (-1 if missing) into `<col>.categories`.
+    * list: `<col>.lengths` int32 (-1 if missing) and the flattened
+      `<col>.ids` int32 into `<col>.vocab`.
+
+    `columns` holds the column names in order. Each batch is converted to
+    compact arrays as it fills, so only the encoded data is kept until the
+    archive is written on close.
+    """
+
+    def __init__(
+        self,
+        output: str,
+        columns: List[str],
+        numeric: Optional[List[str]] = None,
+        lists: Optional[List[str]] = None,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+    ):
+        super().__init__(columns, numeric, lists, batch_size)
+        import numpy as np
+
+        self._np = np
+        self.output = output
+        self._codes = {k: {} for k in columns if k not in self.numeric}
+        self._chunks = {}
+
+    def _encode(self, key: str, value: str) -> int:
+        codes = self._codes[key]
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(codes)
+        return code
+
+    def _write_batch(self, batch: Dict[str, List[Any]]) -> None:
+        np = self._np
+        for key in self.columns:
+            values = batch[key]
+            if key in self.numeric:
+                arrays = {key: np.array(values, dtype=np.float64)}
+            elif key in self.lists:
+                lengths = [-1 if v is None else len(v) for v in values]
+                ids = [self._encode(key, m) for v in values if v for m in v]
+                arrays = {
+                    key + ".lengths": np.array(lengths, dtype=np.int32),
+                    key + ".ids": np.array(ids, dtype=np.int32),
+                }
+            else:
+                codes = [-1 if v is None else self._encode(key, str(v)) for v in values]
+                arrays = {key + ".codes": np.array(codes, dtype=np.int32)}
+            for name, arr in arrays.items():
+                self._chunks.setdefault(name, []).append(arr)
+
+    def close(self) -> None:
+        super().close()
+        np = self._np
+        out = {"columns": np.array(self.columns, dtype=str)}
+        for key in self.columns:
+            if key in self.numeric:
+                names = [key]
+            elif key in self.lists:
+                names = [key + ".lengths", key + ".ids"]
+                out[key + ".vocab"] = np.array(list(self._codes[key]), dtype=str)
+            else:
+                names = [key + ".codes"]
+                out[key + ".categories"] = np.array(list(self._codes[key]), dtype=str)
+            for name in names:
+                chunks = self._chunks.get(name)
+                dtype = np.float64 if key in self.numeric else np.int32
+                out[name] = np.concatenate(chunks) if chunks else np.array([], dtype)
+        with open(self.output, "wb") as o:
+            np.savez_compressed(o, **out)
+
+
+def to_float(value: Any) -> Optional[float]:
+    """Converts a value to float, None if missing or not numeric."""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def open_record_writer(
+    output: str,
+    fmt: str,
+    columns: List[str],
+    numeric: Optional[List[str]] = None,
+    lists: Optional[List[str]] = None,
+    compresslevel: int = DEFAULT_COMPRESSLEVEL,
+) -> RecordWriter:
+    """
+    Opens a record writer for the output format. Parquet and Arrow fall
+    back to `.npz` with a warning if `pyarrow` is not installed, written to
+    `output` with its extension replaced by `.npz`.
+    `compresslevel` applies to gzipped TSV.
+    """
+    if fmt == "tsv":
+        return TsvRecordWriter(
+            output, columns, numeric, lists, compresslevel=compresslevel
+        )
+    if fmt in ("parquet", "arrow"):
+        if pyarrow_available():
+            return ArrowRecordWriter(output, columns, numeric, lists, fmt=fmt)
+        output = os.path.splitext(output)[0] + ".npz"
+        logger = Logger.get_logger("RecordWriter")
+        logger.warning("pyarrow is not installed, writing npz to {}".format(output))
+        fmt = "npz"
+    if fmt == "npz":
+        return NpzRecordWriter(output, columns, numeric, lists)
+    raise ValueError("Unsupported format {}".format(fmt))
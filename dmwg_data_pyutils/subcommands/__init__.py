@@ -1,4 +1,55 @@
+"""Registry of the dmwg-data-pyutils subcommands.
+
+Subcommands are declared by name in `SUBCOMMANDS` and their modules are
+only imported when the subcommand is used, so that the CLI starts without
+importing every tool and its dependencies. `DESCRIPTIONS` holds the
+`__get_description__` of each subcommand for the top-level help.
+"""
 from __future__ import absolute_import
 
+import importlib
+
 from .base import Subcommand
-from .nextstrain_json import ParseNextStrain
+
+# Subcommand name to the module (relative to this package) defining the
+# class of the same name
+SUBCOMMANDS = {
+    "ParseNextStrain": "nextstrain_json",
+    "QueryNextStrain": "query_nextstrain",
+    "ParseNextStrainBuilds": "nextstrain_builds",
+}
+
+# Subcommand name to its description, listed by `--help` without importing
+# the module
+DESCRIPTIONS = {
+    "ParseNextStrain": (
+        "Extracts patient metadata, viral divergence, and "
+        "viral mutations from the nextstrain JSON file."
+    ),
+    "QueryNextStrain": (
+        "Finds the nodes of the nextstrain JSON tree carrying a "
+        "combination of mutations, optionally filtered by node attributes."
+    ),
+    "ParseNextStrainBuilds": (
+        "Fetches and parses several nextstrain JSON builds concurrently, "
+        "writing one output per build and a combined output with a "
+        "dataset column."
+    ),
+}
+
+
+def load_subcommand(name):
+    """Imports the module of subcommand `name` and returns its class."""
+    module = importlib.import_module("." + SUBCOMMANDS[name], __name__)
+    return getattr(module, name)
+
+
+def __getattr__(name):
+    """Lazily resolves `from dmwg_data_pyutils.subcommands import MyClass`."""
+    if name in SUBCOMMANDS:
+        return load_subcommand(name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + list(SUBCOMMANDS))
@@ -6,6 +6,8 @@ based off of Nils Homer's work (https://github.com/nh13).
 """
 from abc import ABCMeta, abstractmethod
 
+from dmwg_data_pyutils.common.logger import Logger
+from dmwg_data_pyutils.common.metrics import Metrics
 from dmwg_data_pyutils.common.types import ArgParserT, NamespaceT
 
 
@@ -40,10 +42,54 @@ class Subcommand(metaclass=ABCMeta):
     @classmethod
     def add(cls, subparsers: ArgParserT) -> ArgParserT:
         """Adds the given subcommand to the subparsers."""
+        description = cls.__get_description__()
         subparser = subparsers.add_parser(
-            name=cls.__tool_name__(), description=cls.__get_description__()
+            name=cls.__tool_name__(), description=description, help=description
         )
 
         cls.__add_arguments__(subparser)
-        subparser.set_defaults(func=cls.main)
+        cls.__add_metrics_arguments__(subparser)
+        subparser.set_defaults(func=cls.run)
         return subparser
+
+    @classmethod
+    def __add_metrics_arguments__(cls, parser: ArgParserT):
+        """Adds the run metrics arguments shared by all subcommands"""
+        group = parser.add_argument_group("Run metrics")
+        group.add_argument(
+            "--profile",
+            action="store_true",
+            help="Run cProfile on each stage and report the top functions.",
+        )
+        group.add_argument(
+            "--metrics-out",
+            default=None,
+            help="Write per-stage wall/CPU time, process peak RSS, bytes "
+            "read/written and records/s to this JSON file.",
+        )
+
+    @classmethod
+    def run(cls, options: NamespaceT) -> None:
+        """
+        Runs `main` with a `Metrics` recorder on `options.metrics` and
+        reports it when `--profile` or `--metrics-out` is given.
+        """
+        profile = getattr(options, "profile", False)
+        metrics_out = getattr(options, "metrics_out", None)
+        options.metrics = Metrics(profile=profile)
+        cls.main(options)
+        if profile or metrics_out:
+            logger = Logger.get_logger(cls.__tool_name__())
+            options.metrics.log(logger)
+            if metrics_out:
+                options.metrics.write(metrics_out)
+                logger.info("Metrics written to {}".format(metrics_out))
+
+    @classmethod
+    def get_metrics(cls, options: NamespaceT) -> Metrics:
+        """
+        Returns the run's `Metrics`, or a fresh one when `main` is called
+        directly.
+        """
+        metrics = getattr(options, "metrics", None)
+        return metrics if metrics is not None else Metrics()
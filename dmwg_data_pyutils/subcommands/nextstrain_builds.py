@@ -0,0 +1,341 @@
+"""Fetches and parses several nextstrain JSON builds concurrently, writing
+one output per build and a combined output with a dataset column.
+
+@author: Kyle Hernandez <kmhernan@uchicago.edu>
+"""
+import os
+import re
+import shutil
+import tempfile
+import urllib.parse
+import concurrent.futures
+
+from typing import Any, Dict, List, Optional, Tuple
+
+from dmwg_data_pyutils.common.logger import Logger
+from dmwg_data_pyutils.common.io import streaming_json_available
+from dmwg_data_pyutils.common.types import ArgParserT, NamespaceT, LoggerT
+from dmwg_data_pyutils.common.download import DownloadCache, download_file
+from dmwg_data_pyutils.common.nextstrain import NextStrainParser, NextStrainSchema
+from dmwg_data_pyutils.common.writers import DEFAULT_COMPRESSLEVEL
+
+from dmwg_data_pyutils.subcommands.nextstrain_json import ParseNextStrain, comma_list
+
+DEFAULT_FETCH_THREADS = 4
+COMBINED_NAME = "combined"
+_NAMED_SOURCE_RE = re.compile(r"^([\w.-]+)=(.+)$")
+
+
+def _parse_build(
+    task: Tuple[str, str, str, str, List[str], int, Dict[str, Any]]
+) -> int:
+    """
+    Parses one build and writes its output and its headerless part of the
+    combined output. Runs in a worker process.
+    """
+    name, path, output, part, columns, compresslevel, traversal = task
+    nstree = NextStrainParser.from_file_path(path, stream=streaming_json_available())
+    nstree.release_json()
+    writer = ParseNextStrain._tsv_writer(
+        output, compresslevel=compresslevel, columns=columns
+    )
+    combined = ParseNextStrain._tsv_writer(
+        part,
+        header=False,
+        compresslevel=compresslevel,
+        columns=["dataset"] + columns,
+    )
+    with writer, combined:
+        for record in nstree.mutation_traversal_generator(**traversal):
+            writer.write(record)
+            record["dataset"] = name
+            combined.write(record)
+    return writer.total
+
+
+class ParseNextStrainBuilds(ParseNextStrain):
+    @classmethod
+    def __add_arguments__(cls, parser: ArgParserT):
+        """Add the arguments to the parser"""
+        cls._add_filter_arguments(parser)
+        parser.add_argument(
+            "--cache-dir",
+            type=str,
+            default=None,
+            help="Optional directory to cache the downloaded builds in. Cached "
+            "copies are revalidated with a conditional GET and only "
+            "downloaded again if they changed on the server.",
+        )
+        parser.add_argument(
+            "--fetch-threads",
+            type=int,
+            default=DEFAULT_FETCH_THREADS,
+            help="Number of builds downloaded at the same time [%(default)s].",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=None,
+            help="Number of worker processes parsing the downloaded builds "
+            "[number of builds, at most the number of CPUs].",
+        )
+        parser.add_argument(
+            "--suffix",
+            type=str,
+            default=".tsv.gz",
+            help="Suffix of the output files, .gz outputs are compressed "
+            "[%(default)s].",
+        )
+        parser.add_argument(
+            "--compression-level",
+            type=int,
+            choices=range(1, 10),
+            default=DEFAULT_COMPRESSLEVEL,
+            metavar="{1..9}",
+            help="gzip compression level of .gz outputs [%(default)s].",
+        )
+        parser.add_argument(
+            "--columns",
+            type=comma_list,
+            default=None,
+            metavar="COLUMN,...",
+            help="Comma separated node attribute columns to write, see "
+            "ParseNextStrain [all].",
+        )
+        parser.add_argument(
+            "--genes",
+            type=comma_list,
+            default=None,
+            metavar="GENE,...",
+            help="Comma separated genes whose mutations are written, see "
+            "ParseNextStrain [all].",
+        )
+        parser.add_argument(
+            "--combined",
+            type=str,
+            default=None,
+            help="Path to the combined output of all builds, with an extra "
+            "dataset column [<output_dir>/{}<suffix>].".format(COMBINED_NAME),
+        )
+        parser.add_argument(
+            "output_dir",
+            type=str,
+            help="Directory of the outputs, one <dataset><suffix> per build.",
+        )
+        parser.add_argument(
+            "datasets",
+            type=str,
+            nargs="+",
+            help="URLs or paths of the Nextstrain JSON builds, optionally "
+            "named as NAME=SOURCE. By default the dataset is named after the "
+            "file, e.g. ncov_europe for .../ncov_europe.json.",
+        )
+
+    @classmethod
+    def main(cls, options: NamespaceT) -> None:
+        """
+        Entrypoint for ParseNextStrainBuilds.
+        """
+        logger = Logger.get_logger(cls.__tool_name__())
+        logger.info(cls.__get_description__())
+
+        metrics = cls.get_metrics(options)
+        datasets = cls.dataset_names(options.datasets)
+        schema = cls._check_schema(options, NextStrainSchema.default())
+        node_filter = cls._node_filter(options, schema)
+        columns = cls.colnames(options.columns, options.genes)
+        traversal = {
+            "node_filter": node_filter,
+            "attr_keys": options.columns,
+            "genes": options.genes,
+        }
+        outputs = {
+            name: os.path.join(options.output_dir, name + options.suffix)
+            for name, _ in datasets
+        }
+        combined = options.combined
+        if combined is None:
+            combined = os.path.join(options.output_dir, COMBINED_NAME + options.suffix)
+        if combined in outputs.values():
+            raise ValueError(
+                "{} is both a build and the combined output".format(combined)
+            )
+        workers = options.workers
+        if workers is None:
+            workers = min(len(datasets), os.cpu_count() or 1)
+
+        os.makedirs(options.output_dir, exist_ok=True)
+        cache = None if options.cache_dir is None else DownloadCache(options.cache_dir)
+        tmpdir = tempfile.mkdtemp(
+            prefix=".{}-".format(cls.__tool_name__()),
+            dir=os.path.abspath(options.output_dir),
+        )
+        # Parts are compressed like the combined output they are appended to
+        ext = ".part.gz" if combined.endswith(".gz") else ".part"
+        parts = {name: os.path.join(tmpdir, name + ext) for name, _ in datasets}
+        try:
+            with metrics.stage("fetch_parse") as stage:
+                counts = cls._fetch_and_parse(
+                    datasets,
+                    tmpdir,
+                    cache,
+                    options.fetch_threads,
+                    workers,
+                    outputs,
+                    parts,
+                    columns,
+                    options.compression_level,
+                    traversal,
+                    logger,
+                )
+                stage.records = sum(counts.values())
+
+            with metrics.stage("combine") as stage:
+                logger.info("Writing the combined output to {}".format(combined))
+                with cls._tsv_writer(
+                    combined,
+                    compresslevel=options.compression_level,
+                    columns=["dataset"] + columns,
+                ):
+                    pass
+                with open(combined, "ab") as o:
+                    for name, _ in datasets:
+                        with open(parts[name], "rb") as fh:
+                            shutil.copyfileobj(fh, o, 1 << 20)
+                stage.records = sum(counts.values())
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        logger.info(
+            "Completed. Parsed {} records of {} builds.".format(
+                sum(counts.values()), len(datasets)
+            )
+        )
+
+    @classmethod
+    def _fetch_and_parse(
+        cls,
+        datasets: List[Tuple[str, str]],
+        tmpdir: str,
+        cache: Optional[DownloadCache],
+        fetch_threads: int,
+        workers: int,
+        outputs: Dict[str, str],
+        parts: Dict[str, str],
+        columns: List[str],
+        compresslevel: int,
+        traversal: Dict[str, Any],
+        logger: LoggerT,
+    ) -> Dict[str, int]:
+        """
+        Downloads the builds on a thread pool and hands each build to a
+        process pool as soon as it is fetched, so parsing overlaps with the
+        remaining downloads. Returns the number of records of each build
+        and raises a `RuntimeError` naming the builds that failed.
+        """
+        counts = {}
+        failed = []
+        with concurrent.futures.ProcessPoolExecutor(workers) as parsers:
+            # Starts the worker processes before any fetch thread is running
+            parsers.submit(int).result()
+            with concurrent.futures.ThreadPoolExecutor(fetch_threads) as fetchers:
+                fetches = {
+                    fetchers.submit(cls._fetch, source, name, tmpdir, cache): name
+                    for name, source in datasets
+                }
+                parses = {}
+                for future in concurrent.futures.as_completed(fetches):
+                    name = fetches[future]
+                    try:
+                        path = future.result()
+                    except Exception as e:
+                        logger.error("Failed to fetch {}: {}".format(name, e))
+                        failed.append(name)
+                        continue
+                    logger.info("Fetched {}, parsing it.".format(name))
+                    task = (
+                        name,
+                        path,
+                        outputs[name],
+                        parts[name],
+                        columns,
+                        compresslevel,
+                        traversal,
+                    )
+                    parses[parsers.submit(_parse_build, task)] = name
+
+            for future in concurrent.futures.as_completed(parses):
+                name = parses[future]
+                try:
+                    counts[name] = future.result()
+                except Exception as e:
+                    logger.error("Failed to parse {}: {}".format(name, e))
+                    failed.append(name)
+                    continue
+                logger.info(
+                    "Parsed {} records of {} to {}.".format(
+                        counts[name], name, outputs[name]
+                    )
+                )
+        if failed:
+            raise RuntimeError(
+                "Failed to process {}".format(", ".join(sorted(failed)))
+            )
+        return counts
+
+    @classmethod
+    def _fetch(
+        cls, source: str, name: str, tmpdir: str, cache: Optional[DownloadCache]
+    ) -> str:
+        """
+        Returns the local path of a build, downloading URLs to `tmpdir` (or
+        the `cache`).
+        """
+        if "://" not in source:
+            if not os.path.isfile(source):
+                raise FileNotFoundError(source)
+            return source
+        return download_file(
+            source, save_path=os.path.join(tmpdir, name + ".json"), cache=cache
+        )
+
+    @classmethod
+    def dataset_names(cls, datasets: List[str]) -> List[Tuple[str, str]]:
+        """
+        Returns the `(name, source)` of each dataset argument. Arguments are
+        `NAME=SOURCE` or only a source, named after its file without the
+        .json/.gz extensions.
+        """
+        res = []
+        for item in datasets:
+            match = _NAMED_SOURCE_RE.match(item)
+            if match is not None:
+                name, source = match.groups()
+            else:
+                source = item
+                name = os.path.basename(urllib.parse.urlsplit(source).path)
+                for ext in (".gz", ".json"):
+                    if name.endswith(ext):
+                        name = name[: -len(ext)]
+            if not name:
+                raise ValueError("Can't name dataset {}, use NAME=SOURCE".format(item))
+            res.append((name, source))
+        names = [name for name, _ in res]
+        duplicated = sorted(set(i for i in names if names.count(i) > 1))
+        if duplicated:
+            raise ValueError(
+                "Duplicated dataset names {}, use NAME=SOURCE".format(
+                    ", ".join(duplicated)
+                )
+            )
+        return res
+
+    @classmethod
+    def __get_description__(cls):
+        """
+        Tool description.
+        """
+        return (
+            "Fetches and parses several nextstrain JSON builds concurrently, "
+            "writing one output per build and a combined output with a "
+            "dataset column."
+        )
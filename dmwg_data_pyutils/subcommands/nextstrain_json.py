@@ -3,29 +3,286 @@ viral mutations from the nextstrain JSON file.
 
 @author: Kyle Hernandez <kmhernan@uchicago.edu>
 """
-import json
 import os
-import gzip
+import glob
+import json
+import zlib
+import shutil
+import tempfile
+import multiprocessing
 
-from typing import Tuple, Optional, List, Dict, Any, TextIO
+from typing import (
+    Tuple,
+    Optional,
+    List,
+    Dict,
+    Any,
+    TextIO,
+    Union,
+    Iterator,
+    Callable,
+)
 
 from dmwg_data_pyutils.common.logger import Logger
-from dmwg_data_pyutils.common.io import load_json_file
+from dmwg_data_pyutils.common.io import (
+    STDIO_PATH,
+    load_json_file,
+    streaming_json_available,
+)
 from dmwg_data_pyutils.common.types import ArgParserT, NamespaceT, LoggerT
+from dmwg_data_pyutils.common.metrics import Metrics
 from dmwg_data_pyutils.common.nextstrain import (
     NextStrainParser,
+    NextStrainSchema,
+    NodeFilter,
+    NEXTSTRAIN_JSON_URL,
     NODE_ATTRS,
     MUTATION_KEYS,
 )
+from dmwg_data_pyutils.common.index_cache import IndexCache, DEFAULT_MAX_BYTES
+from dmwg_data_pyutils.common.writers import (
+    OUTPUT_FORMATS,
+    DEFAULT_COMPRESSLEVEL,
+    DEFAULT_MAX_OPEN_SHARDS,
+    RecordWriter,
+    TsvRecordWriter,
+    ShardedRecordWriter,
+    open_record_writer,
+)
 
 from dmwg_data_pyutils.subcommands import Subcommand
 
+# Chunks per worker process, more chunks balance uneven subtrees better.
+CHUNKS_PER_WORKER = 4
+
+# Output layouts: one row per node with cumulative mutations, or tables of
+# the nodes and of their own branch mutations
+LAYOUTS = ["wide", "normalized"]
+# Columns of the long format mutation tables of the normalized layout
+MUTATION_COLUMNS = ["name", "gene", "mutation"]
+
+# Prefix of the --shard-by hash:N partitions
+HASH_SHARD = "hash:"
+
+# Progress file of --batch runs, one JSON line per finished snapshot
+BATCH_PROGRESS = ".progress.jsonl"
+
+# Parser and traversal options (node filter and projection) shared with
+# the worker processes, set by `_init_worker`.
+_WORKER_TREE = None
+_WORKER_TRAVERSAL = None
+
+
+def _init_worker(nstree: NextStrainParser, traversal: Dict[str, Any]) -> None:
+    """Worker process initializer."""
+    global _WORKER_TREE, _WORKER_TRAVERSAL
+    _WORKER_TREE = nstree
+    _WORKER_TRAVERSAL = traversal
+
+
+def _write_chunk(task: Tuple[int, int, str, bool, int, List[str]]) -> int:
+    """Writes the records of one slice of the traversal order."""
+    start, stop, path, compress, compresslevel, columns = task
+    writer = ParseNextStrain._tsv_writer(
+        path,
+        header=False,
+        compress=compress,
+        compresslevel=compresslevel,
+        columns=columns,
+        schema=_WORKER_TREE.index.schema,
+    )
+    with writer:
+        for record in _WORKER_TREE.mutation_traversal_generator(
+            start, stop, **_WORKER_TRAVERSAL
+        ):
+            writer.write(record)
+    return writer.total
+
+
+def _write_snapshot(
+    task: Tuple[
+        str, str, str, List[str], int, Dict[str, Any], bool, Optional[IndexCache]
+    ]
+) -> Tuple[str, int]:
+    """
+    Parses one snapshot of a --batch run and writes its records to
+    `output`, headerless and with a leading snapshot column if `tagged`.
+    The file is written to `<output>.part` and moved into place once
+    complete. Returns the snapshot and its number of records.
+    """
+    snapshot, path, output, columns, compresslevel, traversal, tagged, cache = task
+    nstree = NextStrainParser.from_file_path(
+        path, stream=streaming_json_available(), index_cache=cache
+    )
+    nstree.release_json()
+    part = output + ".part"
+    writer = ParseNextStrain._tsv_writer(
+        part,
+        header=not tagged,
+        compress=output.endswith(".gz"),
+        compresslevel=compresslevel,
+        columns=["snapshot"] + columns if tagged else columns,
+    )
+    with writer:
+        for record in nstree.mutation_traversal_generator(**traversal):
+            if tagged:
+                record["snapshot"] = snapshot
+            writer.write(record)
+    os.replace(part, output)
+    return snapshot, writer.total
+
+
+def comma_list(value: str) -> List[str]:
+    """argparse type parsing comma separated values."""
+    return [i for i in value.split(",") if i]
+
+
+def check_choices(option: str, items: List[str], choices: List[str]) -> None:
+    """Raises a `ValueError` if any of `items` is not one of `choices`."""
+    unknown = [i for i in items if i not in choices]
+    if unknown:
+        raise ValueError(
+            "{}: invalid choice: {} (choose from {})".format(
+                option, ", ".join(unknown), ", ".join(choices)
+            )
+        )
+
 
 class ParseNextStrain(Subcommand):
     @classmethod
     def __add_arguments__(cls, parser: ArgParserT):
         """Add the arguments to the parser"""
+        cls._add_source_arguments(parser)
+        cls._add_filter_arguments(parser)
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of worker processes. The tree is split into "
+            "balanced subtrees that are written in parallel and "
+            "concatenated in order [%(default)s].",
+        )
+        parser.add_argument(
+            "--format",
+            choices=OUTPUT_FORMATS,
+            default="tsv",
+            help="Output format. parquet and arrow write typed columns "
+            "(numeric num_date/div/age, list-typed mutations) and need "
+            "pyarrow; without it they fall back to npz, written with a .npz "
+            "extension, which needs numpy [%(default)s].",
+        )
+        parser.add_argument(
+            "--layout",
+            choices=LAYOUTS,
+            default="wide",
+            help="wide writes one row per node with its cumulative mutations. "
+            "normalized writes the output directory's nodes<suffix> table "
+            "(parent, name and attributes) and branch_mutations<suffix> "
+            "table (name, gene, mutation) with only each node's own "
+            "mutations [%(default)s].",
+        )
+        parser.add_argument(
+            "--tips-table",
+            action="store_true",
+            help="With --layout normalized, also write the cumulative "
+            "mutations of each tip to tip_mutations<suffix> (name, gene, "
+            "mutation).",
+        )
+        parser.add_argument(
+            "--compression-level",
+            type=int,
+            choices=range(1, 10),
+            default=DEFAULT_COMPRESSLEVEL,
+            metavar="{1..9}",
+            help="gzip compression level of .gz TSV outputs. Lower is faster, "
+            "higher is smaller [%(default)s].",
+        )
+        parser.add_argument(
+            "--columns",
+            type=comma_list,
+            default=None,
+            metavar="COLUMN,...",
+            help="Comma separated node attribute columns to write; parent and "
+            "name are always written. Any of: {} (or of the inferred "
+            "columns with --infer-schema) [all].".format(", ".join(NODE_ATTRS)),
+        )
+        parser.add_argument(
+            "--genes",
+            type=comma_list,
+            default=None,
+            metavar="GENE,...",
+            help="Comma separated genes whose mutations are collected and "
+            "written, e.g. --genes S. Mutations of other genes are never "
+            "accumulated; an empty value writes none. Any of: {} (or of the "
+            "inferred genes with --infer-schema) [all].".format(
+                ", ".join(MUTATION_KEYS)
+            ),
+        )
+        parser.add_argument(
+            "--previous",
+            type=str,
+            default=None,
+            help="Optional path to an earlier Nextstrain JSON. Only the rows "
+            "that were added, changed or removed since then are written, "
+            "with extra change_type and previous_name columns. Unchanged "
+            "subtrees are skipped.",
+        )
         parser.add_argument(
+            "--batch",
+            type=str,
+            default=None,
+            metavar="GLOB|@MANIFEST",
+            help="Process many local JSON snapshots in one run: a glob of "
+            "files, or @ followed by a manifest listing one path per line. "
+            "Each snapshot is written to <output>/<snapshot><suffix>, or "
+            "with --merge to the single output with a snapshot column. "
+            "--workers snapshots are processed at a time and finished ones "
+            "are skipped when the batch is run again.",
+        )
+        parser.add_argument(
+            "--merge",
+            action="store_true",
+            help="Write the --batch snapshots to one output with an extra "
+            "snapshot column instead of one output each.",
+        )
+        parser.add_argument(
+            "--shard-by",
+            type=str,
+            default=None,
+            metavar="ATTR|hash:N",
+            help="Write one TSV shard per value of the attribute column ATTR "
+            "(e.g. region or clade_membership), or N shards by a hash of "
+            "the node name, to <output>/<value><suffix>. A manifest.json "
+            "with the records, bytes and SHA-256 of each shard is written "
+            "next to them.",
+        )
+        parser.add_argument(
+            "--max-open-shards",
+            type=int,
+            default=DEFAULT_MAX_OPEN_SHARDS,
+            help="Number of --shard-by shards kept open at a time; the least "
+            "recently used is closed and later appended to [%(default)s].",
+        )
+        parser.add_argument(
+            "--suffix",
+            type=str,
+            default=".tsv.gz",
+            help="Suffix of the per-snapshot --batch outputs, the --shard-by "
+            "shards and the tsv tables of --layout normalized, .gz outputs "
+            "are compressed [%(default)s].",
+        )
+        parser.add_argument(
+            "output",
+            type=str,
+            help="Path to output file, - for TSV on stdout, or the output "
+            "directory of --batch, --shard-by and --layout normalized.",
+        )
+
+    @classmethod
+    def _add_source_arguments(cls, parser: ArgParserT):
+        """Adds the arguments selecting the Nextstrain JSON to read"""
+        source = parser.add_mutually_exclusive_group()
+        source.add_argument(
             "--json-path",
             type=str,
             default=None,
@@ -34,9 +291,124 @@ class ParseNextStrain(Subcommand):
             "downloaded from Nextstrain. If it doesn't "
             "exist, the file will be downloaded to this "
             "location. If no path is given, the JSON file "
-            "will not be saved locally.",
+            "will not be saved locally. - reads the JSON "
+            "(optionally gzipped) from stdin.",
+        )
+        source.add_argument(
+            "--cache-dir",
+            type=str,
+            default=None,
+            help="Optional directory to cache the downloaded Nextstrain JSON "
+            "in. The cached copy is revalidated on every run with a "
+            "conditional GET (ETag/Last-Modified) and only downloaded "
+            "again if it changed on the server.",
+        )
+        parser.add_argument(
+            "--decompress-json",
+            action="store_true",
+            help="Save the downloaded Nextstrain JSON decompressed. By default "
+            "the bytes are saved exactly as downloaded (usually gzipped); "
+            "gzipped files are detected automatically when read back.",
+        )
+        parser.add_argument(
+            "--url",
+            type=str,
+            default=NEXTSTRAIN_JSON_URL,
+            help="URL of the Nextstrain JSON to download [%(default)s].",
+        )
+        parser.add_argument(
+            "--infer-schema",
+            action="store_true",
+            help="Infer the attribute columns from the colorings and the gene "
+            "columns from the genome annotations in the JSON's meta instead "
+            "of using the built-in ncov columns.",
+        )
+        parser.add_argument(
+            "--index-cache",
+            type=str,
+            default=None,
+            help="Optional directory to cache the parsed tree in. The tree is "
+            "saved in a compact binary form keyed by the SHA-256 of the JSON "
+            "and memory mapped by later runs on the same JSON instead of "
+            "parsing it again.",
+        )
+        parser.add_argument(
+            "--index-cache-size",
+            type=int,
+            default=DEFAULT_MAX_BYTES >> 20,
+            metavar="MB",
+            help="Size limit of --index-cache; the least recently used trees "
+            "are evicted beyond it [%(default)s].",
+        )
+
+    @classmethod
+    def _add_filter_arguments(cls, parser: ArgParserT):
+        """Adds the node filter arguments"""
+        group = parser.add_argument_group(
+            "Node filters",
+            "Only nodes matching all filters are reported. Filters are applied "
+            "before any mutations are collected and subtrees without a match "
+            "are skipped.",
+        )
+        group.add_argument(
+            "--tips-only",
+            action="store_true",
+            help="Only report tips (sampled sequences), not internal nodes.",
+        )
+        group.add_argument(
+            "--where",
+            action="append",
+            default=[],
+            metavar="ATTR=VALUE",
+            help="Only report nodes whose attribute ATTR (one of the "
+            "attribute columns) is VALUE; NA matches missing "
+            "values. Repeat to filter on more attributes, repeating an "
+            "attribute accepts any of its values.",
+        )
+        group.add_argument(
+            "--region",
+            action="append",
+            default=[],
+            help="Only report nodes of this region, same as --where region=REGION.",
+        )
+        group.add_argument(
+            "--num-date-range",
+            type=float,
+            nargs=2,
+            default=None,
+            metavar=("MIN", "MAX"),
+            help="Only report nodes with MIN <= num_date <= MAX (decimal years).",
+        )
+
+    @classmethod
+    def _node_filter(
+        cls, options: NamespaceT, schema: Optional[NextStrainSchema] = None
+    ) -> Optional[NodeFilter]:
+        """
+        Returns the node filter of the options, None if there is none.
+        `--where` attributes are checked against the `schema` (by default
+        the built-in columns).
+        """
+        attr_keys = (schema or NextStrainSchema.default()).attr_keys
+        where = {}
+        for item in options.where:
+            key, sep, value = item.partition("=")
+            if not sep or key not in attr_keys:
+                raise ValueError(
+                    "--where expects ATTR=VALUE with ATTR one of {}, got '{}'".format(
+                        ", ".join(attr_keys), item
+                    )
+                )
+            where.setdefault(key, []).append(value)
+        if options.region:
+            where.setdefault("region", []).extend(options.region)
+        if not (options.tips_only or where or options.num_date_range):
+            return None
+        return NodeFilter(
+            tips_only=options.tips_only,
+            where=where,
+            num_date_range=options.num_date_range,
         )
-        parser.add_argument("output", type=str, help="Path to output TSV file.")
 
     @classmethod
     def main(cls, options: NamespaceT) -> None:
@@ -46,40 +418,619 @@ class ParseNextStrain(Subcommand):
         logger = Logger.get_logger(cls.__tool_name__())
         logger.info(cls.__get_description__())
 
+        metrics = cls.get_metrics(options)
+        if options.batch is not None:
+            cls._main_batch(options, logger, metrics)
+            return
+        normalized = options.layout == "normalized"
+        if options.tips_table and not normalized:
+            raise ValueError("--tips-table needs --layout normalized")
+        if normalized and (options.previous is not None or options.shard_by):
+            raise ValueError(
+                "--layout normalized can't be combined with --previous or --shard-by"
+            )
+        if options.output == STDIO_PATH and (
+            normalized or options.shard_by or options.format != "tsv"
+        ):
+            raise ValueError("Only wide tsv layouts can be written to stdout")
+        if options.previous == STDIO_PATH:
+            raise ValueError("--previous can't be read from stdin")
+        partition_key, partition = None, None
+        if options.shard_by is not None:
+            if options.format != "tsv":
+                raise ValueError("--shard-by only writes tsv")
+            partition_key, partition = cls._shard_partition(options.shard_by)
+        if options.infer_schema:
+            schema = None
+        else:
+            schema = cls._check_schema(options, NextStrainSchema.default())
+
         # Get json
         run_download, dl_location = cls._setup_download(options.json_path, logger)
 
-        nstree = cls._load_nextstrain_json(run_download, dl_location)
+        with metrics.stage("load") as stage:
+            nstree = cls._load_nextstrain_json(
+                run_download,
+                dl_location,
+                options.url,
+                options.cache_dir,
+                save_compressed=not options.decompress_json,
+                infer_schema=options.infer_schema,
+                index_cache=cls._index_cache(options),
+            )
+            stage.records = len(nstree.index)
+        if schema is None:
+            schema = cls._check_schema(options, nstree.index.schema)
+            logger.info(
+                "Inferred {} attribute and {} gene columns.".format(
+                    len(schema.attr_keys), len(schema.genes)
+                )
+            )
+        node_filter = cls._node_filter(options, schema)
+        if node_filter is not None and options.previous is not None:
+            raise ValueError("Node filters can't be combined with --previous")
+        if node_filter is not None and normalized:
+            raise ValueError("Node filters can't be combined with --layout normalized")
+
+        # The partition attribute is collected even if it isn't written
+        attr_keys = options.columns
+        if partition_key is not None and attr_keys is not None:
+            if partition_key not in attr_keys:
+                attr_keys = attr_keys + [partition_key]
+        traversal = {
+            "node_filter": node_filter,
+            "attr_keys": attr_keys,
+            "genes": options.genes,
+        }
+        columns = cls.colnames(options.columns, options.genes, schema)
+        records = None
+        if options.previous is not None:
+            with metrics.stage("load_previous") as stage:
+                previous = NextStrainParser.from_file_path(
+                    options.previous,
+                    stream=streaming_json_available(),
+                    infer_schema=options.infer_schema,
+                    index_cache=cls._index_cache(options),
+                ).index
+                stage.records = len(previous)
+            logger.info("Writing the changes since {}".format(options.previous))
+            columns = cls.diff_colnames(options.columns, options.genes, schema)
+            records = nstree.diff_traversal_generator(
+                previous, attr_keys=attr_keys, genes=options.genes
+            )
 
-        logger.info("Parsed data will be written to {}".format(options.output))
-        ofunc = gzip.open if options.output.endswith(".gz") else open
+        logger.info(
+            "Parsed data will be written to {}".format(
+                "stdout" if options.output == STDIO_PATH else options.output
+            )
+        )
+        if normalized:
+            if options.workers > 1:
+                logger.warning(
+                    "--workers is not supported with --layout normalized, "
+                    "writing serially"
+                )
+            total = cls._write_normalized(nstree, options, schema, logger, metrics)
+            logger.info("Completed. Parsed {} records.".format(total))
+            return
+        parallel = options.workers > 1 and options.format == "tsv"
+        if options.workers > 1 and not parallel:
+            logger.warning("--workers is only supported for tsv, writing serially")
+        elif parallel and options.output == STDIO_PATH:
+            logger.warning("--workers is not supported with stdout, writing serially")
+            parallel = False
+        elif parallel and partition is not None:
+            logger.warning(
+                "--workers is not supported with --shard-by, writing serially"
+            )
+            parallel = False
+        elif parallel and records is not None:
+            logger.warning(
+                "--workers is not supported with --previous, writing serially"
+            )
+            parallel = False
+        with metrics.stage("write") as stage:
+            if parallel:
+                total = cls._write_parallel(
+                    nstree,
+                    options.output,
+                    options.workers,
+                    logger,
+                    compresslevel=options.compression_level,
+                    columns=columns,
+                    **traversal
+                )
+            elif partition is not None:
+                writer = ShardedRecordWriter(
+                    options.output,
+                    partition,
+                    columns,
+                    numeric=schema.numeric,
+                    lists=schema.genes,
+                    suffix=options.suffix,
+                    compresslevel=options.compression_level,
+                    max_open=options.max_open_shards,
+                    metadata={"shard_by": options.shard_by},
+                )
+                total = cls._write_serial(
+                    nstree, writer, logger, records=records, **traversal
+                )
+                logger.info(
+                    "Wrote {} shards and their manifest.".format(len(writer.counts))
+                )
+            else:
+                writer = open_record_writer(
+                    options.output,
+                    options.format,
+                    columns,
+                    numeric=schema.numeric,
+                    lists=schema.genes,
+                    compresslevel=options.compression_level,
+                )
+                total = cls._write_serial(
+                    nstree, writer, logger, records=records, **traversal
+                )
+            stage.records = total
+        logger.info("Completed. Parsed {} records.".format(total))
+
+    @classmethod
+    def _main_batch(
+        cls, options: NamespaceT, logger: LoggerT, metrics: Metrics
+    ) -> None:
+        """
+        Processes the snapshots of --batch on a pool of --workers processes.
+        Every finished snapshot is recorded in a progress file next to its
+        output (`BATCH_PROGRESS`), so a rerun of a crashed batch skips the
+        snapshots that are done and whose input did not change since. With
+        --merge the snapshots are written to parts that are concatenated in
+        input order once all are done.
+        """
+        if options.output == STDIO_PATH:
+            raise ValueError("--batch needs an output directory, not stdout")
+        if (
+            options.json_path
+            or options.cache_dir
+            or options.previous
+            or options.shard_by
+        ):
+            raise ValueError(
+                "--batch can't be combined with --json-path, --cache-dir, "
+                "--previous or --shard-by"
+            )
+        if options.infer_schema or options.format != "tsv" or options.layout != "wide":
+            raise ValueError(
+                "--batch only writes wide tsv layouts with the built-in columns"
+            )
+        schema = cls._check_schema(options, NextStrainSchema.default())
+        node_filter = cls._node_filter(options, schema)
+        columns = cls.colnames(options.columns, options.genes)
+        traversal = {
+            "node_filter": node_filter,
+            "attr_keys": options.columns,
+            "genes": options.genes,
+        }
+        snapshots = cls.batch_inputs(options.batch)
+        if options.merge:
+            workdir = options.output + ".parts"
+            suffix = ".tsv.gz" if options.output.endswith(".gz") else ".tsv"
+        else:
+            workdir = options.output
+            suffix = options.suffix
+        outputs = {name: os.path.join(workdir, name + suffix) for name, _ in snapshots}
+        os.makedirs(workdir, exist_ok=True)
+
+        progress_path = os.path.join(workdir, BATCH_PROGRESS)
+        done = cls._read_progress(progress_path)
+        index_cache = cls._index_cache(options)
+        tasks = []
+        for name, path in snapshots:
+            entry = done.get(name)
+            if (
+                entry is not None
+                and entry["path"] == path
+                and entry["signature"] == cls._file_signature(path)
+                and os.path.isfile(outputs[name])
+            ):
+                continue
+            done.pop(name, None)
+            tasks.append(
+                (
+                    name,
+                    path,
+                    outputs[name],
+                    columns,
+                    options.compression_level,
+                    traversal,
+                    options.merge,
+                    index_cache,
+                )
+            )
+        logger.info(
+            "Processing {} of {} snapshots, {} already done.".format(
+                len(tasks), len(snapshots), len(snapshots) - len(tasks)
+            )
+        )
+
+        with metrics.stage("batch") as stage, open(progress_path, "at") as progress:
+            paths = dict(snapshots)
+            stage.records = 0
+            for name, count in cls._run_batch(tasks, options.workers):
+                path = paths[name]
+                done[name] = {
+                    "snapshot": name,
+                    "path": path,
+                    "signature": cls._file_signature(path),
+                    "records": count,
+                }
+                progress.write(json.dumps(done[name]) + "\n")
+                progress.flush()
+                stage.records += count
+                logger.info(
+                    "Parsed {} records of {} ({}/{}).".format(
+                        count, name, len(done), len(snapshots)
+                    )
+                )
+        total = sum(done[name]["records"] for name, _ in snapshots)
+
+        if options.merge:
+            with metrics.stage("merge") as stage:
+                logger.info("Merging the snapshots into {}".format(options.output))
+                part = options.output + ".part"
+                with cls._tsv_writer(
+                    part,
+                    compress=options.output.endswith(".gz"),
+                    compresslevel=options.compression_level,
+                    columns=["snapshot"] + columns,
+                ):
+                    pass
+                with open(part, "ab") as o:
+                    for name, _ in snapshots:
+                        with open(outputs[name], "rb") as fh:
+                            shutil.copyfileobj(fh, o, 1 << 20)
+                os.replace(part, options.output)
+                shutil.rmtree(workdir, ignore_errors=True)
+                stage.records = total
+        logger.info(
+            "Completed. Parsed {} records of {} snapshots.".format(
+                total, len(snapshots)
+            )
+        )
+
+    @classmethod
+    def _run_batch(
+        cls, tasks: List[Tuple[Any, ...]], workers: int
+    ) -> Iterator[Tuple[str, int]]:
+        """
+        Yields the snapshot and record count of each task as it finishes,
+        running them in this process if there is a single worker.
+        """
+        if workers <= 1 or len(tasks) <= 1:
+            for task in tasks:
+                yield _write_snapshot(task)
+            return
+        with multiprocessing.Pool(min(workers, len(tasks))) as pool:
+            yield from pool.imap_unordered(_write_snapshot, tasks)
+
+    @classmethod
+    def batch_inputs(cls, source: str) -> List[Tuple[str, str]]:
+        """
+        Returns the `(snapshot, path)` of the inputs of --batch, a glob or
+        `@` followed by a manifest path. Manifests list one path per line,
+        relative to the manifest; blank lines and `#` comments are skipped.
+        Snapshots are named after their file without the .json/.gz
+        extensions.
+        """
+        if source.startswith("@"):
+            manifest = source[1:]
+            base = os.path.dirname(manifest)
+            with open(manifest, "rt") as fh:
+                lines = [line.strip() for line in fh]
+            paths = [
+                os.path.join(base, line)
+                for line in lines
+                if line and not line.startswith("#")
+            ]
+        else:
+            paths = sorted(glob.glob(source))
+        if not paths:
+            raise ValueError("No input files for --batch {}".format(source))
+
+        res = []
+        for path in paths:
+            name = os.path.basename(path)
+            for ext in (".gz", ".json"):
+                if name.endswith(ext):
+                    name = name[: -len(ext)]
+            res.append((name, path))
+        names = [name for name, _ in res]
+        duplicated = sorted(set(i for i in names if names.count(i) > 1))
+        if duplicated:
+            raise ValueError(
+                "Duplicated snapshot names: {}".format(", ".join(duplicated))
+            )
+        return res
+
+    @staticmethod
+    def _file_signature(path: str) -> List[int]:
+        """Size and modification time of a file, to detect changed inputs."""
+        st = os.stat(path)
+        return [st.st_size, st.st_mtime_ns]
+
+    @staticmethod
+    def _read_progress(path: str) -> Dict[str, Dict[str, Any]]:
+        """
+        Reads the finished snapshots of a --batch progress file. A line
+        truncated by a crash is ignored.
+        """
+        done = {}
+        if os.path.isfile(path):
+            with open(path, "rt") as fh:
+                for line in fh:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    done[entry["snapshot"]] = entry
+        return done
+
+    @classmethod
+    def _check_schema(
+        cls, options: NamespaceT, schema: NextStrainSchema
+    ) -> NextStrainSchema:
+        """
+        Checks that the options only select columns of the schema and
+        returns it.
+        """
+        if options.columns is not None:
+            check_choices("--columns", options.columns, schema.attr_keys)
+        if options.genes is not None:
+            check_choices("--genes", options.genes, schema.genes)
+        shard_by = getattr(options, "shard_by", None)
+        if shard_by is not None and not shard_by.startswith(HASH_SHARD):
+            check_choices("--shard-by", [shard_by], schema.attr_keys)
+        return schema
+
+    @classmethod
+    def _shard_partition(
+        cls, shard_by: str
+    ) -> Tuple[Optional[str], Callable[[Dict[str, Any]], str]]:
+        """
+        Returns the attribute read by a --shard-by partitioning (None for
+        `hash:N`) and the function returning the partition of a record.
+        Attribute partitions are the attribute's value, NA if missing.
+        `hash:N` partitions are `part-00000` to `part-<N-1>` by the CRC-32
+        of the node name, so a node stays in its shard across runs.
+        """
+        if not shard_by.startswith(HASH_SHARD):
+
+            def by_attr(record):
+                value = record[shard_by]
+                return "NA" if value is None else str(value)
+
+            return shard_by, by_attr
+
+        count = shard_by[len(HASH_SHARD) :]
+        if not count.isdigit() or int(count) < 1:
+            raise ValueError(
+                "--shard-by expects hash:N with N > 0, got '{}'".format(shard_by)
+            )
+        count = int(count)
+
+        def by_hash(record):
+            return "part-{:05d}".format(
+                zlib.crc32(record["name"].encode("utf-8")) % count
+            )
+
+        return None, by_hash
+
+    @classmethod
+    def _index_cache(cls, options: NamespaceT) -> Optional[IndexCache]:
+        """Returns the index cache of the options, None if there is none."""
+        if options.index_cache is None:
+            return None
+        return IndexCache(options.index_cache, options.index_cache_size << 20)
+
+    @classmethod
+    def _tsv_writer(
+        cls,
+        output: Union[str, TextIO],
+        header: bool = True,
+        compress: Optional[bool] = None,
+        compresslevel: int = DEFAULT_COMPRESSLEVEL,
+        columns: Optional[List[str]] = None,
+        schema: Optional[NextStrainSchema] = None,
+    ) -> TsvRecordWriter:
+        """
+        Returns a TSV writer for the output columns (by default all) of the
+        `schema` (by default the built-in columns).
+        """
+        schema = NextStrainSchema.default() if schema is None else schema
+        return TsvRecordWriter(
+            output,
+            cls.colnames(schema=schema) if columns is None else columns,
+            schema.numeric,
+            schema.genes,
+            header=header,
+            compress=compress,
+            compresslevel=compresslevel,
+        )
+
+    @classmethod
+    def _write_normalized(
+        cls,
+        nstree: NextStrainParser,
+        options: NamespaceT,
+        schema: NextStrainSchema,
+        logger: LoggerT,
+        metrics: Metrics,
+    ) -> int:
+        """
+        Writes the tables of --layout normalized to the output directory:
+        `nodes` (parent, name and attributes), `branch_mutations` (each
+        node's own mutations) and, with --tips-table, `tip_mutations` (the
+        cumulative mutations of the tips). Returns the number of records of
+        all tables.
+        """
+        suffix = options.suffix if options.format == "tsv" else "." + options.format
+        os.makedirs(options.output, exist_ok=True)
+        tables = [
+            (
+                "nodes",
+                cls.colnames(options.columns, [], schema),
+                nstree.mutation_traversal_generator(
+                    attr_keys=options.columns, genes=[]
+                ),
+            ),
+            (
+                "branch_mutations",
+                MUTATION_COLUMNS,
+                nstree.branch_mutation_generator(options.genes),
+            ),
+        ]
+        if options.tips_table:
+            tables.append(
+                (
+                    "tip_mutations",
+                    MUTATION_COLUMNS,
+                    nstree.tip_mutation_generator(options.genes),
+                )
+            )
+        total = 0
+        for table, columns, records in tables:
+            path = os.path.join(options.output, table + suffix)
+            with metrics.stage("write_" + table) as stage:
+                logger.info("Writing the {} table to {}".format(table, path))
+                writer = open_record_writer(
+                    path,
+                    options.format,
+                    columns,
+                    numeric=schema.numeric,
+                    compresslevel=options.compression_level,
+                )
+                stage.records = cls._write_serial(
+                    nstree, writer, logger, records=records
+                )
+            total += stage.records
+        return total
+
+    @classmethod
+    def _write_serial(
+        cls,
+        nstree: NextStrainParser,
+        writer: RecordWriter,
+        logger: LoggerT,
+        records: Optional[Iterator[Dict[str, Any]]] = None,
+        **traversal
+    ) -> int:
+        """
+        Traverses the tree and writes all records in this process, or only
+        the given `records` (e.g. of a diff traversal). `traversal` are the
+        node filter and projection options of
+        `NextStrainParser.mutation_traversal_generator`.
+        """
+        if records is None:
+            records = nstree.mutation_traversal_generator(**traversal)
         total = 0
-        with ofunc(options.output, "wt") as o:
-            o.write("\t".join(cls.colnames()) + "\n")
-            for record in nstree.mutation_traversal_generator():
+        with writer:
+            for record in records:
                 if total > 0 and total % 1000 == 0:
                     logger.info("Parsed {} records.".format(total))
-                cls._write_record(record, o)
+                writer.write(record)
                 total += 1
-        logger.info("Completed. Parsed {} records.".format(total))
+        return total
+
+    @classmethod
+    def _write_parallel(
+        cls,
+        nstree: NextStrainParser,
+        output: str,
+        workers: int,
+        logger: LoggerT,
+        compresslevel: int = DEFAULT_COMPRESSLEVEL,
+        columns: Optional[List[str]] = None,
+        **traversal
+    ) -> int:
+        """
+        Splits the traversal order into contiguous chunks (subtrees whose
+        roots inherit their ancestors' mutations) that worker processes
+        write to temporary files. The chunks are appended to the output in
+        order as they complete, so the result is identical to a serial run.
+        Gzipped chunks are separate gzip members, which concatenate into a
+        valid gzip file. `traversal` are passed on to
+        `NextStrainParser.mutation_traversal_generator`.
+        """
+        index = nstree.index
+        # Computed before the workers start so they inherit them.
+        index.order
+        index.duplicates
+        index.mutation_ids
+        if traversal.get("node_filter") is not None:
+            traversal["node_filter"].masks(index)
+
+        n = len(index)
+        nchunks = max(1, min(n, workers * CHUNKS_PER_WORKER))
+        bounds = [n * i // nchunks for i in range(nchunks + 1)]
+        compress = output.endswith(".gz")
+        tmpdir = tempfile.mkdtemp(
+            prefix=".{}-".format(cls.__tool_name__()),
+            dir=os.path.dirname(os.path.abspath(output)),
+        )
+        tasks = []
+        for i in range(nchunks):
+            path = os.path.join(tmpdir, "chunk{}".format(i))
+            tasks.append(
+                (bounds[i], bounds[i + 1], path, compress, compresslevel, columns)
+            )
+        logger.info("Writing {} chunks with {} workers.".format(nchunks, workers))
+
+        total = 0
+        try:
+            with cls._tsv_writer(
+                output,
+                compresslevel=compresslevel,
+                columns=columns,
+                schema=index.schema,
+            ):
+                pass
+            with multiprocessing.Pool(
+                workers, initializer=_init_worker, initargs=(nstree, traversal)
+            ) as pool, open(output, "ab") as o:
+                for task, count in zip(tasks, pool.imap(_write_chunk, tasks)):
+                    with open(task[2], "rb") as fh:
+                        shutil.copyfileobj(fh, o, 1 << 20)
+                    os.remove(task[2])
+                    total += count
+                    logger.info("Parsed {} records.".format(total))
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        return total
 
     @classmethod
-    def colnames(cls) -> List[str]:
-        """Returns a list of the column names"""
-        return ["parent", "name"] + NODE_ATTRS + MUTATION_KEYS
+    def colnames(
+        cls,
+        attr_keys: Optional[List[str]] = None,
+        genes: Optional[List[str]] = None,
+        schema: Optional[NextStrainSchema] = None,
+    ) -> List[str]:
+        """
+        Returns a list of the column names of the `schema` (by default the
+        built-in columns), optionally only with the selected attribute and
+        gene columns.
+        """
+        schema = NextStrainSchema.default() if schema is None else schema
+        attr_keys = schema.attr_keys if attr_keys is None else attr_keys
+        genes = schema.genes if genes is None else genes
+        return ["parent", "name"] + list(attr_keys) + list(genes)
 
     @classmethod
-    def _write_record(cls, record: Dict[str, Any], o: TextIO) -> None:
-        """Formats and writes mutation traversal record to file."""
-        row = []
-        for key in cls.colnames():
-            if record[key] is None:
-                row.append("NA")
-            elif isinstance(record[key], list):
-                row.append(",".join([str(i) for i in record[key]]))
-            else:
-                row.append(str(record[key]))
-        o.write("\t".join(row) + "\n")
+    def diff_colnames(
+        cls,
+        attr_keys: Optional[List[str]] = None,
+        genes: Optional[List[str]] = None,
+        schema: Optional[NextStrainSchema] = None,
+    ) -> List[str]:
+        """Returns a list of the column names of --previous outputs"""
+        return ["change_type", "previous_name"] + cls.colnames(attr_keys, genes, schema)
 
     @classmethod
     def _setup_download(
@@ -88,7 +1039,10 @@ class ParseNextStrain(Subcommand):
         """Determines if download needs to happen and where it should go."""
         run_download = True
         dl_location = json_path
-        if json_path and os.path.isfile(json_path):
+        if json_path == STDIO_PATH:
+            logger.info("Reading JSON from stdin")
+            run_download = False
+        elif json_path and os.path.isfile(json_path):
             logger.info("Found pre-existing JSON, skipping download")
             run_download = False
         elif json_path is not None:
@@ -99,23 +1053,51 @@ class ParseNextStrain(Subcommand):
 
     @classmethod
     def _load_nextstrain_json(
-        cls, run_download: bool, dl_location: Optional[str]
+        cls,
+        run_download: bool,
+        dl_location: Optional[str],
+        url: Optional[str] = None,
+        cache_dir: Optional[str] = None,
+        save_compressed: bool = True,
+        infer_schema: bool = False,
+        index_cache: Optional[IndexCache] = None,
     ) -> NextStrainParser:
         """
         Performs the actual loading of the JSON file into a `NextStrainParser`
-        instance. Caution this implementation is dangerous because some member
-        functions of the `NextStrainParser` mutate the loaded JSON, so you must
-        write out the json *before* calling other functions. I discuss different
-        implementations in the `NextStrainParser` class.
+        instance. Downloads are streamed to `dl_location` (or revalidated
+        against `cache_dir`) while they are parsed, keeping the downloaded
+        bytes as they are unless `save_compressed` is False. Once the tree
+        index is built the deserialized JSON is released, since traversals
+        only use the index. If the optional `ijson` package is installed, the
+        JSON is parsed incrementally straight into the index. With
+        `infer_schema` the columns are inferred from the JSON's `meta`. With
+        an `index_cache` the index is loaded from, or saved to, the cache,
+        except for stdin (`dl_location` `-`).
         """
+        stream = streaming_json_available()
+        if dl_location == STDIO_PATH and index_cache is not None:
+            logger = Logger.get_logger(cls.__tool_name__())
+            logger.warning("--index-cache is not used when reading stdin")
+            index_cache = None
         if run_download:
-            ns_obj = NextStrainParser.from_url()
-            if dl_location:
-                with open(dl_location, "wt") as o:
-                    json.dump(ns_obj.obj, o, sort_keys=True, indent=2)
+            ns_obj = NextStrainParser.from_url(
+                url,
+                stream=stream,
+                save_path=dl_location,
+                cache_dir=cache_dir,
+                save_compressed=save_compressed,
+                infer_schema=infer_schema,
+                index_cache=index_cache,
+            )
         else:
-            ns_obj = NextStrainParser.from_file_path(dl_location)
+            ns_obj = NextStrainParser.from_file_path(
+                dl_location,
+                stream=stream,
+                infer_schema=infer_schema,
+                index_cache=index_cache,
+            )
 
+        ns_obj.release_json()
         return ns_obj
 
     @classmethod
@@ -0,0 +1,125 @@
+"""Finds the nodes of a nextstrain JSON tree carrying a combination of
+mutations, optionally filtered by node attributes.
+
+@author: Kyle Hernandez <kmhernan@uchicago.edu>
+"""
+import sys
+import time
+
+from typing import List, Optional
+
+from dmwg_data_pyutils.common.logger import Logger
+from dmwg_data_pyutils.common.types import ArgParserT, NamespaceT
+from dmwg_data_pyutils.common.nextstrain import NextStrainSchema
+from dmwg_data_pyutils.common.writers import TsvRecordWriter
+
+from dmwg_data_pyutils.subcommands.nextstrain_json import ParseNextStrain
+
+
+class QueryNextStrain(ParseNextStrain):
+    @classmethod
+    def __add_arguments__(cls, parser: ArgParserT):
+        """Add the arguments to the parser"""
+        cls._add_source_arguments(parser)
+        cls._add_filter_arguments(parser)
+        parser.add_argument(
+            "--count",
+            action="store_true",
+            help="Only print the number of matching nodes.",
+        )
+        parser.add_argument(
+            "--output",
+            type=str,
+            default=None,
+            help="Path to the output TSV (.gz is compressed), - for stdout. "
+            "Matching nodes are printed to stdout by default.",
+        )
+        parser.add_argument(
+            "query",
+            type=str,
+            nargs="?",
+            default=None,
+            help="Mutation query, e.g. 'S:N501Y AND ORF1a:T1001I'. Terms are "
+            "gene:mutation and can be combined with AND, OR, NOT and "
+            "parentheses. All nodes match if no query is given.",
+        )
+
+    @classmethod
+    def main(cls, options: NamespaceT) -> None:
+        """
+        Entrypoint for QueryNextStrain.
+        """
+        logger = Logger.get_logger(cls.__tool_name__())
+        logger.info(cls.__get_description__())
+
+        metrics = cls.get_metrics(options)
+        if not options.infer_schema:
+            cls._node_filter(options)
+
+        run_download, dl_location = cls._setup_download(options.json_path, logger)
+        with metrics.stage("load") as stage:
+            nstree = cls._load_nextstrain_json(
+                run_download,
+                dl_location,
+                options.url,
+                options.cache_dir,
+                save_compressed=not options.decompress_json,
+                infer_schema=options.infer_schema,
+                index_cache=cls._index_cache(options),
+            )
+            stage.records = len(nstree.index)
+        schema = nstree.index.schema
+        node_filter = cls._node_filter(options, schema)
+
+        with metrics.stage("index") as stage:
+            nstree.mutation_index
+            stage.records = len(nstree.index)
+
+        with metrics.stage("query") as stage:
+            start = time.perf_counter()
+            matches = list(nstree.query(options.query, node_filter=node_filter))
+            stage.records = len(matches)
+        logger.info(
+            "Found {} matching nodes in {:.1f} ms.".format(
+                len(matches), (time.perf_counter() - start) * 1000
+            )
+        )
+
+        if options.count:
+            print(len(matches), file=sys.stdout)
+            return
+
+        index = nstree.index
+        writer = TsvRecordWriter(
+            options.output if options.output is not None else sys.stdout,
+            cls.query_colnames(schema),
+            schema.numeric,
+            [],
+        )
+        with writer:
+            for idx in matches:
+                node = index.node(idx)
+                parent = node.parent
+                dat = node.attrs
+                dat["name"] = node.name
+                dat["parent"] = node.name if parent is None else parent.name
+                writer.write(dat)
+
+    @classmethod
+    def query_colnames(cls, schema: Optional[NextStrainSchema] = None) -> List[str]:
+        """
+        Returns a list of the column names of the `schema` (by default the
+        built-in columns).
+        """
+        schema = NextStrainSchema.default() if schema is None else schema
+        return ["parent", "name"] + schema.attr_keys
+
+    @classmethod
+    def __get_description__(cls):
+        """
+        Tool description.
+        """
+        return (
+            "Finds the nodes of the nextstrain JSON tree carrying a "
+            "combination of mutations, optionally filtered by node attributes."
+        )
@@ -8,7 +8,12 @@ setup(
     description = "Utility tools for data munging",
     license = "Apache 2.0",
     packages = find_packages(),
-    python_requires='>=3.5',
+    python_requires='>=3.7',
+    extras_require = {
+        "stream": ["ijson>=3.1"],
+        "arrow": ["pyarrow"],
+        "npz": ["numpy"],
+    },
     entry_points= ''' 
         [console_scripts]
         dmwg-data-pyutils=dmwg_data_pyutils.__main__:main
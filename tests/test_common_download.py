@@ -0,0 +1,152 @@
+"""Tests the `dmwg_data_pyutils.common.download` module"""
+import unittest
+import tempfile
+import gzip
+import json
+import io
+import os
+import hashlib
+
+from dmwg_data_pyutils.common.download import DownloadStream, DownloadCache
+from dmwg_data_pyutils.common.nextstrain import NextStrainParser
+from dmwg_data_pyutils.common.io import streaming_json_available
+
+from utils import captured_output, cleanup_files, serve_bodies
+from test_common_nextstrain import build_test_tree
+
+
+class TestDownloadStream(unittest.TestCase):
+    to_remove = []
+
+    def test_plain(self):
+        raw = b"0123456789" * 1000
+        with DownloadStream(io.BytesIO(raw), chunk_size=7) as fh:
+            self.assertEqual(fh.read(), raw)
+            self.assertEqual(fh.bytes_read, len(raw))
+
+    def test_gzip_members_and_save(self):
+        raw = b"0123456789" * 1000
+        data = gzip.compress(raw[:5000]) + gzip.compress(raw[5000:])
+        (fd, fn) = tempfile.mkstemp()
+        self.to_remove.append(fn)
+        with DownloadStream(io.BytesIO(data), save_path=fn, chunk_size=100) as fh:
+            # Only read the head, the rest is drained on exit
+            self.assertEqual(fh.read(10), raw[:10])
+            self.assertTrue(os.path.exists(fn + ".part"))
+        with open(fn, "rb") as fh:
+            self.assertEqual(fh.read(), data)
+        self.assertFalse(os.path.exists(fn + ".part"))
+
+        with DownloadStream(io.BytesIO(data), save_path=fn, save_compressed=False):
+            pass
+        with open(fn, "rb") as fh:
+            self.assertEqual(fh.read(), raw)
+
+    def test_abort_removes_partial(self):
+        fn = os.path.join(tempfile.mkdtemp(), "out.json")
+        self.to_remove.append(fn)
+        with self.assertRaises(ValueError):
+            with DownloadStream(io.BytesIO(b"abc"), save_path=fn) as fh:
+                fh.read(1)
+                raise ValueError()
+        self.assertFalse(os.path.exists(fn))
+        self.assertFalse(os.path.exists(fn + ".part"))
+
+    def test_reader_error(self):
+        class Broken(io.RawIOBase):
+            def read(self, size=-1):
+                raise OSError("connection reset")
+
+        with self.assertRaises(OSError):
+            with DownloadStream(Broken()) as fh:
+                fh.read()
+
+    def tearDown(self):
+        cleanup_files(TestDownloadStream.to_remove)
+
+
+class TestDownloadCache(unittest.TestCase):
+    def test_store_lookup(self):
+        cache = DownloadCache(tempfile.mkdtemp())
+        url = "http://localhost/ncov_global.json"
+        path = cache.path_for(url)
+        self.assertTrue(path.endswith("-ncov_global.json"))
+        self.assertIsNone(cache.lookup(url))
+        self.assertEqual(cache.conditional_headers(url), {})
+
+        with open(path, "wb") as o:
+            o.write(b"abc")
+        headers = {"ETag": '"1"', "Last-Modified": "Mon, 01 Jun 2020 00:00:00 GMT"}
+        cache.store(url, headers, 3, hashlib.sha256(b"abc").hexdigest())
+        self.assertEqual(cache.lookup(url)["etag"], '"1"')
+        self.assertEqual(
+            cache.conditional_headers(url),
+            {
+                "If-None-Match": '"1"',
+                "If-Modified-Since": "Mon, 01 Jun 2020 00:00:00 GMT",
+            },
+        )
+
+        # Truncated or changed files are not revalidated
+        with open(path, "wb") as o:
+            o.write(b"abd")
+        self.assertIsNone(cache.lookup(url))
+        self.assertEqual(cache.conditional_headers(url), {})
+        with open(path, "wb") as o:
+            o.write(b"ab")
+        self.assertIsNone(cache.lookup(url))
+        self.assertIsNone(cache.lookup("http://localhost/other.json"))
+
+
+class TestFromUrl(unittest.TestCase):
+    to_remove = []
+
+    def _check_from_url(self, stream):
+        raw = json.dumps(build_test_tree()).encode("utf-8")
+        exp = list(NextStrainParser(build_test_tree()).mutation_traversal_generator())
+        bodies = {"/plain.json": raw, "/ncov.json": gzip.compress(raw)}
+        with serve_bodies(bodies) as url:
+            for path in bodies:
+                fn = os.path.join(tempfile.mkdtemp(), "saved.json")
+                self.to_remove.append(fn)
+                res = NextStrainParser.from_url(url + path, stream=stream, save_path=fn)
+                self.assertEqual(list(res.mutation_traversal_generator()), exp)
+                with open(fn, "rb") as fh:
+                    self.assertEqual(fh.read(), bodies[path])
+                res = NextStrainParser.from_file_path(fn, stream=stream)
+                self.assertEqual(list(res.mutation_traversal_generator()), exp)
+
+    def test_from_url(self):
+        self._check_from_url(False)
+
+    @unittest.skipIf(not streaming_json_available(), "ijson is not installed")
+    def test_from_url_stream(self):
+        self._check_from_url(True)
+
+    def test_from_url_cache(self):
+        raw = json.dumps(build_test_tree()).encode("utf-8")
+        exp = list(NextStrainParser(build_test_tree()).mutation_traversal_generator())
+        cache_dir = tempfile.mkdtemp()
+        bodies = {"/ncov.json": gzip.compress(raw)}
+        with serve_bodies(bodies) as url:
+            for i in range(2):
+                with captured_output() as (_, stderr):
+                    res = NextStrainParser.from_url(
+                        url + "/ncov.json", cache_dir=cache_dir
+                    )
+                self.assertEqual(list(res.mutation_traversal_generator()), exp)
+                self.assertEqual("Not modified" in stderr.getvalue(), i == 1)
+
+            bodies["/ncov.json"] = gzip.compress(raw + b" ")
+            with captured_output() as (_, stderr):
+                NextStrainParser.from_url(url + "/ncov.json", cache_dir=cache_dir)
+            self.assertFalse("Not modified" in stderr.getvalue())
+
+        meta = DownloadCache(cache_dir).lookup(url + "/ncov.json")
+        self.assertEqual(meta["size"], len(bodies["/ncov.json"]))
+        self.assertEqual(
+            meta["sha256"], hashlib.sha256(bodies["/ncov.json"]).hexdigest()
+        )
+
+    def tearDown(self):
+        cleanup_files(TestFromUrl.to_remove)
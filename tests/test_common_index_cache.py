@@ -0,0 +1,155 @@
+"""Tests the `dmwg_data_pyutils.common.index_cache` module"""
+import unittest
+import tempfile
+import pickle
+import json
+import io
+import os
+from array import array
+
+from dmwg_data_pyutils.common.index_cache import (
+    IndexCache,
+    MappedTreeIndex,
+    write_index,
+    encode_column,
+)
+from dmwg_data_pyutils.common.nextstrain import NextStrainParser, NextStrainTreeIndex
+from dmwg_data_pyutils.common.synthetic import build_synthetic_tree
+
+from utils import captured_output, cleanup_files
+from test_common_nextstrain import build_test_tree, build_random_tree
+
+
+def cache_roundtrip(index):
+    """Utility to write an index to a cache file and map it back"""
+    cache = IndexCache(tempfile.mkdtemp())
+    with captured_output():
+        cache.store("abc", index)
+        return cache.load("abc")
+
+
+class TestIndexCache(unittest.TestCase):
+    to_remove = []
+
+    def assertSameIndex(self, res, exp):
+        self.assertEqual(res.names, exp.names)
+        self.assertEqual(list(res.parents), list(exp.parents))
+        self.assertEqual(list(res.child_offsets), list(exp.child_offsets))
+        self.assertEqual(list(res.child_ids), list(exp.child_ids))
+        self.assertEqual(res.attrs, exp.attrs)
+        self.assertEqual(res.mutations, exp.mutations)
+        self.assertEqual(res.mutation_ids, exp.mutation_ids)
+        self.assertEqual(res.vocabulary.strings, exp.vocabulary.strings)
+        self.assertEqual(list(res.order), list(exp.order))
+        self.assertEqual(res.duplicates, exp.duplicates)
+        self.assertEqual(list(res.subtree_ends), list(exp.subtree_ends))
+        self.assertEqual(res.schema.attr_keys, exp.schema.attr_keys)
+        self.assertEqual(res.schema.numeric, exp.schema.numeric)
+        self.assertEqual(res.schema.genes, exp.schema.genes)
+
+    def test_roundtrip(self):
+        dat = build_test_tree()
+        dat["tree"]["node_attrs"]["div"] = 1
+        dat["tree"]["children"][0]["node_attrs"]["div"] = 1.0
+        dat["tree"]["children"][0]["children"][0]["name"] = "left2"
+        for exp in (
+            NextStrainTreeIndex.from_obj(dat),
+            NextStrainTreeIndex.from_obj(build_random_tree(300, seed=2)),
+            NextStrainTreeIndex.from_obj(build_synthetic_tree(300), infer_schema=True),
+        ):
+            res = cache_roundtrip(exp)
+            self.assertIsInstance(res, MappedTreeIndex)
+            self.assertIsInstance(res.parents, memoryview)
+            self.assertSameIndex(res, exp)
+        # 1 and 1.0 are kept apart
+        res = cache_roundtrip(NextStrainTreeIndex.from_obj(dat))
+        self.assertEqual([type(i) for i in res.attrs["div"][:2]], [int, float])
+
+    def test_traversal(self):
+        dat = build_random_tree(300, seed=3)
+        exp = list(NextStrainParser(dat).mutation_traversal_generator())
+        index = cache_roundtrip(NextStrainParser(dat).index)
+        obj = NextStrainParser(None, index=index)
+        self.assertEqual(list(obj.mutation_traversal_generator()), exp)
+        exp_ids = list(NextStrainParser(dat).query("S:M1 OR nuc:M2"))
+        self.assertEqual(list(obj.query("S:M1 OR nuc:M2")), exp_ids)
+
+        # Mapped arrays are copied when pickled
+        res = pickle.loads(pickle.dumps(index))
+        self.assertIsInstance(res.parents, array)
+        obj = NextStrainParser(None, index=res)
+        self.assertEqual(list(obj.mutation_traversal_generator()), exp)
+
+    def test_encode_column(self):
+        codes, values = encode_column(["a", None, 1, 1.0, "a", [1], [1], True])
+        self.assertEqual(list(codes), [1, 0, 2, 3, 1, 4, 4, 5])
+        self.assertEqual(values, [None, "a", 1, 1.0, [1], True])
+
+    def test_from_file_path(self):
+        (fd, fn) = tempfile.mkstemp()
+        self.to_remove.append(fn)
+        with open(fn, "wt") as o:
+            json.dump(build_random_tree(100, seed=4), o)
+        cache = IndexCache(tempfile.mkdtemp())
+        exp = NextStrainParser.from_file_path(fn).index
+
+        with captured_output() as (_, stderr):
+            obj = NextStrainParser.from_file_path(fn, index_cache=cache)
+        self.assertNotIsInstance(obj.index, MappedTreeIndex)
+        self.assertTrue("Cached index in" in stderr.getvalue())
+        digest = cache.file_digest(fn)
+        self.assertTrue(os.path.isfile(cache.path_for(digest)))
+        self.assertFalse(os.path.isfile(cache.path_for(digest, infer_schema=True)))
+
+        with captured_output() as (_, stderr):
+            obj = NextStrainParser.from_file_path(fn, index_cache=cache)
+        self.assertIsInstance(obj.index, MappedTreeIndex)
+        self.assertTrue("Loaded cached index" in stderr.getvalue())
+        self.assertSameIndex(obj.index, exp)
+
+    def test_unreadable(self):
+        cache = IndexCache(tempfile.mkdtemp())
+        path = cache.path_for("abc")
+        with open(path, "wb") as o:
+            o.write(b"not an index")
+        with captured_output() as (_, stderr):
+            self.assertIsNone(cache.load("abc"))
+        self.assertTrue("Removing unreadable cached index" in stderr.getvalue())
+        self.assertFalse(os.path.exists(path))
+
+        buf = io.BytesIO()
+        write_index(buf, NextStrainTreeIndex.from_obj(build_test_tree()))
+        with open(path, "wb") as o:
+            o.write(buf.getvalue()[:-16])
+        with captured_output():
+            self.assertIsNone(cache.load("abc"))
+
+        dat = build_test_tree()
+        dat["tree"]["name"] = "a\x00b"
+        with captured_output() as (_, stderr):
+            self.assertIsNone(cache.store("abc", NextStrainTreeIndex.from_obj(dat)))
+        self.assertEqual(os.listdir(cache.cache_dir), [])
+
+    def test_evict(self):
+        index = NextStrainTreeIndex.from_obj(build_random_tree(100, seed=5))
+        cache = IndexCache(tempfile.mkdtemp())
+        with captured_output():
+            path = cache.store("a", index)
+            size = os.path.getsize(path)
+            cache.max_bytes = 2 * size
+            cache.store("b", index)
+            os.utime(cache.path_for("a"), (0, 0))
+            os.utime(cache.path_for("b"), (1, 1))
+            # a is used again, so b is the least recently used
+            self.assertIsNotNone(cache.load("a"))
+            cache.store("c", index)
+        names = sorted(os.path.basename(p) for _, _, p in cache.entries())
+        self.assertEqual(names, ["a-default.idx", "c-default.idx"])
+
+        cache.max_bytes = 0
+        with captured_output():
+            self.assertEqual(cache.evict(keep=cache.path_for("c")), size)
+        self.assertEqual(len(cache.entries()), 1)
+
+    def tearDown(self):
+        cleanup_files(TestIndexCache.to_remove)
@@ -2,8 +2,17 @@
 import unittest
 import tempfile
 import json
+import gzip
+import io
 
-from dmwg_data_pyutils.common.io import load_json_file
+from dmwg_data_pyutils.common.io import (
+    load_json_file,
+    open_maybe_gzip,
+    streaming_json_available,
+    iter_json_events,
+    read_json_value,
+    skip_json_value,
+)
 
 from utils import captured_output, cleanup_files
 
@@ -18,5 +27,60 @@ class TestCommonIO(unittest.TestCase):
 
             res = load_json_file(fn)
             self.assertEqual(res, tobj)
+
+            with gzip.open(fn, "wt") as o:
+                json.dump(tobj, o)
+
+            res = load_json_file(fn)
+            self.assertEqual(res, tobj)
         finally:
             cleanup_files(fn)
+
+    def test_open_maybe_gzip(self):
+        raw = b'{"tree": 1}'
+        self.assertEqual(open_maybe_gzip(io.BytesIO(raw)).read(), raw)
+        self.assertEqual(open_maybe_gzip(io.BytesIO(gzip.compress(raw))).read(), raw)
+
+    def test_read_json_value(self):
+        events = iter(
+            [
+                ("start_map", None),
+                ("map_key", "a"),
+                ("start_array", None),
+                ("number", 1),
+                ("start_map", None),
+                ("map_key", "b"),
+                ("null", None),
+                ("end_map", None),
+                ("end_array", None),
+                ("map_key", "c"),
+                ("string", "x"),
+                ("end_map", None),
+                ("string", "next"),
+            ]
+        )
+        self.assertEqual(read_json_value(events), {"a": [1, {"b": None}], "c": "x"})
+        self.assertEqual(read_json_value(events), "next")
+
+    def test_skip_json_value(self):
+        events = iter(
+            [
+                ("start_array", None),
+                ("start_map", None),
+                ("map_key", "a"),
+                ("number", 1),
+                ("end_map", None),
+                ("end_array", None),
+                ("number", 2),
+                ("string", "next"),
+            ]
+        )
+        skip_json_value(events)
+        skip_json_value(events)
+        self.assertEqual(next(events), ("string", "next"))
+
+    @unittest.skipIf(not streaming_json_available(), "ijson is not installed")
+    def test_iter_json_events(self):
+        tobj = {"tree": {"a": [1, 2.5, None, True]}}
+        events = iter_json_events(io.BytesIO(json.dumps(tobj).encode("utf-8")))
+        self.assertEqual(read_json_value(events), tobj)
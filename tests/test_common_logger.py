@@ -0,0 +1,29 @@
+"""Tests the `dmwg_data_pyutils.common.logger` module"""
+import unittest
+import subprocess
+import sys
+import os
+
+from dmwg_data_pyutils.common import logger
+
+LOGGER_SCRIPT = """
+from dmwg_data_pyutils.common.logger import Logger
+Logger.RootLogger.setLevel("WARNING")
+log = Logger.get_logger("test")
+log.info("hidden")
+log.warning("shown")
+"""
+
+
+class TestLogger(unittest.TestCase):
+    def test_get_logger_keeps_level(self):
+        res = subprocess.run(
+            [sys.executable, "-c", LOGGER_SCRIPT],
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+            check=True,
+            cwd=os.path.dirname(os.path.dirname(os.path.dirname(logger.__file__))),
+        )
+        self.assertFalse("hidden" in res.stderr)
+        self.assertTrue("[WARNING]" in res.stderr)
+        self.assertTrue("[dmwg_data_pyutils.test] - shown" in res.stderr)
@@ -0,0 +1,79 @@
+"""Tests the `dmwg_data_pyutils.common.metrics` module"""
+import unittest
+import tempfile
+import json
+
+from dmwg_data_pyutils.common.metrics import Metrics, read_io_counters
+
+from utils import cleanup_files
+
+
+class TestMetrics(unittest.TestCase):
+    to_remove = []
+
+    def test_stage(self):
+        metrics = Metrics()
+        with metrics.stage("count") as stage:
+            stage.records = sum(1 for _ in range(10000))
+
+        self.assertEqual(len(metrics.stages), 1)
+        res = metrics.stages[0].to_dict()
+        self.assertEqual(res["name"], "count")
+        self.assertEqual(res["records"], 10000)
+        self.assertGreaterEqual(res["wall_s"], 0)
+        self.assertGreaterEqual(res["cpu_s"], 0)
+        self.assertIsNone(res["profile"])
+        if res["wall_s"]:
+            self.assertEqual(res["records_per_s"], round(10000 / res["wall_s"], 1))
+
+    def test_stage_error(self):
+        metrics = Metrics()
+        with self.assertRaises(ValueError):
+            with metrics.stage("fails"):
+                raise ValueError("boom")
+        self.assertEqual(metrics.stages[0].name, "fails")
+        self.assertIsNotNone(metrics.stages[0].wall_s)
+
+    @unittest.skipIf(read_io_counters() is None, "/proc/self/io is not available")
+    def test_stage_bytes(self):
+        (fd, fn) = tempfile.mkstemp()
+        self.to_remove.append(fn)
+
+        metrics = Metrics()
+        with metrics.stage("io"):
+            with open(fn, "wb") as o:
+                o.write(b"x" * 100000)
+            with open(fn, "rb") as fh:
+                fh.read()
+        stage = metrics.stages[0]
+        self.assertGreaterEqual(stage.bytes_written, 100000)
+        self.assertGreaterEqual(stage.bytes_read, 100000)
+
+    def test_profile(self):
+        def work():
+            return sorted(range(1000), reverse=True)
+
+        metrics = Metrics(profile=True)
+        with metrics.stage("sort"):
+            work()
+        self.assertTrue("work" in metrics.stages[0].profile)
+
+    def test_write(self):
+        (fd, fn) = tempfile.mkstemp()
+        self.to_remove.append(fn)
+
+        metrics = Metrics()
+        with metrics.stage("a"):
+            pass
+        with metrics.stage("b"):
+            pass
+        metrics.write(fn)
+
+        with open(fn, "rt") as fh:
+            report = json.load(fh)
+        self.assertEqual([i["name"] for i in report["stages"]], ["a", "b"])
+        self.assertTrue("process_peak_rss_bytes" in report)
+        self.assertTrue("process_peak_rss_bytes" in report["stages"][0])
+
+    def tearDown(self):
+        cleanup_files(TestMetrics.to_remove)
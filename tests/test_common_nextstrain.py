@@ -1,9 +1,23 @@
 """Tests the `dmwg_data_pyutils.common.nextstrain` module"""
 import unittest
 import tempfile
+import tracemalloc
 import json
+import gzip
+import io
+import random
+import copy
 
-from dmwg_data_pyutils.common.nextstrain import NextStrainParser
+from dmwg_data_pyutils.common.nextstrain import (
+    NextStrainParser,
+    NextStrainTreeIndex,
+    NextStrainSchema,
+    NodeFilter,
+    MutationVocabulary,
+    MutationGenotype,
+)
+
+from dmwg_data_pyutils.common.io import streaming_json_available
 
 from utils import captured_output, cleanup_files
 
@@ -14,6 +28,27 @@ def get_basic_node(name):
     return curr
 
 
+def iter_obj_events(obj):
+    """Utility to generate JSON parse events from a deserialized object"""
+    if isinstance(obj, dict):
+        yield ("start_map", None)
+        for k, v in obj.items():
+            yield ("map_key", k)
+            yield from iter_obj_events(v)
+        yield ("end_map", None)
+    elif isinstance(obj, list):
+        yield ("start_array", None)
+        for v in obj:
+            yield from iter_obj_events(v)
+        yield ("end_array", None)
+    elif obj is None:
+        yield ("null", None)
+    elif isinstance(obj, str):
+        yield ("string", obj)
+    else:
+        yield ("number", obj)
+
+
 def build_test_tree():
     """Utility to get small test tree"""
     root = get_basic_node("root")
@@ -38,6 +73,35 @@ def build_test_tree():
     return tree
 
 
+def build_vocabulary_index():
+    """Utility to get an index whose vocabulary has S A/C, nuc B and E D"""
+    root = get_basic_node("root")
+    child = get_basic_node("child")
+    child["branch_attrs"]["mutations"] = {"S": ["A", "C"], "nuc": ["B"], "E": ["D"]}
+    root["children"].append(child)
+    return NextStrainTreeIndex.from_obj({"tree": root})
+
+
+def build_random_tree(size, seed=0):
+    """Utility to get a random tree with `size` nodes"""
+    rng = random.Random(seed)
+    genes = ["S", "nuc", "ORF1a"]
+    nodes = [get_basic_node("NODE_0")]
+    for i in range(1, size):
+        node = get_basic_node("NODE_{}".format(i))
+        node["node_attrs"]["country"] = {"value": rng.choice(["USA", "China"])}
+        node["node_attrs"]["div"] = rng.random()
+        for gene in rng.sample(genes, rng.randint(0, 2)):
+            node["branch_attrs"].setdefault("mutations", {})[gene] = [
+                "M{}".format(rng.randint(0, 50)) for _ in range(rng.randint(0, 3))
+            ]
+        # Skewed towards recent nodes to get deep subtrees
+        parent = nodes[max(0, i - 1 - int(rng.expovariate(0.2)))]
+        parent["children"].append(node)
+        nodes.append(node)
+    return {"tree": nodes[0]}
+
+
 class TestNextStrainParser(unittest.TestCase):
     to_remove = []
 
@@ -159,5 +223,572 @@ class TestNextStrainParser(unittest.TestCase):
         with self.assertRaises(StopIteration):
             curr = next(gen)
 
+    def test__propagate_mutations(self):
+        obj = NextStrainParser(None, index=build_vocabulary_index())
+        vocab = obj.index.vocabulary
+        inherited = obj._propagate_mutations(
+            {}, {"S": vocab.encode("S", ["A"]), "nuc": vocab.encode("nuc", ["B"])}
+        )
+        delta = {"S": vocab.encode("S", ["C", "A"]), "E": vocab.encode("E", ["D"])}
+        res = obj._propagate_mutations(inherited, delta)
+        self.assertEqual(
+            obj._materialize_mutations(res, ["S", "nuc", "E", "M"]),
+            {"S": ["A", "C"], "nuc": ["B"], "E": ["D"], "M": None},
+        )
+        self.assertIs(res["nuc"], inherited["nuc"])
+        self.assertIs(res["S"].parent, inherited["S"])
+        self.assertEqual(inherited["S"].resolve(), [0])
+
+        res = obj._propagate_mutations(inherited, None)
+        self.assertIs(res, inherited)
+        # Nothing new shares the parent's dict
+        res = obj._propagate_mutations(inherited, {"S": ()})
+        self.assertIs(res, inherited)
+        # A repeated mutation is only kept once
+        res = obj._propagate_mutations(inherited, {"S": vocab.encode("S", ["A"])})
+        self.assertEqual(res["S"].resolve(), [0])
+
+    def test_mutation_vocabulary(self):
+        vocab = MutationVocabulary.from_mutations(
+            [None, {"S": ("D614G", "A222V")}, {"S": ("D614G",), "nuc": ("C241T",)}]
+        )
+        self.assertEqual(vocab.strings, {"S": ["A222V", "D614G"], "nuc": ["C241T"]})
+        self.assertEqual(len(vocab), 3)
+        self.assertEqual(vocab.encode("S", ["D614G", "A222V"]), (1, 0))
+        self.assertEqual(vocab.decode("S", [0, 1]), ["A222V", "D614G"])
+        self.assertEqual(vocab.decode("nuc", []), [])
+
+    def test_mutation_genotype(self):
+        root = MutationGenotype.extend(None, [1, 0])
+        left = MutationGenotype.extend(root, [2, 0])
+        right = MutationGenotype.extend(root, [])
+        self.assertEqual(left.added, (2, 0))
+        self.assertIs(left.parent, root)
+        self.assertIs(right, root)
+        self.assertEqual(left.resolve(), [0, 1, 2])
+        self.assertEqual(root.resolve(), [0, 1])
+        self.assertEqual(MutationGenotype.extend(None, []).resolve(), [])
+
+        # Resolving from an ancestor only walks the links below it
+        base = (root, [0, 1])
+        self.assertEqual(left.resolve(base), [0, 1, 2])
+        self.assertEqual(base[1], [0, 1])
+        self.assertIs(root.resolve(base), base[1])
+        other = MutationGenotype.extend(None, [2])
+        self.assertEqual(other.resolve(base), [2])
+
+    def test_query(self):
+        obj = NextStrainParser(build_test_tree())
+        names = obj.index.names
+
+        def run(*args, **kwargs):
+            return [names[i] for i in obj.query(*args, **kwargs)]
+
+        self.assertEqual(run("S:A"), ["left0", "left1", "left2", "left3"])
+        self.assertEqual(run("S:A AND NOT nuc:B"), ["left0", "left1"])
+        self.assertEqual(
+            run("S:A", node_filter=NodeFilter(tips_only=True)), ["left1", "left3"]
+        )
+        self.assertEqual(run("S:Z"), [])
+        self.assertEqual(run(node_filter=NodeFilter(where={"age": [10]})), ["left0"])
+        self.assertEqual(
+            run("NOT S:A", node_filter=NodeFilter(where={"age": ["NA"]})), ["root"]
+        )
+
+    def test_query_duplicate_names(self):
+        root = get_basic_node("root")
+        for mutation in ("X", "Y"):
+            child = get_basic_node("dup")
+            child["branch_attrs"]["mutations"] = {"S": [mutation]}
+            root["children"].append(child)
+        obj = NextStrainParser({"tree": root})
+        # The traversal visits the last child first and keeps that node
+        records = [r for r in obj.mutation_traversal_generator() if r["name"] == "dup"]
+        self.assertEqual([r["S"] for r in records], [["Y"]])
+        self.assertEqual(list(obj.query("S:Y")), [2])
+        self.assertEqual(list(obj.query("S:X")), [])
+        self.assertEqual(list(obj.query()), [0, 2])
+
+    def test_query_matches_traversal(self):
+        obj = NextStrainParser(build_random_tree(300, seed=3))
+        records = {r["name"]: r for r in obj.mutation_traversal_generator()}
+        vocab = obj.index.vocabulary
+        terms = [(k, m) for k in sorted(vocab.strings) for m in vocab.strings[k][:5]]
+
+        def carries(name, term):
+            return term[1] in (records[name][term[0]] or [])
+
+        names = obj.index.names
+        for (g1, m1), (g2, m2) in zip(terms, reversed(terms)):
+            query = "{}:{} AND NOT {}:{}".format(g1, m1, g2, m2)
+            exp = [
+                names[i]
+                for i in range(len(names))
+                if carries(names[i], (g1, m1)) and not carries(names[i], (g2, m2))
+            ]
+            self.assertEqual([names[i] for i in obj.query(query)], exp)
+
+    def test_diff_traversal_generator(self):
+        previous = NextStrainTreeIndex.from_obj(build_test_tree())
+        obj = NextStrainParser(build_test_tree())
+        self.assertEqual(list(obj.diff_traversal_generator(previous)), [])
+
+        dat = build_test_tree()
+        left0 = dat["tree"]["children"][0]
+        left1, left2 = left0["children"]
+        # Renamed, but matched by parent and branch mutations
+        left2["name"] = "NODE_2"
+        left1["node_attrs"]["age"] = {"value": "20"}
+        new = get_basic_node("left4")
+        new["branch_attrs"]["mutations"] = {"S": ["C"]}
+        left2["children"].append(new)
+        del left2["children"][0]
+
+        obj = NextStrainParser(dat)
+        res = list(obj.diff_traversal_generator(previous))
+        self.assertEqual(
+            [(r["change_type"], r["previous_name"], r["name"]) for r in res],
+            [
+                ("changed", "left1", "left1"),
+                ("changed", "left2", "NODE_2"),
+                ("added", None, "left4"),
+                ("removed", "left3", "left3"),
+            ],
+        )
+        self.assertEqual(res[0]["age"], "20")
+        self.assertEqual(res[2]["parent"], "NODE_2")
+        self.assertEqual(res[2]["S"], ["A", "C"])
+        self.assertEqual(res[2]["nuc"], ["B"])
+        self.assertIsNone(res[3]["S"])
+
+    def test_diff_traversal_generator_applies(self):
+        def apply_diff(records, diff):
+            table = {r["name"]: r for r in records}
+            diff = list(diff)
+            for r in diff:
+                if r["change_type"] != "added":
+                    del table[r["previous_name"]]
+            for r in diff:
+                if r["change_type"] != "removed":
+                    del r["change_type"], r["previous_name"]
+                    table[r["name"]] = r
+            return table
+
+        for seed in range(5):
+            rng = random.Random(seed)
+            old = build_random_tree(200, seed=seed)
+            dat = copy.deepcopy(old)
+            stack = [dat["tree"]]
+            nodes = []
+            while stack:
+                node = stack.pop()
+                nodes.append(node)
+                stack.extend(node["children"])
+            for node in rng.sample(nodes[1:], 20):
+                edit = rng.randrange(4)
+                if edit == 0 and node["children"]:
+                    node["name"] = "NEW_{}".format(node["name"])
+                elif edit == 1:
+                    node["node_attrs"]["country"] = {"value": "Peru"}
+                elif edit == 2:
+                    node["branch_attrs"]["mutations"] = {"S": ["X1"]}
+                else:
+                    node["children"].append(get_basic_node("ADD_" + node["name"]))
+            for node in rng.sample(nodes[1:], 5):
+                node["children"] = []
+
+            previous = NextStrainTreeIndex.from_obj(old)
+            exp = {
+                r["name"]: r
+                for r in NextStrainParser(dat).mutation_traversal_generator()
+            }
+            obj = NextStrainParser(dat)
+            res = apply_diff(
+                NextStrainParser(old).mutation_traversal_generator(),
+                obj.diff_traversal_generator(previous),
+            )
+            self.assertEqual(res, exp)
+
+    def test_mutation_traversal_generator_filter(self):
+        obj = NextStrainParser(build_test_tree())
+        node_filter = NodeFilter(tips_only=True)
+        res = list(obj.mutation_traversal_generator(node_filter=node_filter))
+        self.assertEqual([r["name"] for r in res], ["left3", "left1"])
+        self.assertEqual(res[0]["S"], ["A"])
+        self.assertEqual(res[0]["nuc"], ["B"])
+
+        node_filter = NodeFilter(where={"age": ["10"]})
+        res = list(obj.mutation_traversal_generator(node_filter=node_filter))
+        self.assertEqual([r["name"] for r in res], ["left0"])
+
+    def test_mutation_traversal_generator_filter_matches(self):
+        dat = build_random_tree(500, seed=4)
+        rng = random.Random(4)
+        stack = [dat["tree"]]
+        while stack:
+            node = stack.pop()
+            node["node_attrs"]["num_date"] = {"value": rng.uniform(2020, 2021)}
+            stack.extend(node["children"])
+        obj = NextStrainParser(dat)
+        full = list(obj.mutation_traversal_generator())
+        filters = [
+            (NodeFilter(tips_only=True), lambda r: r["name"] in tips),
+            (NodeFilter(where={"country": ["USA"]}), lambda r: r["country"] == "USA"),
+            (
+                NodeFilter(num_date_range=(2020.2, 2020.3)),
+                lambda r: 2020.2 <= r["num_date"] <= 2020.3,
+            ),
+        ]
+        index = obj.index
+        tips = set(
+            index.names[i]
+            for i in range(len(index))
+            if index.child_offsets[i] == index.child_offsets[i + 1]
+        )
+        for node_filter, func in filters:
+            exp = [r for r in full if func(r)]
+            self.assertEqual(
+                list(obj.mutation_traversal_generator(node_filter=node_filter)), exp
+            )
+            # Slices concatenate to the filtered output
+            res = []
+            for start in range(0, len(index), 37):
+                res.extend(
+                    obj.mutation_traversal_generator(
+                        start, start + 37, node_filter=node_filter
+                    )
+                )
+            self.assertEqual(res, exp)
+
+    def test_mutation_traversal_generator_projection(self):
+        obj = NextStrainParser(build_random_tree(200, seed=6))
+        full = list(obj.mutation_traversal_generator())
+        res = list(obj.mutation_traversal_generator(attr_keys=["div"], genes=["S"]))
+        exp = [{k: r[k] for k in ("parent", "name", "div", "S")} for r in full]
+        self.assertEqual(res, exp)
+        # Other genes are not even accumulated
+        path = obj._ancestor_mutations(len(obj.index) - 1, {"S"})
+        self.assertTrue(all(set(muts) <= {"S"} for _, muts in path))
+
+        with self.assertRaises(AssertionError):
+            list(obj.mutation_traversal_generator(genes=["XYZ"]))
+
+    def test_branch_mutation_generator(self):
+        dat = build_random_tree(300, seed=9)
+        # Repeated mutations and the root's own mutations
+        dat["tree"]["branch_attrs"]["mutations"] = {"S": ["R1"]}
+        dat["tree"]["children"][0]["branch_attrs"]["mutations"] = {"S": ["M2", "M2"]}
+        obj = NextStrainParser(dat)
+        full = list(obj.mutation_traversal_generator())
+        res = list(obj.branch_mutation_generator())
+        own = {}
+        for rec in res:
+            own.setdefault(rec["name"], {}).setdefault(rec["gene"], []).append(
+                rec["mutation"]
+            )
+        self.assertFalse("NODE_0" in own)
+        self.assertEqual(own["NODE_1"]["S"], ["M2"])
+
+        # The cumulative mutations are the union of the ancestors' own ones
+        parents = {r["name"]: r["parent"] for r in full}
+        for rec in full:
+            for gene in ("S", "nuc", "ORF1a"):
+                muts = set()
+                name = rec["name"]
+                while parents[name] != name:
+                    muts.update(own.get(name, {}).get(gene, []))
+                    name = parents[name]
+                self.assertEqual(sorted(muts), rec[gene] or [])
+
+        res = list(obj.branch_mutation_generator(genes=["nuc"]))
+        self.assertEqual(set(r["gene"] for r in res), {"nuc"})
+
+    def test_tip_mutation_generator(self):
+        obj = NextStrainParser(build_random_tree(200, seed=10))
+        exp = [
+            {"name": r["name"], "gene": gene, "mutation": m}
+            for r in obj.mutation_traversal_generator(node_filter=NodeFilter(True))
+            for gene in ("S", "ORF1a")
+            for m in r[gene] or []
+        ]
+        self.assertEqual(list(obj.tip_mutation_generator(["S", "ORF1a"])), exp)
+
+    def test_mutation_interval_index(self):
+        obj = NextStrainParser(build_test_tree())
+        mindex = obj.mutation_index
+        self.assertEqual(list(obj.index.subtree_ends), [5, 5, 3, 5, 5])
+        self.assertEqual(list(mindex.lookup("S", "A")), [1, 5])
+        self.assertEqual(list(mindex.lookup("nuc", "B")), [3, 5])
+        self.assertEqual(list(mindex.lookup("nuc", "Z")), [])
+        self.assertEqual(list(mindex.lookup("E", "A")), [])
+
+    def test_mutation_traversal_generator_matches_collect(self):
+        dat = build_test_tree()
+        exp = NextStrainParser(build_test_tree())
+        exp._append_parents()
+        exp = {n["name"]: exp._collect_mutations(n) for n in exp._flatten_nodes()}
+
+        obj = NextStrainParser(dat)
+        for rec in obj.mutation_traversal_generator():
+            found = {k: v for k, v in rec.items() if k in ("S", "nuc") and v}
+            self.assertEqual(found, exp[rec["name"]])
+        self.assertEqual(dat, build_test_tree())
+
+    def test_mutation_traversal_generator_deep(self):
+        depth = 2000
+        root = get_basic_node("node0")
+        curr = root
+        for i in range(1, depth):
+            child = get_basic_node("node{}".format(i))
+            child["branch_attrs"]["mutations"] = {"nuc": ["M{}".format(i)]}
+            curr["children"].append(child)
+            curr = child
+
+        obj = NextStrainParser({"tree": root})
+        records = list(obj.mutation_traversal_generator())
+        self.assertEqual(len(records), depth)
+        self.assertEqual(records[-1]["name"], "node{}".format(depth - 1))
+        self.assertEqual(len(records[-1]["nuc"]), depth - 1)
+
+    def test_mutation_traversal_generator_deep_memory(self):
+        # Ladder tree: every internal node has a tip and the next internal
+        # node as children, with one nuc mutation per branch
+        depth = 3000
+        root = get_basic_node("node0")
+        curr = root
+        for i in range(1, depth):
+            tip = get_basic_node("tip{}".format(i))
+            tip["branch_attrs"]["mutations"] = {"nuc": ["T{}".format(i)]}
+            child = get_basic_node("node{}".format(i))
+            child["branch_attrs"]["mutations"] = {"nuc": ["M{}".format(i)]}
+            curr["children"].extend([tip, child])
+            curr = child
+
+        obj = NextStrainParser({"tree": root})
+        obj.index.vocabulary
+        obj.index.mutation_ids
+        obj.index.duplicates
+        count = 0
+        tracemalloc.start()
+        try:
+            for record in obj.mutation_traversal_generator():
+                count += 1
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertEqual(count, 2 * depth - 1)
+        # Caching the strings on every genotype peaks at tens of MB here
+        self.assertLess(peak, 4 * 1024 * 1024)
+
+    @unittest.skipIf(not streaming_json_available(), "ijson is not installed")
+    def test_from_file_path_stream(self):
+        (fd, fn) = tempfile.mkstemp()
+        self.to_remove.append(fn)
+        with open(fn, "wt") as o:
+            json.dump(build_test_tree(), o)
+
+        res = NextStrainParser.from_file_path(fn, stream=True)
+        self.assertIsNone(res.obj)
+        exp = list(NextStrainParser(build_test_tree()).mutation_traversal_generator())
+        self.assertEqual(list(res.mutation_traversal_generator()), exp)
+
+    def test_mutation_traversal_generator_slices(self):
+        dat = build_random_tree(300)
+        dat["tree"]["children"][0]["name"] = "NODE_1_dup"
+        dat["tree"]["children"][0]["children"].append(get_basic_node("NODE_1_dup"))
+        obj = NextStrainParser(dat)
+        exp = list(obj.mutation_traversal_generator())
+        self.assertEqual(len(exp), 300)
+        self.assertEqual(len(obj.index.duplicates), 1)
+
+        legacy = NextStrainParser(copy.deepcopy(dat))
+        legacy._append_parents()
+        nodes = legacy._flatten_nodes()
+        self.assertEqual([i["name"] for i in exp], [i["name"] for i in nodes])
+        for rec, node in zip(exp, nodes):
+            nuc = legacy._collect_mutations(node).get("nuc")
+            self.assertEqual(rec["nuc"], nuc)
+
+        for bounds in ([0, 301], [0, 1, 150, 301], [0, 7, 8, 100, 299, 301]):
+            res = []
+            for start, stop in zip(bounds[:-1], bounds[1:]):
+                res.extend(obj.mutation_traversal_generator(start, stop))
+            self.assertEqual(res, exp)
+
+    def test_release_json(self):
+        obj = NextStrainParser(build_test_tree())
+        obj.release_json()
+        self.assertIsNone(obj.obj)
+        records = list(obj.mutation_traversal_generator())
+        self.assertEqual(len(records), 5)
+
     def tearDown(self):
         cleanup_files(TestNextStrainParser.to_remove)
+
+
+class TestNextStrainTreeIndex(unittest.TestCase):
+    def test_match(self):
+        previous = NextStrainTreeIndex.from_obj(build_test_tree())
+        dat = build_test_tree()
+        left0 = dat["tree"]["children"][0]
+        left0["name"] = "NODE_1"
+        left0["children"][1]["name"] = "NODE_2"
+        left0["children"][1]["branch_attrs"]["mutations"] = {"nuc": ["C"]}
+        index = NextStrainTreeIndex.from_obj(dat)
+        # left0 matches by its mutations, NODE_2 does not, left3 by name
+        self.assertEqual(list(index.match(previous)), [0, 1, 2, -1, 4])
+        self.assertEqual(index.branch_signature(1), (("S", ("A",)),))
+        self.assertEqual(index.branch_signature(0), ())
+
+    def test_from_obj(self):
+        dat = build_test_tree()
+        index = NextStrainTreeIndex.from_obj(dat)
+        self.assertEqual(dat, build_test_tree())
+        self.assertEqual(len(index), 5)
+        self.assertEqual(index.names, ["root", "left0", "left1", "left2", "left3"])
+        self.assertEqual(list(index.parents), [-1, 0, 1, 1, 3])
+        self.assertEqual(list(index.children_of(0)), [1])
+        self.assertEqual(list(index.children_of(1)), [2, 3])
+        self.assertEqual(list(index.children_of(2)), [])
+        self.assertEqual(index.attrs["age"], [None, "10", None, None, None])
+        self.assertEqual(index.mutations[1], {"S": ("A",)})
+        self.assertIsNone(index.mutations[0])
+
+    def test_from_events(self):
+        dat = build_test_tree()
+        dat["meta"] = {"colorings": [{"key": "age"}]}
+        dat["tree"]["node_attrs"]["country"] = {"value": "USA", "confidence": {}}
+        dat["tree"]["node_attrs"]["unused"] = {"value": [1, 2]}
+        dat["tree"]["branch_attrs"]["labels"] = {"clade": "A"}
+        dat["tree"]["children"][0]["children"].append({"name": "left4"})
+        exp = NextStrainTreeIndex.from_obj(dat)
+        index = NextStrainTreeIndex.from_events(iter_obj_events(dat))
+        self.assertEqual(index.names, exp.names)
+        self.assertEqual(index.parents, exp.parents)
+        self.assertEqual(index.child_offsets, exp.child_offsets)
+        self.assertEqual(index.child_ids, exp.child_ids)
+        self.assertEqual(index.attrs, exp.attrs)
+        self.assertEqual(index.attrs["country"][0], "USA")
+        self.assertEqual(index.mutations, exp.mutations)
+
+        with self.assertRaises(AssertionError):
+            NextStrainTreeIndex.from_events(iter_obj_events({"meta": {}}))
+
+    def test_from_events_infer_schema(self):
+        meta = {
+            "colorings": [{"key": "age", "type": "continuous"}, {"key": "gt"}],
+            "genome_annotations": {"nuc": {}, "S": {}},
+        }
+        # meta has to come before the tree to be read while streaming
+        dat = dict(meta=meta, **build_test_tree())
+        dat["tree"]["node_attrs"]["div"] = 0.5
+        for index in (
+            NextStrainTreeIndex.from_obj(dat, infer_schema=True),
+            NextStrainTreeIndex.from_events(iter_obj_events(dat), infer_schema=True),
+        ):
+            self.assertEqual(index.schema.attr_keys, ["age", "div", "num_date"])
+            self.assertEqual(index.schema.genes, ["S", "nuc"])
+            self.assertEqual(index.attrs["age"], [None, "10", None, None, None])
+            self.assertEqual(index.attrs["div"][:2], [0.5, None])
+
+        index = NextStrainTreeIndex.from_events(
+            iter_obj_events(dat), ["age"], infer_schema=True
+        )
+        self.assertEqual(list(index.attrs), ["age"])
+        self.assertEqual(index.schema.numeric, ["age"])
+
+    def test_from_events_infer_schema_late_meta(self):
+        meta = {
+            "colorings": [
+                {"key": "age", "type": "continuous"},
+                {"key": "lineage"},
+            ],
+            "genome_annotations": {"nuc": {}, "S": {}},
+        }
+        # meta after the tree only projects the attributes read by default
+        dat = dict(build_test_tree(), meta=meta)
+        dat["tree"]["node_attrs"]["lineage"] = {"value": "B.1"}
+        with captured_output() as (_, stderr):
+            index = NextStrainTreeIndex.from_events(
+                iter_obj_events(dat), infer_schema=True
+            )
+        self.assertTrue("attributes lineage were not read" in stderr.getvalue())
+        self.assertEqual(
+            index.schema.attr_keys, ["age", "lineage", "div", "num_date"]
+        )
+        self.assertEqual(index.schema.numeric, ["age", "div", "num_date"])
+        self.assertEqual(index.schema.genes, ["S", "nuc"])
+        self.assertEqual(list(index.attrs), index.schema.attr_keys)
+        self.assertEqual(index.attrs["age"], [None, "10", None, None, None])
+        self.assertEqual(index.attrs["lineage"], [None] * 5)
+
+        index = NextStrainTreeIndex.from_events(
+            iter_obj_events(dat), ["age"], infer_schema=True
+        )
+        self.assertEqual(list(index.attrs), ["age"])
+        self.assertEqual(index.schema.numeric, ["age"])
+
+    @unittest.skipIf(not streaming_json_available(), "ijson is not installed")
+    def test_from_stream(self):
+        raw = json.dumps(build_test_tree()).encode("utf-8")
+        exp = NextStrainTreeIndex.from_obj(build_test_tree())
+        for data in (raw, gzip.compress(raw)):
+            index = NextStrainTreeIndex.from_stream(io.BytesIO(data))
+            self.assertEqual(index.names, exp.names)
+            self.assertEqual(index.parents, exp.parents)
+            self.assertEqual(index.mutations, exp.mutations)
+
+    def test_traversal_order(self):
+        dat = build_test_tree()
+        index = NextStrainTreeIndex.from_obj(dat)
+        obj = NextStrainParser(dat)
+        obj._append_parents()
+        exp = [n["name"] for n in obj._flatten_nodes()]
+        self.assertEqual([index.names[i] for i in index.traversal_order()], exp)
+
+    def test_node(self):
+        index = NextStrainTreeIndex.from_obj(build_test_tree(), ["age"])
+        node = index.node(1)
+        self.assertEqual(node.name, "left0")
+        self.assertEqual(node.parent.name, "root")
+        self.assertIsNone(node.parent.parent)
+        self.assertEqual([i.name for i in node.children], ["left1", "left2"])
+        self.assertEqual(node.attrs, {"age": "10"})
+        self.assertEqual(node.mutations, {"S": ("A",)})
+        self.assertEqual(index.node(0).mutations, {})
+
+
+class TestNextStrainSchema(unittest.TestCase):
+    def test_from_meta(self):
+        schema = NextStrainSchema.from_meta(
+            {
+                "colorings": [
+                    {"key": "gt", "type": "categorical"},
+                    {"key": "pango_lineage", "type": "categorical"},
+                    {"key": "num_date", "type": "continuous"},
+                    {"key": "ct", "type": "continuous"},
+                ],
+                "genome_annotations": {"nuc": {}, "S": {}, "E": {}},
+            }
+        )
+        self.assertEqual(schema.attr_keys, ["pango_lineage", "num_date", "ct", "div"])
+        self.assertEqual(schema.numeric, ["num_date", "ct", "div"])
+        self.assertEqual(schema.genes, ["E", "S", "nuc"])
+
+        default = NextStrainSchema.default()
+        for meta in (None, {}, {"colorings": [{"key": "gt"}]}):
+            schema = NextStrainSchema.from_meta(meta)
+            self.assertEqual(schema.attr_keys, default.attr_keys)
+            self.assertEqual(sorted(schema.numeric), sorted(default.numeric))
+            self.assertEqual(schema.genes, sorted(default.genes))
+
+    def test_compile_extractor(self):
+        schema = NextStrainSchema(["country", "div", "age"], ["div"], [])
+        extract = schema.compile_extractor()
+        self.assertEqual(
+            extract({"country": {"value": "USA"}, "div": 0.1}), ["USA", 0.1, None]
+        )
+        self.assertEqual(extract({"div": {"value": 0.2}}), [None, 0.2, None])
+        # Unexpected shapes fall back to checking every value
+        res = extract({"country": "USA", "age": {"value": 3}})
+        self.assertEqual(res, ["USA", None, 3])
@@ -0,0 +1,76 @@
+"""Tests the `dmwg_data_pyutils.common.query` module"""
+import unittest
+import random
+
+from dmwg_data_pyutils.common.query import (
+    parse_query,
+    evaluate_query,
+    union_intervals,
+    intersect_intervals,
+    complement_intervals,
+    iter_intervals,
+)
+
+
+def to_intervals(ids):
+    """Utility to convert a set of ids to an interval list"""
+    res = []
+    for i in sorted(ids):
+        if res and res[-1] == i:
+            res[-1] = i + 1
+        else:
+            res.extend([i, i + 1])
+    return res
+
+
+class TestParseQuery(unittest.TestCase):
+    def test_parse_query(self):
+        self.assertEqual(parse_query("S:N501Y"), ("mut", "S", "N501Y"))
+        self.assertEqual(
+            parse_query("S:N501Y and ORF1a:T1001I OR not nuc:C241T"),
+            (
+                "or",
+                ("and", ("mut", "S", "N501Y"), ("mut", "ORF1a", "T1001I")),
+                ("not", ("mut", "nuc", "C241T")),
+            ),
+        )
+        self.assertEqual(
+            parse_query("S:A AND (S:B OR S:C)"),
+            ("and", ("mut", "S", "A"), ("or", ("mut", "S", "B"), ("mut", "S", "C"))),
+        )
+
+    def test_parse_query_errors(self):
+        for query in ["", "S:A AND", "(S:A", "S:A)", "N501Y", "S:A S:B", "AND S:A"]:
+            with self.assertRaises(ValueError):
+                parse_query(query)
+
+
+class TestIntervals(unittest.TestCase):
+    def test_operations(self):
+        rng = random.Random(0)
+        size = 50
+        for _ in range(200):
+            a = set(rng.sample(range(size), rng.randrange(size)))
+            b = set(rng.sample(range(size), rng.randrange(size)))
+            ia, ib = to_intervals(a), to_intervals(b)
+            self.assertEqual(list(union_intervals(ia, ib)), to_intervals(a | b))
+            self.assertEqual(list(intersect_intervals(ia, ib)), to_intervals(a & b))
+            self.assertEqual(
+                list(complement_intervals(ia, size)),
+                to_intervals(set(range(size)) - a),
+            )
+            self.assertEqual(list(iter_intervals(ia)), sorted(a))
+
+    def test_evaluate_query(self):
+        terms = {("S", "A"): [0, 10], ("S", "B"): [2, 4, 6, 8], ("S", "C"): []}
+
+        def lookup(gene, mutation):
+            return terms[(gene, mutation)]
+
+        def run(query):
+            return list(evaluate_query(parse_query(query), lookup, 12))
+
+        self.assertEqual(run("S:A AND NOT S:B"), [0, 2, 4, 6, 8, 10])
+        self.assertEqual(run("S:B OR S:C"), [2, 4, 6, 8])
+        self.assertEqual(run("NOT S:A"), [10, 12])
+        self.assertEqual(run("S:A AND S:C"), [])
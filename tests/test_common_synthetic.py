@@ -0,0 +1,53 @@
+"""Tests the `dmwg_data_pyutils.common.synthetic` module"""
+import unittest
+
+from dmwg_data_pyutils.common.nextstrain import NextStrainParser
+from dmwg_data_pyutils.common.synthetic import build_synthetic_tree
+
+
+class TestSyntheticTree(unittest.TestCase):
+    def test_build_synthetic_tree(self):
+        dat = build_synthetic_tree(500, seed=1)
+        self.assertEqual(dat["version"], "v2")
+        self.assertTrue("colorings" in dat["meta"])
+        self.assertEqual(dat, build_synthetic_tree(500, seed=1))
+        self.assertNotEqual(dat, build_synthetic_tree(500, seed=2))
+
+        obj = NextStrainParser(dat)
+        records = list(obj.mutation_traversal_generator())
+        self.assertEqual(len(records), 500)
+        self.assertEqual(len(set(r["name"] for r in records)), 500)
+        self.assertTrue(all(r["region"] is not None for r in records))
+        index = obj.index
+        for idx, name in enumerate(index.names):
+            is_internal = len(index.children_of(idx)) > 0
+            self.assertEqual(name.startswith("NODE_"), is_internal)
+
+    def test_depth_and_skew(self):
+        def depth(dat):
+            index = NextStrainParser(dat).index
+            depths = [0] * len(index)
+            for idx in range(1, len(index)):
+                depths[idx] = depths[index.parents[idx]] + 1
+            return max(depths)
+
+        self.assertLessEqual(depth(build_synthetic_tree(300, max_depth=5)), 5)
+        self.assertEqual(depth(build_synthetic_tree(300, max_depth=1)), 1)
+        self.assertEqual(depth(build_synthetic_tree(1, max_depth=1)), 0)
+        with self.assertRaises(ValueError):
+            build_synthetic_tree(300, max_depth=0)
+        with self.assertRaises(ValueError):
+            build_synthetic_tree(0)
+        self.assertEqual(depth(build_synthetic_tree(1)), 0)
+        ladder = depth(build_synthetic_tree(300, skew=1.0))
+        bush = depth(build_synthetic_tree(300, skew=0.0))
+        self.assertEqual(ladder, 299)
+        self.assertLess(bush, ladder)
+
+    def test_mutation_rate(self):
+        dat = build_synthetic_tree(50, mutation_rate=0.0)
+        index = NextStrainParser(dat).index
+        self.assertTrue(all(m is None for m in index.mutations))
+        dat = build_synthetic_tree(50, mutation_rate=5.0)
+        index = NextStrainParser(dat).index
+        self.assertTrue(any(m is not None for m in index.mutations))
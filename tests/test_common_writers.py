@@ -0,0 +1,227 @@
+"""Tests the `dmwg_data_pyutils.common.writers` module"""
+import unittest
+import tempfile
+import json
+import io
+import os
+import gzip
+from unittest import mock
+
+from dmwg_data_pyutils.common import writers
+from dmwg_data_pyutils.common.writers import (
+    RecordWriter,
+    BatchedRecordWriter,
+    TsvRecordWriter,
+    ShardedRecordWriter,
+    BackgroundGzipSink,
+    NpzRecordWriter,
+    ArrowRecordWriter,
+    open_record_writer,
+    pyarrow_available,
+    numpy_available,
+    to_float,
+    file_sha256,
+    SHARD_MANIFEST,
+)
+
+from utils import captured_output, cleanup_files
+
+COLUMNS = ["name", "age", "S"]
+RECORDS = [
+    {"name": "root", "age": None, "S": None},
+    {"name": "left0", "age": "10", "S": ["A", "B"]},
+    {"name": "left1", "age": "?", "S": []},
+]
+
+
+class TestRecordWriters(unittest.TestCase):
+    to_remove = []
+
+    def _write(self, writer):
+        with writer:
+            for record in RECORDS:
+                writer.write(record)
+        self.assertEqual(writer.total, 3)
+
+    def test_to_float(self):
+        self.assertEqual(to_float("10"), 10.0)
+        self.assertEqual(to_float(2), 2.0)
+        self.assertIsNone(to_float("?"))
+        self.assertIsNone(to_float(None))
+
+    def test_abstract(self):
+        with self.assertRaises(TypeError):
+            RecordWriter(COLUMNS)
+
+        class Incomplete(BatchedRecordWriter):
+            pass
+
+        with self.assertRaises(TypeError):
+            Incomplete(COLUMNS)
+
+    def test_tsv(self):
+        exp = "name\tage\tS\nroot\tNA\tNA\nleft0\t10\tA,B\nleft1\t?\t\n"
+        o = io.StringIO()
+        self._write(TsvRecordWriter(o, COLUMNS, ["age"], ["S"], buffer_rows=2))
+        self.assertEqual(o.getvalue(), exp)
+
+        for suffix, threaded in ((".tsv", True), (".tsv.gz", True), (".gz", False)):
+            (fd, fn) = tempfile.mkstemp(suffix=suffix)
+            self.to_remove.append(fn)
+            writer = TsvRecordWriter(
+                fn, COLUMNS, ["age"], ["S"], threaded=threaded, buffer_rows=1
+            )
+            self._write(writer)
+            ofunc = gzip.open if suffix.endswith(".gz") else open
+            with ofunc(fn, "rt") as fh:
+                self.assertEqual(fh.read(), exp)
+
+    def test_sharded(self):
+        out_dir = tempfile.mkdtemp()
+        records = [
+            {"name": "n{}".format(i), "age": str(i), "S": None, "region": region}
+            for i, region in enumerate("abcab/ca" + "c" * 5)
+        ]
+        records[0]["region"] = None
+        # Small buffers and at most 2 open shards, so shards are closed and
+        # appended to
+        writer = ShardedRecordWriter(
+            out_dir,
+            lambda r: "NA" if r["region"] is None else r["region"],
+            COLUMNS,
+            ["age"],
+            ["S"],
+            max_open=2,
+            buffer_rows=2,
+            max_buffered_rows=3,
+            metadata={"shard_by": "region"},
+        )
+        with writer:
+            for record in records:
+                writer.write(record)
+        self.assertEqual(writer.counts, {"NA": 1, "a": 2, "b": 2, "/": 1, "c": 7})
+
+        with open(os.path.join(out_dir, SHARD_MANIFEST), "rt") as fh:
+            manifest = json.load(fh)
+        self.assertEqual(manifest["shard_by"], "region")
+        self.assertEqual(manifest["columns"], COLUMNS)
+        self.assertEqual(manifest["records"], len(records))
+        self.assertEqual(
+            [i["partition"] for i in manifest["shards"]], ["/", "NA", "a", "b", "c"]
+        )
+        for shard in manifest["shards"]:
+            path = os.path.join(out_dir, shard["path"])
+            self.assertEqual(path, writer.shard_path(shard["partition"]))
+            self.assertEqual(shard["bytes"], os.path.getsize(path))
+            self.assertEqual(shard["sha256"], file_sha256(path))
+            with gzip.open(path, "rt") as fh:
+                rows = fh.read().splitlines()
+            exp = [
+                "{}\t{}\tNA".format(r["name"], r["age"])
+                for r in records
+                if writer.partition(r) == shard["partition"]
+            ]
+            self.assertEqual(rows, ["\t".join(COLUMNS)] + exp)
+            self.assertEqual(shard["records"], len(exp))
+        self.assertEqual(manifest["shards"][0]["path"], "%2F.tsv.gz")
+
+        # No manifest is written after an error
+        out_dir = tempfile.mkdtemp()
+        with self.assertRaises(KeyError):
+            with ShardedRecordWriter(
+                out_dir, lambda r: r["region"], COLUMNS, buffer_rows=1
+            ) as writer:
+                writer.write(records[1])
+                writer.write({"name": "x"})
+        self.assertEqual(os.listdir(out_dir), ["b.tsv.gz"])
+
+    def test_tsv_stdout(self):
+        exp = "name\tage\tS\nroot\tNA\tNA\nleft0\t10\tA,B\nleft1\t?\t\n"
+        with captured_output() as (stdout, _):
+            self._write(TsvRecordWriter("-", COLUMNS, ["age"], ["S"]))
+        self.assertEqual(stdout.getvalue(), exp)
+
+        # Blocks are flushed to stdout's binary handle, which is left open
+        out = io.TextIOWrapper(io.BytesIO())
+        with mock.patch("sys.stdout", out):
+            self._write(TsvRecordWriter("-", COLUMNS, ["age"], ["S"], buffer_rows=1))
+            self.assertEqual(out.buffer.getvalue().decode("utf-8"), exp)
+        self.assertFalse(out.closed)
+
+    def test_compile_formatter(self):
+        fmt = TsvRecordWriter.compile_formatter(COLUMNS, {"S"})
+        self.assertEqual(fmt(RECORDS[1]), "left0\t10\tA,B\n")
+        fmt = TsvRecordWriter.compile_formatter(["S"], {"S"})
+        self.assertEqual(fmt(RECORDS[0]), "NA\n")
+
+    def test_background_gzip_sink_error(self):
+        class Broken(io.BytesIO):
+            def write(self, data):
+                raise OSError("disk full")
+
+        sink = BackgroundGzipSink(Broken(), max_blocks=1)
+        with self.assertRaises(OSError):
+            for _ in range(10):
+                sink.write(b"abc" * 100000)
+            sink.close()
+
+    @unittest.skipIf(not numpy_available(), "numpy is not installed")
+    def test_npz(self):
+        import numpy as np
+
+        (fd, fn) = tempfile.mkstemp(suffix=".npz")
+        self.to_remove.append(fn)
+        self._write(NpzRecordWriter(fn, COLUMNS, ["age"], ["S"], batch_size=2))
+        res = np.load(fn)
+        self.assertEqual(list(res["columns"]), COLUMNS)
+        self.assertEqual(list(res["name.categories"]), ["root", "left0", "left1"])
+        self.assertEqual(list(res["name.codes"]), [0, 1, 2])
+        self.assertEqual(res["age"][1], 10.0)
+        self.assertTrue(np.isnan(res["age"][0]) and np.isnan(res["age"][2]))
+        self.assertEqual(list(res["S.lengths"]), [-1, 2, 0])
+        self.assertEqual(list(res["S.vocab"][res["S.ids"]]), ["A", "B"])
+
+    @unittest.skipIf(not pyarrow_available(), "pyarrow is not installed")
+    def test_parquet_and_arrow(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        for fmt in ("parquet", "arrow"):
+            (fd, fn) = tempfile.mkstemp(suffix="." + fmt)
+            self.to_remove.append(fn)
+            writer = ArrowRecordWriter(fn, COLUMNS, ["age"], ["S"], fmt, batch_size=2)
+            self._write(writer)
+            if fmt == "parquet":
+                table = pq.read_table(fn)
+            else:
+                table = pa.ipc.open_file(fn).read_all()
+            self.assertEqual(table.num_rows, 3)
+            self.assertEqual(table.schema.field("age").type, pa.float64())
+            res = table.to_pydict()
+            self.assertEqual(res["name"], ["root", "left0", "left1"])
+            self.assertEqual(res["age"], [None, 10.0, None])
+            self.assertEqual(res["S"], [None, ["A", "B"], []])
+
+    @unittest.skipIf(not numpy_available(), "numpy is not installed")
+    def test_open_record_writer_fallback(self):
+        (fd, fn) = tempfile.mkstemp(suffix=".parquet")
+        npz = fn[: -len(".parquet")] + ".npz"
+        self.to_remove.extend([fn, npz])
+        with mock.patch.object(writers, "pyarrow_available", return_value=False):
+            with captured_output() as (_, stderr):
+                writer = open_record_writer(fn, "parquet", COLUMNS, ["age"], ["S"])
+        self.assertTrue(isinstance(writer, NpzRecordWriter))
+        self.assertEqual(writer.output, npz)
+        self.assertTrue(
+            "pyarrow is not installed, writing npz to {}".format(npz)
+            in stderr.getvalue()
+        )
+        self._write(writer)
+        self.assertTrue(os.path.exists(npz))
+        self.assertEqual(os.path.getsize(fn), 0)
+
+        with self.assertRaises(ValueError):
+            open_record_writer(fn, "xlsx", COLUMNS)
+
+    def tearDown(self):
+        cleanup_files(TestRecordWriters.to_remove)
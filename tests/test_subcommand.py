@@ -1,11 +1,51 @@
 """Tests the `dmwg_data_pyutils.subcommands.base.Subcommand` class"""
 import unittest
+import subprocess
+import json
+import sys
+import os
+from unittest import mock
 
+from dmwg_data_pyutils import subcommands
 from dmwg_data_pyutils.subcommands import Subcommand
+from dmwg_data_pyutils import __main__
 from dmwg_data_pyutils.__main__ import main
 
 from utils import captured_output
 
+# Optional dependencies that only the work of a subcommand may import. The
+# CLI is called thousands of times from workflow engines, so `--help` must
+# not pay for them.
+HEAVY_MODULES = ["numpy", "pyarrow", "ijson"]
+
+HELP_SCRIPT = """
+import io, json, sys
+from dmwg_data_pyutils import __main__
+from dmwg_data_pyutils.__main__ import main
+stdout, sys.stdout = sys.stdout, io.StringIO()
+try:
+    main(args=sys.argv[1:] + ["--help"])
+except SystemExit:
+    pass
+sys.stdout = stdout
+json.dump(sorted(sys.modules), sys.stdout)
+"""
+
+
+def run_help(*args):
+    """
+    Runs `dmwg-data-pyutils *args --help` in a new interpreter and returns
+    the imported modules.
+    """
+    res = subprocess.run(
+        [sys.executable, "-c", HELP_SCRIPT] + list(args),
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+        cwd=os.path.dirname(os.path.dirname(subcommands.__path__[0])),
+    )
+    return json.loads(res.stdout)
+
 
 class TestSubcommand(unittest.TestCase):
     class Example(Subcommand):
@@ -42,3 +82,60 @@ class TestSubcommand(unittest.TestCase):
             with self.assertRaises(SystemExit) as context:
                 main(args=["Example", "--fake"], extra_subparser=TestSubcommand.Example)
         self.assertTrue("unrecognized arguments: --fake" in stderr.getvalue())
+
+    def test_registry(self):
+        self.assertEqual(set(subcommands.DESCRIPTIONS), set(subcommands.SUBCOMMANDS))
+        for name in subcommands.SUBCOMMANDS:
+            cls = subcommands.load_subcommand(name)
+            self.assertTrue(issubclass(cls, Subcommand))
+            self.assertEqual(cls.__tool_name__(), name)
+            self.assertEqual(cls.__get_description__(), subcommands.DESCRIPTIONS[name])
+            self.assertIs(getattr(subcommands, name), cls)
+        with self.assertRaises(AttributeError):
+            subcommands.NotASubcommand
+
+    def test_help_lists_descriptions(self):
+        with captured_output() as (stdout, _):
+            with self.assertRaises(SystemExit):
+                main(args=["--help"])
+        for description in subcommands.DESCRIPTIONS.values():
+            self.assertTrue(description.split()[0] in stdout.getvalue())
+
+    def test_selects_first_positional(self):
+        # A value named like a registered subcommand doesn't select it
+        with mock.patch.object(__main__, "load_subcommand") as load:
+            with captured_output() as (stdout, _):
+                with self.assertRaises(SystemExit):
+                    main(
+                        args=["Example", "ParseNextStrain", "--help"],
+                        extra_subparser=TestSubcommand.Example,
+                    )
+        load.assert_not_called()
+        self.assertTrue("usage: DMWG Data Utils Example" in stdout.getvalue())
+
+    def test_help_imports(self):
+        modules = run_help()
+        self.assertFalse("dmwg_data_pyutils.common.nextstrain" in modules)
+        for module in subcommands.SUBCOMMANDS.values():
+            self.assertFalse(
+                "dmwg_data_pyutils.subcommands.{}".format(module) in modules
+            )
+        for module in HEAVY_MODULES:
+            self.assertFalse(module in modules)
+
+        # Only the selected subcommand (and the modules of its base classes)
+        # is imported
+        names = {
+            k: "dmwg_data_pyutils.subcommands.{}".format(v)
+            for k, v in subcommands.SUBCOMMANDS.items()
+        }
+        for name, module in names.items():
+            modules = run_help(name)
+            cls = subcommands.load_subcommand(name)
+            bases = set(c.__module__ for c in cls.__mro__)
+            self.assertTrue(module in modules)
+            for other in names.values():
+                if other not in bases:
+                    self.assertFalse(other in modules)
+            for heavy in HEAVY_MODULES:
+                self.assertFalse(heavy in modules)
@@ -3,18 +3,47 @@ import unittest
 import tempfile
 import attr
 import json
+import gzip
+import os
+import sys
+import subprocess
 
 from dmwg_data_pyutils.subcommands import ParseNextStrain
 from dmwg_data_pyutils.__main__ import main
+from dmwg_data_pyutils.common.writers import pyarrow_available
+from dmwg_data_pyutils.common.synthetic import build_synthetic_tree
 
-from utils import captured_output, cleanup_files
-from test_common_nextstrain import build_test_tree
+from utils import captured_output, cleanup_files, serve_bodies
+from test_common_nextstrain import build_test_tree, build_random_tree
 
 
 @attr.s
 class MockArgs:
     json_path = attr.ib()
     output = attr.ib()
+    url = attr.ib(default=None)
+    cache_dir = attr.ib(default=None)
+    decompress_json = attr.ib(default=False)
+    workers = attr.ib(default=1)
+    format = attr.ib(default="tsv")
+    compression_level = attr.ib(default=6)
+    previous = attr.ib(default=None)
+    tips_only = attr.ib(default=False)
+    where = attr.ib(factory=list)
+    region = attr.ib(factory=list)
+    num_date_range = attr.ib(default=None)
+    columns = attr.ib(default=None)
+    genes = attr.ib(default=None)
+    infer_schema = attr.ib(default=False)
+    index_cache = attr.ib(default=None)
+    index_cache_size = attr.ib(default=2048)
+    batch = attr.ib(default=None)
+    merge = attr.ib(default=False)
+    suffix = attr.ib(default=".tsv.gz")
+    shard_by = attr.ib(default=None)
+    max_open_shards = attr.ib(default=64)
+    layout = attr.ib(default="wide")
+    tips_table = attr.ib(default=False)
 
 
 class TestParseNextStrain(unittest.TestCase):
@@ -78,5 +107,501 @@ class TestParseNextStrain(unittest.TestCase):
         self.assertTrue("Completed. Parsed 5 records." in serr)
         self.assertTrue("[dmwg_data_pyutils.main] - Finished!" in serr)
 
+    def test_cli_metrics(self):
+        (in_fd, in_fn) = tempfile.mkstemp()
+        self.to_remove.append(in_fn)
+        with open(in_fn, "wt") as o:
+            json.dump(build_test_tree(), o)
+        (out_fd, out_fn) = tempfile.mkstemp()
+        self.to_remove.append(out_fn)
+        (met_fd, met_fn) = tempfile.mkstemp()
+        self.to_remove.append(met_fn)
+
+        with captured_output() as (_, stderr):
+            main(
+                args=[
+                    "ParseNextStrain",
+                    "--json-path",
+                    in_fn,
+                    "--profile",
+                    "--metrics-out",
+                    met_fn,
+                    out_fn,
+                ]
+            )
+        serr = stderr.getvalue()
+        self.assertTrue("Stage load: wall" in serr)
+        self.assertTrue("Stage write profile:" in serr)
+
+        with open(met_fn, "rt") as fh:
+            report = json.load(fh)
+        self.assertEqual([i["name"] for i in report["stages"]], ["load", "write"])
+        self.assertEqual(report["stages"][0]["records"], 5)
+        self.assertEqual(report["stages"][1]["records"], 5)
+        profile = report["stages"][1]["profile"]
+        self.assertTrue("mutation_traversal_generator" in profile)
+
+    def test_main_previous(self):
+        (prev_fd, prev_fn) = tempfile.mkstemp()
+        self.to_remove.append(prev_fn)
+        with open(prev_fn, "wt") as o:
+            json.dump(build_test_tree(), o)
+
+        dat = build_test_tree()
+        dat["tree"]["children"][0]["children"][0]["node_attrs"]["age"] = 5
+        (in_fd, in_fn) = tempfile.mkstemp()
+        self.to_remove.append(in_fn)
+        with open(in_fn, "wt") as o:
+            json.dump(dat, o)
+        (out_fd, out_fn) = tempfile.mkstemp()
+        self.to_remove.append(out_fn)
+
+        ParseNextStrain.main(MockArgs(in_fn, out_fn, previous=prev_fn))
+        with open(out_fn, "rt") as fh:
+            hdr = fh.readline().rstrip("\r\n").split("\t")
+            recs = [dict(zip(hdr, line.rstrip("\r\n").split("\t"))) for line in fh]
+        self.assertEqual(hdr, ParseNextStrain.diff_colnames())
+        self.assertEqual(len(recs), 1)
+        self.assertEqual(recs[0]["change_type"], "changed")
+        self.assertEqual(recs[0]["name"], "left1")
+        self.assertEqual(recs[0]["age"], "5")
+        self.assertEqual(recs[0]["S"], "A")
+
+    def test_main_filters(self):
+        (in_fd, in_fn) = tempfile.mkstemp()
+        self.to_remove.append(in_fn)
+        with open(in_fn, "wt") as o:
+            json.dump(build_random_tree(300, seed=2), o)
+
+        for workers in (1, 2):
+            (out_fd, out_fn) = tempfile.mkstemp()
+            self.to_remove.append(out_fn)
+            args = MockArgs(
+                in_fn, out_fn, workers=workers, tips_only=True, where=["country=USA"]
+            )
+            ParseNextStrain.main(args)
+            with open(out_fn, "rt") as fh:
+                hdr = fh.readline().rstrip("\r\n").split("\t")
+                recs = [dict(zip(hdr, l.rstrip("\r\n").split("\t"))) for l in fh]
+            self.assertTrue(len(recs) > 0)
+            self.assertTrue(all(r["country"] == "USA" for r in recs))
+            parents = set(r["parent"] for r in recs)
+            self.assertFalse(any(r["name"] in parents for r in recs))
+
+        with self.assertRaises(ValueError):
+            ParseNextStrain.main(MockArgs(in_fn, out_fn, where=["nope=1"]))
+        with self.assertRaises(ValueError):
+            args = MockArgs(in_fn, out_fn, region=["Asia"], previous=in_fn)
+            ParseNextStrain.main(args)
+
+    def test_main_projection(self):
+        (in_fd, in_fn) = tempfile.mkstemp()
+        self.to_remove.append(in_fn)
+        with open(in_fn, "wt") as o:
+            json.dump(build_random_tree(300, seed=5), o)
+
+        res = {}
+        for workers in (1, 2):
+            (out_fd, out_fn) = tempfile.mkstemp()
+            self.to_remove.append(out_fn)
+            args = MockArgs(
+                in_fn, out_fn, workers=workers, columns=["country"], genes=["S"]
+            )
+            ParseNextStrain.main(args)
+            with open(out_fn, "rt") as fh:
+                res[workers] = fh.read()
+        self.assertEqual(res[1], res[2])
+        lines = res[1].splitlines()
+        self.assertEqual(lines[0], "parent\tname\tcountry\tS")
+        self.assertEqual(len(lines), 301)
+
+        with self.assertRaisesRegex(ValueError, "invalid choice: X"):
+            main(args=["ParseNextStrain", "--genes", "S,X", out_fn])
+
+    def test_cli_batch(self):
+        in_dir = tempfile.mkdtemp()
+        exp = {}
+        for i in range(3):
+            fn = os.path.join(in_dir, "ncov_2021-01-0{}.json".format(i + 1))
+            with open(fn, "wt") as o:
+                json.dump(build_random_tree(50 + i * 10, seed=i), o)
+            (out_fd, out_fn) = tempfile.mkstemp()
+            self.to_remove.append(out_fn)
+            ParseNextStrain.main(MockArgs(fn, out_fn))
+            with open(out_fn, "rt") as fh:
+                exp["ncov_2021-01-0{}".format(i + 1)] = fh.read()
+
+        out_dir = tempfile.mkdtemp()
+        args = [
+            "ParseNextStrain",
+            "--batch",
+            os.path.join(in_dir, "*.json"),
+            "--workers",
+            "2",
+            out_dir,
+        ]
+        with captured_output() as (_, stderr):
+            main(args=args)
+        self.assertTrue("Processing 3 of 3 snapshots" in stderr.getvalue())
+        self.assertTrue("Parsed 180 records of 3 snapshots" in stderr.getvalue())
+        for name, rows in exp.items():
+            with gzip.open(os.path.join(out_dir, name + ".tsv.gz"), "rt") as fh:
+                self.assertEqual(fh.read(), rows)
+
+        # Finished snapshots are skipped unless their input changed
+        os.utime(os.path.join(in_dir, "ncov_2021-01-02.json"), (0, 0))
+        with captured_output() as (_, stderr):
+            main(args=args)
+        self.assertTrue("Processing 1 of 3 snapshots" in stderr.getvalue())
+        self.assertTrue("Parsed 180 records of 3 snapshots" in stderr.getvalue())
+
+    def test_cli_batch_merge(self):
+        in_dir = tempfile.mkdtemp()
+        exp = []
+        for i in range(3):
+            fn = os.path.join(in_dir, "snap{}.json.gz".format(i))
+            with gzip.open(fn, "wt") as o:
+                json.dump(build_random_tree(40, seed=10 + i), o)
+            (out_fd, out_fn) = tempfile.mkstemp()
+            self.to_remove.append(out_fn)
+            ParseNextStrain.main(MockArgs(fn, out_fn))
+            with open(out_fn, "rt") as fh:
+                rows = fh.read().splitlines()
+            exp.extend("snap{}\t{}".format(i, row) for row in rows[1:])
+        manifest = os.path.join(in_dir, "manifest.txt")
+        with open(manifest, "wt") as o:
+            o.write("# Snapshots\nsnap2.json.gz\n\nsnap0.json.gz\nsnap1.json.gz\n")
+        exp = exp[80:] + exp[:80]
+
+        (out_fd, out_fn) = tempfile.mkstemp(suffix=".tsv.gz")
+        self.to_remove.append(out_fn)
+        args = ["ParseNextStrain", "--batch", "@" + manifest, "--merge", out_fn]
+        # A crash on the last snapshot keeps the finished ones
+        os.rename(os.path.join(in_dir, "snap1.json.gz"), os.path.join(in_dir, "tmp"))
+        with captured_output():
+            with self.assertRaises(FileNotFoundError):
+                main(args=args)
+        os.rename(os.path.join(in_dir, "tmp"), os.path.join(in_dir, "snap1.json.gz"))
+        with captured_output() as (_, stderr):
+            main(args=args)
+        self.assertTrue("Processing 1 of 3 snapshots" in stderr.getvalue())
+        self.assertFalse(os.path.exists(out_fn + ".parts"))
+
+        with gzip.open(out_fn, "rt") as fh:
+            lines = fh.read().splitlines()
+        self.assertEqual(lines[0].split("\t"), ["snapshot"] + ParseNextStrain.colnames())
+        self.assertEqual(lines[1:], exp)
+
+        with self.assertRaisesRegex(ValueError, "No input files"):
+            main(args=["ParseNextStrain", "--batch", in_dir + "/*.xyz", out_fn])
+
+    def test_cli_index_cache(self):
+        (in_fd, in_fn) = tempfile.mkstemp()
+        self.to_remove.append(in_fn)
+        with open(in_fn, "wt") as o:
+            json.dump(build_random_tree(200, seed=8), o)
+        cache_dir = tempfile.mkdtemp()
+
+        res = []
+        for expected in ("Cached index in", "Loaded cached index"):
+            (out_fd, out_fn) = tempfile.mkstemp()
+            self.to_remove.append(out_fn)
+            with captured_output() as (_, stderr):
+                main(
+                    args=[
+                        "ParseNextStrain",
+                        "--json-path",
+                        in_fn,
+                        "--index-cache",
+                        cache_dir,
+                        "--workers",
+                        "2",
+                        out_fn,
+                    ]
+                )
+            self.assertTrue(expected in stderr.getvalue())
+            with open(out_fn, "rt") as fh:
+                res.append(fh.read())
+        self.assertEqual(res[0], res[1])
+        self.assertEqual(len(res[0].splitlines()), 201)
+
+    def test_cli_shard_by(self):
+        (in_fd, in_fn) = tempfile.mkstemp()
+        self.to_remove.append(in_fn)
+        with open(in_fn, "wt") as o:
+            json.dump(build_synthetic_tree(300, seed=5), o)
+        (out_fd, out_fn) = tempfile.mkstemp()
+        self.to_remove.append(out_fn)
+        ParseNextStrain.main(MockArgs(in_fn, out_fn, columns=["region", "country"]))
+        with open(out_fn, "rt") as fh:
+            rows = [line.split("\t") for line in fh.read().splitlines()[1:]]
+
+        for shard_by, nshards in (("region", 4), ("hash:3", 3)):
+            out_dir = tempfile.mkdtemp()
+            args = [
+                "ParseNextStrain",
+                "--json-path",
+                in_fn,
+                "--shard-by",
+                shard_by,
+                "--max-open-shards",
+                "2",
+                "--columns",
+                "country",
+                "--genes",
+                "",
+                out_dir,
+            ]
+            with captured_output() as (_, stderr):
+                main(args=args)
+            self.assertTrue("Wrote {} shards".format(nshards) in stderr.getvalue())
+            with open(os.path.join(out_dir, "manifest.json"), "rt") as fh:
+                manifest = json.load(fh)
+            self.assertEqual(manifest["shard_by"], shard_by)
+            self.assertEqual(manifest["records"], len(rows))
+            self.assertEqual(len(manifest["shards"]), nshards)
+            res = []
+            for shard in manifest["shards"]:
+                with gzip.open(os.path.join(out_dir, shard["path"]), "rt") as fh:
+                    lines = fh.read().splitlines()
+                self.assertEqual(lines[0], "parent\tname\tcountry")
+                self.assertEqual(shard["records"], len(lines) - 1)
+                res.extend((shard["partition"], line) for line in lines[1:])
+            if shard_by == "region":
+                exp = [(r[2], "\t".join([r[0], r[1], r[3]])) for r in rows]
+                self.assertEqual(sorted(res), sorted(exp))
+            else:
+                exp = ["\t".join([r[0], r[1], r[3]]) for r in rows]
+                self.assertEqual(sorted(i for _, i in res), sorted(exp))
+
+        with captured_output():
+            with self.assertRaisesRegex(ValueError, "invalid choice: lineage"):
+                main(args=["ParseNextStrain", "--shard-by", "lineage", out_dir])
+            with self.assertRaisesRegex(ValueError, "hash:N with N > 0"):
+                main(args=["ParseNextStrain", "--shard-by", "hash:0", out_dir])
+
+    def test_cli_layout_normalized(self):
+        (in_fd, in_fn) = tempfile.mkstemp()
+        self.to_remove.append(in_fn)
+        with open(in_fn, "wt") as o:
+            json.dump(build_synthetic_tree(300, seed=7), o)
+        (out_fd, out_fn) = tempfile.mkstemp()
+        self.to_remove.append(out_fn)
+        ParseNextStrain.main(MockArgs(in_fn, out_fn))
+        with open(out_fn, "rt") as fh:
+            lines = fh.read().splitlines()
+        colnames = lines[0].split("\t")
+        wide = [dict(zip(colnames, line.split("\t"))) for line in lines[1:]]
+
+        out_dir = tempfile.mkdtemp()
+        args = [
+            "ParseNextStrain",
+            "--json-path",
+            in_fn,
+            "--layout",
+            "normalized",
+            "--tips-table",
+            out_dir,
+        ]
+        with captured_output():
+            main(args=args)
+        self.assertEqual(
+            sorted(os.listdir(out_dir)),
+            ["branch_mutations.tsv.gz", "nodes.tsv.gz", "tip_mutations.tsv.gz"],
+        )
+        tables = {}
+        for table in ("nodes", "branch_mutations", "tip_mutations"):
+            with gzip.open(os.path.join(out_dir, table + ".tsv.gz"), "rt") as fh:
+                lines = fh.read().splitlines()
+            tables[table] = [line.split("\t") for line in lines]
+        attrs = ParseNextStrain.colnames(genes=[])
+        self.assertEqual(tables["nodes"][0], attrs)
+        self.assertEqual(
+            tables["nodes"][1:], [[r[k] for k in attrs] for r in wide]
+        )
+
+        # Joining each node to its ancestors gives the cumulative mutations
+        self.assertEqual(tables["branch_mutations"][0], ["name", "gene", "mutation"])
+        own = {}
+        for name, gene, mutation in tables["branch_mutations"][1:]:
+            own.setdefault((name, gene), set()).add(mutation)
+        parents = {r["name"]: r["parent"] for r in wide}
+        tips = []
+        for rec in wide:
+            for gene in ParseNextStrain.colnames(attr_keys=[])[2:]:
+                muts = set()
+                name = rec["name"]
+                while parents[name] != name:
+                    muts.update(own.get((name, gene), ()))
+                    name = parents[name]
+                exp = ",".join(sorted(muts)) if muts else "NA"
+                self.assertEqual(exp, rec[gene])
+                if rec["name"] not in parents.values():
+                    tips.extend([rec["name"], gene, m] for m in sorted(muts))
+        self.assertEqual(tables["tip_mutations"][1:], tips)
+
+        with captured_output():
+            with self.assertRaisesRegex(ValueError, "needs --layout normalized"):
+                main(args=["ParseNextStrain", "--tips-table", out_dir])
+            with self.assertRaisesRegex(ValueError, "can't be combined"):
+                main(args=args[:-1] + ["--tips-only", out_dir])
+
+    def test_cli_stdio(self):
+        dat = build_random_tree(500, seed=8)
+        (in_fd, in_fn) = tempfile.mkstemp()
+        self.to_remove.append(in_fn)
+        with open(in_fn, "wt") as o:
+            json.dump(dat, o)
+        (out_fd, out_fn) = tempfile.mkstemp()
+        self.to_remove.append(out_fn)
+        ParseNextStrain.main(MockArgs(in_fn, out_fn))
+        with open(out_fn, "rb") as fh:
+            exp = fh.read()
+
+        # Gzipped JSON from stdin, TSV on stdout and the logs on stderr
+        body = gzip.compress(json.dumps(dat).encode("utf-8"))
+        args = ["ParseNextStrain", "--json-path", "-", "-"]
+        res = subprocess.run(
+            [sys.executable, "-m", "dmwg_data_pyutils"] + args,
+            input=body,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            check=True,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        )
+        self.assertEqual(res.stdout, exp)
+        self.assertTrue(b"Reading JSON from stdin" in res.stderr)
+        self.assertTrue(b"Parsed 500 records" in res.stderr)
+
+        for extra in (["--format", "parquet"], ["--shard-by", "region"]):
+            with captured_output():
+                with self.assertRaisesRegex(ValueError, "written to stdout"):
+                    main(args=["ParseNextStrain"] + extra + ["-"])
+
+    def test_cli_infer_schema(self):
+        dat = build_synthetic_tree(200, seed=3)
+        dat["meta"]["colorings"].append({"key": "gt", "type": "categorical"})
+        dat["tree"]["node_attrs"]["pango_lineage"] = {"value": "B.1"}
+        dat["meta"]["colorings"].append({"key": "pango_lineage"})
+        (in_fd, in_fn) = tempfile.mkstemp()
+        self.to_remove.append(in_fn)
+        with open(in_fn, "wt") as o:
+            json.dump(dat, o)
+        (out_fd, out_fn) = tempfile.mkstemp()
+        self.to_remove.append(out_fn)
+
+        with captured_output() as (_, stderr):
+            main(
+                args=[
+                    "ParseNextStrain",
+                    "--json-path",
+                    in_fn,
+                    "--infer-schema",
+                    "--where",
+                    "pango_lineage=B.1",
+                    out_fn,
+                ]
+            )
+        self.assertTrue("Inferred 6 attribute and" in stderr.getvalue())
+        with open(out_fn, "rt") as fh:
+            lines = fh.read().splitlines()
+        genes = sorted(dat["meta"]["genome_annotations"])
+        self.assertEqual(
+            lines[0].split("\t"),
+            ["parent", "name", "region", "country", "clade_membership", "num_date"]
+            + ["pango_lineage", "div"]
+            + genes,
+        )
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[1].split("\t")[6], "B.1")
+
+        with self.assertRaisesRegex(ValueError, "--columns: invalid choice"):
+            main(args=["ParseNextStrain", "--columns", "pango_lineage", out_fn])
+
+    @unittest.skipIf(not pyarrow_available(), "pyarrow is not installed")
+    def test_main_projection_parquet(self):
+        import pyarrow.parquet as pq
+
+        (in_fd, in_fn) = tempfile.mkstemp()
+        self.to_remove.append(in_fn)
+        with open(in_fn, "wt") as o:
+            json.dump(build_test_tree(), o)
+        (out_fd, out_fn) = tempfile.mkstemp(suffix=".parquet")
+        self.to_remove.append(out_fn)
+
+        args = MockArgs(in_fn, out_fn, format="parquet", columns=["age"], genes=["nuc"])
+        ParseNextStrain.main(args)
+        res = pq.read_table(out_fn).to_pydict()
+        self.assertEqual(list(res), ["parent", "name", "age", "nuc"])
+        self.assertEqual(res["nuc"], [None, None, ["B"], ["B"], None])
+
+    def test_cli_download(self):
+        raw = json.dumps(build_test_tree()).encode("utf-8")
+        in_fn = os.path.join(tempfile.mkdtemp(), "ncov.json")
+        self.to_remove.append(in_fn)
+        (out_fd, out_fn) = tempfile.mkstemp()
+        self.to_remove.append(out_fn)
+
+        with serve_bodies({"/ncov.json": gzip.compress(raw)}) as url:
+            with captured_output() as (_, stderr):
+                main(
+                    args=[
+                        "ParseNextStrain",
+                        "--url",
+                        url + "/ncov.json",
+                        "--json-path",
+                        in_fn,
+                        out_fn,
+                    ]
+                )
+        serr = stderr.getvalue()
+        self.assertTrue("Downloading JSON to {}".format(in_fn) in serr)
+        self.assertTrue("Completed. Parsed 5 records." in serr)
+        with open(in_fn, "rb") as fh:
+            self.assertEqual(gzip.decompress(fh.read()), raw)
+
+        # Reads the gzipped JSON back
+        with captured_output() as (_, stderr):
+            main(args=["ParseNextStrain", "--json-path", in_fn, out_fn])
+        self.assertTrue("Completed. Parsed 5 records." in stderr.getvalue())
+
+    def test_main_workers(self):
+        dat = build_random_tree(500)
+        (in_fd, in_fn) = tempfile.mkstemp()
+        self.to_remove.append(in_fn)
+        with open(in_fn, "wt") as o:
+            json.dump(dat, o)
+
+        for suffix, ofunc in ((".tsv", open), (".tsv.gz", gzip.open)):
+            res = []
+            for workers in (1, 3):
+                (out_fd, out_fn) = tempfile.mkstemp(suffix=suffix)
+                self.to_remove.append(out_fn)
+                with captured_output() as (_, stderr):
+                    ParseNextStrain.main(MockArgs(in_fn, out_fn, workers=workers))
+                self.assertTrue("Completed. Parsed 500 records." in stderr.getvalue())
+                with ofunc(out_fn, "rt") as fh:
+                    res.append(fh.read())
+            self.assertEqual(res[0], res[1])
+            self.assertEqual(len(res[0].splitlines()), 501)
+
+    @unittest.skipIf(not pyarrow_available(), "pyarrow is not installed")
+    def test_main_parquet(self):
+        import pyarrow.parquet as pq
+
+        (in_fd, in_fn) = tempfile.mkstemp()
+        self.to_remove.append(in_fn)
+        with open(in_fn, "wt") as o:
+            json.dump(build_test_tree(), o)
+        (out_fd, out_fn) = tempfile.mkstemp(suffix=".parquet")
+        self.to_remove.append(out_fn)
+
+        ParseNextStrain.main(MockArgs(in_fn, out_fn, format="parquet"))
+        res = pq.read_table(out_fn).to_pydict()
+        self.assertEqual(list(res), ParseNextStrain.colnames())
+        self.assertEqual(res["name"], ["root", "left0", "left2", "left3", "left1"])
+        self.assertEqual(res["age"], [None, 10.0, None, None, None])
+        self.assertEqual(res["nuc"], [None, None, ["B"], ["B"], None])
+
     def tearDown(self):
         cleanup_files(TestParseNextStrain.to_remove)
@@ -0,0 +1,116 @@
+"""Tests the `dmwg_data_pyutils.subcommands.ParseNextStrainBuilds` class"""
+import unittest
+import tempfile
+import json
+import gzip
+import os
+
+from dmwg_data_pyutils.subcommands import ParseNextStrain, ParseNextStrainBuilds
+from dmwg_data_pyutils.__main__ import main
+
+from utils import captured_output, cleanup_files, serve_bodies
+from test_common_nextstrain import build_test_tree, build_random_tree
+
+
+class TestParseNextStrainBuilds(unittest.TestCase):
+    to_remove = []
+
+    def expected_rows(self, dat):
+        """Utility to get the ParseNextStrain rows of a tree"""
+        (in_fd, in_fn) = tempfile.mkstemp()
+        self.to_remove.append(in_fn)
+        with open(in_fn, "wt") as o:
+            json.dump(dat, o)
+        (out_fd, out_fn) = tempfile.mkstemp()
+        self.to_remove.append(out_fn)
+        with captured_output():
+            main(args=["ParseNextStrain", "--json-path", in_fn, out_fn])
+        with open(out_fn, "rt") as fh:
+            return fh.read().splitlines()
+
+    def test_cli(self):
+        trees = {
+            "europe": build_random_tree(150, seed=1),
+            "asia": build_random_tree(100, seed=2),
+            "local": build_test_tree(),
+        }
+        exp = {name: self.expected_rows(dat) for name, dat in trees.items()}
+        bodies = {
+            "/ncov_europe.json": gzip.compress(json.dumps(trees["europe"]).encode()),
+            "/ncov_asia.json": json.dumps(trees["asia"]).encode(),
+        }
+        (in_fd, in_fn) = tempfile.mkstemp()
+        self.to_remove.append(in_fn)
+        with open(in_fn, "wt") as o:
+            json.dump(trees["local"], o)
+        out_dir = tempfile.mkdtemp()
+        cache_dir = tempfile.mkdtemp()
+
+        with serve_bodies(bodies) as url:
+            args = [
+                "ParseNextStrainBuilds",
+                "--cache-dir",
+                cache_dir,
+                "--workers",
+                "2",
+                out_dir,
+                url + "/ncov_europe.json",
+                "asia=" + url + "/ncov_asia.json",
+                "local=" + in_fn,
+            ]
+            for _ in range(2):
+                with captured_output() as (_, stderr):
+                    main(args=args)
+                serr = stderr.getvalue()
+                self.assertTrue("Parsed 150 records of ncov_europe" in serr)
+                self.assertTrue("Completed. Parsed 255 records of 3 builds." in serr)
+
+        names = {"ncov_europe": "europe", "asia": "asia", "local": "local"}
+        self.assertEqual(
+            sorted(os.listdir(out_dir)),
+            sorted(["combined.tsv.gz"] + [i + ".tsv.gz" for i in names]),
+        )
+        for name, tree in names.items():
+            with gzip.open(os.path.join(out_dir, name + ".tsv.gz"), "rt") as fh:
+                self.assertEqual(fh.read().splitlines(), exp[tree])
+
+        with gzip.open(os.path.join(out_dir, "combined.tsv.gz"), "rt") as fh:
+            lines = fh.read().splitlines()
+        self.assertEqual(lines[0], "dataset\t" + exp["local"][0])
+        res = [line.partition("\t") for line in lines[1:]]
+        self.assertEqual([i[0] for i in res[:150]], ["ncov_europe"] * 150)
+        self.assertEqual([i[2] for i in res[:150]], exp["europe"][1:])
+        self.assertEqual([i[2] for i in res[150:250]], exp["asia"][1:])
+        self.assertEqual([i[2] for i in res[250:]], exp["local"][1:])
+
+    def test_cli_failed(self):
+        out_dir = tempfile.mkdtemp()
+        with serve_bodies({}) as url:
+            with captured_output() as (_, stderr):
+                with self.assertRaisesRegex(RuntimeError, "missing"):
+                    main(args=["ParseNextStrainBuilds", out_dir, url + "/missing.json"])
+        self.assertTrue("Failed to fetch missing" in stderr.getvalue())
+        self.assertEqual(os.listdir(out_dir), [])
+
+    def test_dataset_names(self):
+        res = ParseNextStrainBuilds.dataset_names(
+            [
+                "http://data.nextstrain.org/ncov_europe.json",
+                "oceania=http://data.nextstrain.org/ncov_oceania.json?v=1",
+                "/data/ncov_asia.json.gz",
+            ]
+        )
+        self.assertEqual(
+            res,
+            [
+                ("ncov_europe", "http://data.nextstrain.org/ncov_europe.json"),
+                ("oceania", "http://data.nextstrain.org/ncov_oceania.json?v=1"),
+                ("ncov_asia", "/data/ncov_asia.json.gz"),
+            ],
+        )
+        with self.assertRaises(ValueError):
+            ParseNextStrainBuilds.dataset_names(["a/ncov.json", "b/ncov.json"])
+        self.assertTrue(issubclass(ParseNextStrainBuilds, ParseNextStrain))
+
+    def tearDown(self):
+        cleanup_files(TestParseNextStrainBuilds.to_remove)
@@ -0,0 +1,82 @@
+"""Tests the `dmwg_data_pyutils.subcommands.QueryNextStrain` class"""
+import unittest
+import tempfile
+import json
+
+from dmwg_data_pyutils.__main__ import main
+from dmwg_data_pyutils.common.nextstrain import NODE_ATTRS
+from dmwg_data_pyutils.subcommands import ParseNextStrain, QueryNextStrain
+
+from utils import captured_output, cleanup_files
+from test_common_nextstrain import build_test_tree
+
+
+class TestQueryNextStrain(unittest.TestCase):
+    to_remove = []
+
+    def write_tree(self):
+        (in_fd, in_fn) = tempfile.mkstemp()
+        self.to_remove.append(in_fn)
+        with open(in_fn, "wt") as o:
+            json.dump(build_test_tree(), o)
+        return in_fn
+
+    def test_colnames(self):
+        self.assertEqual(
+            QueryNextStrain.query_colnames(), ["parent", "name"] + NODE_ATTRS
+        )
+        # The inherited ParseNextStrain helpers keep their signature
+        self.assertEqual(
+            QueryNextStrain.colnames(["age"], ["S"]),
+            ParseNextStrain.colnames(["age"], ["S"]),
+        )
+
+    def test_cli(self):
+        in_fn = self.write_tree()
+        (out_fd, out_fn) = tempfile.mkstemp()
+        self.to_remove.append(out_fn)
+
+        with captured_output() as (_, stderr):
+            main(
+                args=[
+                    "QueryNextStrain",
+                    "--json-path",
+                    in_fn,
+                    "--output",
+                    out_fn,
+                    "S:A AND NOT nuc:B",
+                ]
+            )
+        self.assertTrue("Found 2 matching nodes" in stderr.getvalue())
+        with open(out_fn, "rt") as fh:
+            hdr = fh.readline().rstrip("\r\n").split("\t")
+            recs = [dict(zip(hdr, line.rstrip("\r\n").split("\t"))) for line in fh]
+        self.assertEqual([r["name"] for r in recs], ["left0", "left1"])
+        self.assertEqual([r["parent"] for r in recs], ["root", "left0"])
+        self.assertEqual(recs[0]["age"], "10")
+
+    def test_cli_count(self):
+        in_fn = self.write_tree()
+        with captured_output() as (stdout, _):
+            main(
+                args=[
+                    "QueryNextStrain",
+                    "--json-path",
+                    in_fn,
+                    "--count",
+                    "--tips-only",
+                    "--where",
+                    "age=NA",
+                    "S:A",
+                ]
+            )
+        self.assertEqual(stdout.getvalue(), "2\n")
+
+    def test_cli_bad_where(self):
+        in_fn = self.write_tree()
+        with captured_output():
+            with self.assertRaises(ValueError):
+                main(args=["QueryNextStrain", "--json-path", in_fn, "--where", "age"])
+
+    def tearDown(self):
+        cleanup_files(TestQueryNextStrain.to_remove)
@@ -1,9 +1,12 @@
 """Utilities for testing."""
 import sys
 import os
+import threading
+import hashlib
 
 from io import StringIO
 from contextlib import contextmanager
+from http.server import HTTPServer, BaseHTTPRequestHandler
 
 from dmwg_data_pyutils.common.logger import Logger
 
@@ -38,3 +41,46 @@ def cleanup_files(files):
 
     for fil in flist:
         _do_remove(fil)
+
+
+@contextmanager
+def serve_bodies(bodies):
+    """
+    Serves the `bodies` dict of path to bytes from a local HTTP server
+    and yields its base URL. Bodies get an ETag and answer matching
+    `If-None-Match` requests with 304. Requests are recorded in
+    `server.requests`.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            server.requests.append((self.path, dict(self.headers)))
+            if self.path not in bodies:
+                self.send_error(404)
+                return
+            body = bodies[self.path]
+            etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", "Mon, 01 Jun 2020 00:00:00 GMT")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield "http://127.0.0.1:{}".format(server.server_address[1])
+    finally:
+        server.shutdown()
+        server.server_close()